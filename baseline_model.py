@@ -4,8 +4,10 @@ import argparse
 from sklearn import ensemble
 from sklearn.utils import shuffle
 from sklearn.metrics import mean_squared_error
-from sklearn.model_selection import train_test_split, GridSearchCV, StratifiedKFold
+from sklearn.model_selection import train_test_split, KFold, ParameterGrid
 import xgboost as xgb
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
 
 from time import time
 import os
@@ -21,7 +23,8 @@ parser = argparse.ArgumentParser(
 # Model / Training
 parser.add_argument("-m", "--model", type=str, default="xgboost",
                     choices = ["gbrt", "xgboost", "xgb_cv",
-                               "xgb_gs", "save"],
+                               "xgb_gs", "xgb_sh", "xgb_bench", "xgb_extmem",
+                               "save"],
                     help="Choose which baseline model to train "
                          "(default: xgboost)")
 parser.add_argument("-b", "--booster", type=str, default="gbtree",
@@ -59,6 +62,34 @@ parser.add_argument("--gpu", action="store_true",
                          "Currently only supported by 'xgboost'")
 parser.add_argument("--xgb-num-thread", type=int, default=4,
                     help="Number of parallel threads for XGBoost")
+parser.add_argument("--tree-method", type=str, default="hist",
+                    choices=["exact", "approx", "hist"],
+                    help="Tree construction algorithm for XGBoost on CPU "
+                         "(default: hist). '--gpu' always uses 'gpu_hist'")
+parser.add_argument("--max-bin", type=int, default=256,
+                    help="Maximum number of bins per feature for "
+                         "histogram-based tree methods (default: 256)")
+parser.add_argument("--float32-cache", action="store_true",
+                    help="With '--model save', store the datasets as "
+                         "float32 arrays, which histogram-based tree "
+                         "methods load as an 'xgb.QuantileDMatrix' (if "
+                         "supported by the installed XGBoost), binned "
+                         "on every load")
+parser.add_argument("--sh-min-size", type=int, default=10000,
+                    help="Size of the random subset that every candidate "
+                         "is first cross-validated on with '--model xgb_sh'")
+parser.add_argument("--sh-eta", type=int, default=3,
+                    help="With '--model xgb_sh', only the best 1/eta of the "
+                         "candidates are promoted to the next subset, which "
+                         "is eta times larger (default: 3)")
+parser.add_argument("--bench-sizes", type=str, default="10000,100000,1000000",
+                    help="Comma-separated dataset sizes to benchmark "
+                         "'approx' against 'hist' on with '--model xgb_bench'")
+parser.add_argument("--cache-dir", type=str, default="data/xgb_cache",
+                    help="Directory for the external memory cache of "
+                         "'--model xgb_extmem', which streams the dataset "
+                         "from the database in blocks of '--batch-size' "
+                         "rows (default block size: 1000000)")
 parser.add_argument("--use-saved", action="store_true",
                     help="Use the preprocessed & saved DMatrix data. "
                          "Need to first run with '--model save'. "
@@ -77,6 +108,17 @@ parser.add_argument("--pred-model", default=None, type=str,
                          "with. The model should be placed in "
                          "the directory specified by `--models-dir`")
 
+# Continued Training
+parser.add_argument("--continue-model", default=None, type=str,
+                    help="The name of a saved model (in the directory "
+                         "specified by `--models-dir`) to continue training "
+                         "with '--model xgboost', using only the rides picked "
+                         "up after the watermark recorded in the model")
+parser.add_argument("--refresh-leaves", action="store_true",
+                    help="With `--continue-model`, refresh the leaf values "
+                         "of the existing trees on the new rides instead of "
+                         "adding `--num-trees` new trees")
+
 # Dataset
 parser.add_argument("-sm", "--stddev-mul", type=float,
                     default=1, choices=[-1,0.25,0.5,1,2],
@@ -184,6 +226,8 @@ def xgboost(features=None, outputs=None,
             dart_params=None,
             gpu=False,
             n_jobs=4,
+            tree_method="hist",
+            max_bin=256,
             use_saved=False,
             save_path=None,
             verbose=True):
@@ -203,6 +247,10 @@ def xgboost(features=None, outputs=None,
                   parameters
     :gpu: Whether to use GPU to train or not
     :n_jobs: When not using GPU, number of threads to use to train
+    :tree_method: Tree construction algorithm to use when not using
+                  GPU ("exact", "approx" or "hist")
+    :max_bin: Maximum number of bins per feature for "hist"
+              (and "gpu_hist")
     :use_saved: Whether to use data already preprocessed and
                 saved to disk in the form of `xgb.DMatrix`
                 (run with `--model save` option first)
@@ -227,7 +275,8 @@ def xgboost(features=None, outputs=None,
                              random_state=10701)
 
         params = {
-            "tree_method": "gpu_hist" if gpu else "approx",
+            "tree_method": "gpu_hist" if gpu else tree_method,
+            "max_bin": max_bin,
             "n_estimators": num_trees,
             "booster": booster,
             "objective": objective,
@@ -259,7 +308,8 @@ def xgboost(features=None, outputs=None,
         assert save_path is not None, \
             "ERROR: Need to provide 'save_path'."
         params = {
-            "tree_method": "gpu_hist" if gpu else "approx",
+            "tree_method": "gpu_hist" if gpu else tree_method,
+            "max_bin": max_bin,
             "booster": booster,
             "objective": objective,
             "learning_rate": lr,
@@ -268,6 +318,8 @@ def xgboost(features=None, outputs=None,
             "max_depth": max_depth,
             "eval_metric": loss,
         }
+        if not gpu:
+            params['nthread'] = n_jobs
         if booster == "dart":
             assert dart_params is not None, \
                 "ERROR: Please provide DART-related parameters"
@@ -275,8 +327,10 @@ def xgboost(features=None, outputs=None,
             params['sample_type'] = dart_params['sample_type']
             params['normalize_type'] = dart_params['normalize_type']
 
-        dtrain = xgb.DMatrix(save_path + '.train')
-        dval = xgb.DMatrix(save_path + '.val')
+        # Histogram-based methods bin the float32 cache on loading
+        quantile_bins = max_bin if gpu or tree_method == "hist" else None
+        dtrain = load_dmatrix(save_path + '.train', max_bin=quantile_bins)
+        dval = load_dmatrix(save_path + '.val', max_bin=quantile_bins, ref=dtrain)
         watchlist = [(dtrain,"train"),(dval,"validation")]
         evals_result = {}
 
@@ -302,6 +356,55 @@ def xgboost(features=None, outputs=None,
     return result, model
 
 
+def xgb_cv_on_folds(params, folds,
+                    num_boost_round=100,
+                    metric="rmse",
+                    early_stopping_rounds=10,
+                    verbose=False):
+    """Conducts K-fold CV over prebuilt fold DMatrices,
+    training one booster per fold in lockstep like `xgb.cv`
+
+    :params: Parameters of the boosters
+    :folds: List of (train, test) `xgb.DMatrix` pairs
+    :num_boost_round: The maximum number of iterations (trees)
+    :metric: The evaluation metric set in `params`
+    :early_stopping_rounds: Stop once the mean test loss has not
+        improved for this many iterations
+    :verbose: Prints out the mean losses at each iteration
+    :returns: The losses up to the best iteration, in the
+        format of `xgb.cv(..., as_pandas=False)`
+    """
+    boosters = [xgb.Booster(params, [fold_train, fold_test])
+                for fold_train, fold_test in folds]
+    cv_result = {f"{split}-{metric}-{stat}": []
+                 for split in ("train", "test") for stat in ("mean", "std")}
+    best_iteration, best_loss = 0, np.inf
+    for iteration in range(num_boost_round):
+        losses = []
+        for booster, (fold_train, fold_test) in zip(boosters, folds):
+            booster.update(fold_train, iteration)
+            # Formatted as '[iteration]\ttrain-rmse:loss\ttest-rmse:loss'
+            eval_str = booster.eval_set([(fold_train, "train"), (fold_test, "test")],
+                                        iteration)
+            losses.append([float(item.split(":")[1]) for item in eval_str.split()[1:]])
+        losses = np.array(losses)
+        for split_idx, split in enumerate(("train", "test")):
+            cv_result[f"{split}-{metric}-mean"].append(losses[:, split_idx].mean())
+            cv_result[f"{split}-{metric}-std"].append(losses[:, split_idx].std())
+        if verbose:
+            print(f"[{iteration}]\t"
+                  f"train-{metric}:{cv_result[f'train-{metric}-mean'][-1]:.5f}\t"
+                  f"test-{metric}:{cv_result[f'test-{metric}-mean'][-1]:.5f}")
+
+        if cv_result[f"test-{metric}-mean"][-1] < best_loss:
+            best_iteration = iteration
+            best_loss = cv_result[f"test-{metric}-mean"][-1]
+        elif iteration - best_iteration >= early_stopping_rounds:
+            break
+
+    return {key: values[:best_iteration + 1] for key, values in cv_result.items()}
+
+
 def xgb_cv(features=None, outputs=None,
            nfold=10,
            loss_fn="LSE",
@@ -312,6 +415,8 @@ def xgb_cv(features=None, outputs=None,
            max_depth=3,
            dart_params=None,
            gpu=False,
+           tree_method="hist",
+           max_bin=256,
            use_saved=False,
            save_path=None,
            seed=None,
@@ -337,7 +442,8 @@ def xgb_cv(features=None, outputs=None,
         dtrain = xgb.DMatrix(features, label=outputs)
 
         params = {
-            "tree_method": "gpu_hist" if gpu else "approx",
+            "tree_method": "gpu_hist" if gpu else tree_method,
+            "max_bin": max_bin,
             "booster": booster,
             "objective": objective,
             "learning_rate": lr,
@@ -369,7 +475,8 @@ def xgb_cv(features=None, outputs=None,
         assert save_path is not None, \
             "ERROR: Need to provide 'save_path'."
         params = {
-            "tree_method": "gpu_hist" if gpu else "approx",
+            "tree_method": "gpu_hist" if gpu else tree_method,
+            "max_bin": max_bin,
             "booster": booster,
             "objective": objective,
             "learning_rate": lr,
@@ -385,19 +492,15 @@ def xgb_cv(features=None, outputs=None,
             params["sample_type"] = dart_params["sample_type"]
             params["normalize_type"] = dart_params["normalize_type"]
 
-        dtrain = xgb.DMatrix(save_path + ".train")
+        # Reuse the folds cached next to the stored dataset
+        folds = load_cv_folds(save_path, nfold, seed=seed, verbose=verbose)
 
-        cv_result = xgb.cv(params, dtrain,
-                           num_boost_round=num_trees,
-                           nfold=nfold,
-                           metrics=[loss],
-                           shuffle=True,
-                           seed=seed,
-                           early_stopping_rounds=10,
-                           verbose_eval=verbose,
-                           show_stdv=verbose,
-                           as_pandas=False,
-                          )
+        cv_result = xgb_cv_on_folds(params, folds,
+                                    num_boost_round=num_trees,
+                                    metric=loss,
+                                    early_stopping_rounds=10,
+                                    verbose=verbose,
+                                   )
 
     if verbose:
         print(">>> Model training complete")
@@ -406,12 +509,18 @@ def xgb_cv(features=None, outputs=None,
     val_losses   = cv_result[f"test-{loss}-mean"]
     train_losses_std = cv_result[f"train-{loss}-std"]
     val_losses_std   = cv_result[f"test-{loss}-std"]
-    result = {}
+    result = {
+        "val_loss":         val_losses[-1],
+        "val_losses":       val_losses,
+        "train_losses":     train_losses,
+        "val_losses_std":   val_losses_std,
+        "train_losses_std": train_losses_std,
+    }
     return result
 
 
-def xgb_gridsearch(features, outputs,
-                   param_grid,
+def xgb_gridsearch(features=None, outputs=None,
+                   param_grid=None,
                    nfold=10,
                    loss_fn="LSE",
                    lr=0.1,
@@ -419,57 +528,486 @@ def xgb_gridsearch(features, outputs,
                    booster="gbtree",
                    subsample=1,
                    max_depth=3,
+                   dart_params=None,
                    gpu=False,
                    n_jobs=4,
+                   tree_method="hist",
+                   max_bin=256,
+                   use_saved=False,
+                   save_path=None,
+                   seed=None,
                    verbose=True):
     """Conducts K-fold CV for grid search on
     hyperparameters of XGBoost.
-    NOTE) This does NOT support `--use-saved' option
-    and ONLY supports passing in data as np.arrays
-    or sparse arrays. Hence, this may suffer from
-    memory issues depending on input size. Consider
-    implementing np.array version of `save_dmatrix`
-    function in `baseline_utils.py`.
+    The folds are sliced once out of a single DMatrix and
+    shared by all the candidates. The (candidate, fold) fits
+    run on `os.cpu_count() // n_jobs` threads, each training
+    with `n_jobs` XGBoost threads, so that the cores are not
+    oversubscribed. Every fit stops early once its validation
+    loss has not improved for 10 iterations.
     Refer to `xgboost` for parameters not described below.
 
     :features, outputs: The FULL dataset
     :nfold: Number of splits for K-fold CV
     :param_grid: Dictionary where each entry is
         - key: Name of parameter
-               (refer to 'xgb.XGBRegressor' for details)
+               (refer to 'xgb.XGBRegressor' for details;
+               `n_estimators` sets the number of iterations)
         - value: A list or 1-D array of values to try
-    :returns: A dictionary containing collected statistics.
-        Refer to 'sklearn.model_selection.GridSearchCV' doc
-        for details.
+    :n_jobs: Number of XGBoost threads per fit
+    :seed: Seed for splitting the folds
+    :returns: A dictionary containing collected statistics,
+        in the format of `cv_results_` of
+        'sklearn.model_selection.GridSearchCV' (scores are
+        negated MSEs), with the mean number of iterations
+        until the best validation loss in "mean_best_iteration"
     """
-    loss = {"LSE": "neg_mean_squared_error"}[loss_fn]
+    loss = {"LSE": "rmse"}[loss_fn]
     objective = {"LSE": "reg:squarederror"}[loss_fn]
 
+    if not use_saved:
+        assert features is not None and outputs is not None, \
+            "ERROR: Please provide `features` or `outputs`."
+        dtrain = xgb.DMatrix(features, label=outputs)
+    else:
+        assert save_path is not None, \
+            "ERROR: Need to provide 'save_path'."
+        # Folds need to be sliced out of a regular DMatrix
+        dtrain = load_dmatrix(save_path + ".train")
+
+    kfold = KFold(n_splits=nfold, shuffle=True, random_state=seed)
+    folds = [(dtrain.slice(train_idx), dtrain.slice(test_idx))
+             for train_idx, test_idx in kfold.split(np.arange(dtrain.num_row()))]
+    # A DMatrix caches its quantiles while training, so
+    # each fold is only used by one fit at a time
+    fold_locks = [Lock() for _ in folds]
+
     params = {
-        "n_estimators": num_trees,
+        "tree_method": "gpu_hist" if gpu else tree_method,
+        "max_bin": max_bin,
+        "booster": booster,
         "objective": objective,
         "learning_rate": lr,
-        "verbosity": 2 if verbose else 1,
-        "tree_method": "gpu_hist" if gpu else "approx",
-        "booster": booster,
+        "verbosity": 1,
         "subsample": subsample,
         "max_depth": max_depth,
+        "eval_metric": loss,
     }
     if not gpu:
-        params['n_jobs'] = n_jobs
+        params["nthread"] = n_jobs
+    if booster == "dart":
+        assert dart_params is not None, \
+            "ERROR: Please provide DART-related parameters"
+        params["rate_drop"] = dart_params["rate_drop"]
+        params["sample_type"] = dart_params["sample_type"]
+        params["normalize_type"] = dart_params["normalize_type"]
+
+    candidates = list(ParameterGrid(param_grid))
+
+    def fit(candidate_idx, fold_idx):
+        trial_params = dict(params, **candidates[candidate_idx])
+        num_boost_round = trial_params.pop("n_estimators", num_trees)
+        fold_train, fold_test = folds[fold_idx]
+        evals_result = {}
+        with fold_locks[fold_idx]:
+            start_time = time()
+            xgb.train(trial_params,
+                      dtrain=fold_train,
+                      num_boost_round=num_boost_round,
+                      evals=[(fold_train,"train"),(fold_test,"test")],
+                      verbose_eval=False,
+                      evals_result=evals_result,
+                      early_stopping_rounds=10,
+                     )
+            fit_time = time() - start_time
+        best_iteration = int(np.argmin(evals_result["test"][loss]))
+        if verbose:
+            print(f">>> candidate {candidate_idx}, fold {fold_idx}: "
+                  f"{candidates[candidate_idx]}, "
+                  f"best iteration: {best_iteration}, "
+                  f"test {loss}: {evals_result['test'][loss][best_iteration]:.4f}")
+        return (evals_result["train"][loss][best_iteration],
+                evals_result["test"][loss][best_iteration],
+                best_iteration, fit_time)
+
+    # GPU fits can't share the device, so run them one at a time
+    n_parallel = 1 if gpu else max(1, (os.cpu_count() or 1) // n_jobs)
+    # Consecutive jobs use different folds, so parallel fits rarely wait
+    jobs = [(candidate_idx, fold_idx)
+            for candidate_idx in range(len(candidates))
+            for fold_idx in range(len(folds))]
+    with ThreadPoolExecutor(max_workers=n_parallel) as executor:
+        fits = list(executor.map(lambda job: fit(*job), jobs))
+    fits = np.array(fits).reshape(len(candidates), len(folds), 4)
+
+    train_scores = -fits[:, :, 0] ** 2
+    test_scores = -fits[:, :, 1] ** 2
+    result = {
+        "params": candidates,
+        "mean_fit_time": fits[:, :, 3].mean(axis=1),
+        "std_fit_time": fits[:, :, 3].std(axis=1),
+        "mean_test_score": test_scores.mean(axis=1),
+        "std_test_score": test_scores.std(axis=1),
+        "mean_train_score": train_scores.mean(axis=1),
+        "std_train_score": train_scores.std(axis=1),
+        "mean_best_iteration": fits[:, :, 2].mean(axis=1),
+    }
+    for name in param_grid:
+        result[f"param_{name}"] = np.array([candidate[name] for candidate in candidates])
+    for fold_idx in range(len(folds)):
+        result[f"split{fold_idx}_test_score"] = test_scores[:, fold_idx]
+        result[f"split{fold_idx}_train_score"] = train_scores[:, fold_idx]
+    result["rank_test_score"] = \
+        np.argsort(np.argsort(-result["mean_test_score"])) + 1
 
-    model = xgb.XGBRegressor(**params)
+    return result
 
-    kfold = StratifiedKFold(n_splits=nfold, shuffle=True)
-    grid_search = GridSearchCV(model, param_grid,
-                               scoring=loss,
-                               n_jobs=-1,
-                               cv=kfold,
-                               verbose=2 if verbose else 1,
-                               return_train_score=True)
-    search = grid_search.fit(features, outputs)
 
-    return search.cv_results_
+# Grid parameter name -> (`xgb_cv` argument, `args` attribute)
+SH_PARAMS = {
+    "subsample":     ("subsample", "subsample_rate"),
+    "learning_rate": ("lr", "learning_rate"),
+    "max_depth":     ("max_depth", "max_depth"),
+    "n_estimators":  ("num_trees", "num_trees"),
+}
+
+
+def xgb_successive_halving(conn, data_params,
+                           param_grid,
+                           min_size=10000,
+                           eta=3,
+                           nfold=10,
+                           seed=None,
+                           log_args=None,
+                           verbose=True,
+                           **xgb_params):
+    """Conducts successive halving over the hyperparameters
+    of XGBoost. Every candidate is first cross-validated on a
+    small random subset of the data, and only the best 1/eta
+    of them are promoted to a subset eta times larger, until
+    the full budget (the dataset described by `data_params`)
+    is reached or a single candidate is left.
+    Refer to `xgb_cv` for parameters not described below.
+
+    :conn: Connection object to the database
+    :data_params: Keyword arguments of `extract_features` giving
+                  the full dataset
+    :param_grid: Dictionary where each entry is
+        - key: Name of parameter, one of `SH_PARAMS`
+        - value: A list or 1-D array of values to try
+    :min_size: Size of the random subset of the first round
+    :eta: Ratio of candidates dropped and of subset size
+          increase between rounds
+    :log_args: If not None, the Argparse object used to log
+               every evaluation with `write_log`
+    :xgb_params: Remaining arguments of `xgb_cv`
+    :returns: A dictionary containing the following:
+        - "rounds":      For each round, a dictionary of the subset
+                         "size", the candidate "params" and their
+                         final "val_loss"
+        - "best_params": The best candidate of the last round
+        - "val_loss":    Its final validation loss
+    """
+    for name in param_grid:
+        assert name in SH_PARAMS, \
+            f"ERROR: '{name}' is not supported, use one of {list(SH_PARAMS)}"
+
+    candidates = [{name: value.item() if isinstance(value, np.generic) else value
+                   for name, value in candidate.items()}
+                  for candidate in ParameterGrid(param_grid)]
+    max_size = data_params["size"] if data_params["variant"] == "random" else None
+    size = min_size
+    rounds = []
+    while True:
+        last_round = len(candidates) == 1 or \
+                     (max_size is not None and size >= max_size)
+        if last_round:
+            round_data_params = data_params
+        else:
+            round_data_params = dict(data_params, variant="random", size=size)
+        features, outputs = extract_features(conn, **round_data_params)
+        num_rows = outputs.shape[0]
+
+        val_losses = []
+        for candidate in candidates:
+            cv_params = dict(xgb_params, **{SH_PARAMS[name][0]: value
+                                            for name, value in candidate.items()})
+            result = xgb_cv(features, outputs,
+                            nfold=nfold,
+                            seed=seed,
+                            verbose=False,
+                            **cv_params)
+            val_losses.append(result["val_loss"])
+            if verbose:
+                print(f">>> size: {num_rows:10d}, {candidate}, "
+                      f"val_loss: {result['val_loss']:.4f}")
+            if log_args is not None:
+                cand_args = argparse.Namespace(**vars(log_args))
+                cand_args.rand_subset = num_rows
+                for name, value in candidate.items():
+                    setattr(cand_args, SH_PARAMS[name][1], value)
+                write_log(args=cand_args, stats=result)
+
+        rounds.append({"size": num_rows, "params": candidates, "val_loss": val_losses})
+        order = np.argsort(val_losses)
+        if last_round:
+            break
+        candidates = [candidates[idx] for idx in
+                      order[:max(1, int(np.ceil(len(candidates) / eta)))]]
+        size *= eta
+
+    return {
+        "rounds":      rounds,
+        "best_params": candidates[order[0]],
+        "val_loss":    val_losses[order[0]],
+    }
+
+
+def xgb_tree_method_benchmark(features, outputs,
+                              sizes,
+                              tree_methods=("approx", "hist"),
+                              loss_fn="LSE",
+                              lr=0.1,
+                              num_trees=100,
+                              booster="gbtree",
+                              subsample=1,
+                              max_depth=3,
+                              max_bin=256,
+                              n_jobs=4,
+                              verbose=True):
+    """Compares the wall time and final validation loss of
+    XGBoost tree construction methods, training on random
+    subsets of increasing sizes and validating on a common
+    holdout split from the given dataset.
+    Refer to `xgboost` for parameters not described below.
+
+    :features, outputs: The FULL dataset
+    :sizes: List of training set sizes to benchmark on
+            (capped at the size of the training split)
+    :tree_methods: Tree construction methods to compare
+    :returns: A dictionary of equally long lists, with one
+        entry per (size, tree method) combination:
+        - "size":       The number of training rows
+        - "tree_method":The tree construction method
+        - "train_time": Wall time of training in seconds
+        - "val_loss":   The final validation loss
+    """
+    loss = {"LSE": "rmse"}[loss_fn]
+    objective = {"LSE": "reg:squarederror"}[loss_fn]
+
+    f_train, f_val, o_train, o_val = \
+        train_test_split(features, outputs,
+                         test_size=0.1,
+                         shuffle=True,
+                         random_state=10701)
+    dval = xgb.DMatrix(f_val, label=o_val)
+    permutation = np.random.RandomState(10701).permutation(o_train.shape[0])
+
+    result = {"size": [], "tree_method": [], "train_time": [], "val_loss": []}
+    for size in sizes:
+        indices = permutation[:size]
+        dtrain = xgb.DMatrix(f_train[indices], label=o_train[indices])
+
+        for tree_method in tree_methods:
+            params = {
+                "tree_method": tree_method,
+                "max_bin": max_bin,
+                "booster": booster,
+                "objective": objective,
+                "learning_rate": lr,
+                "verbosity": 1,
+                "subsample": subsample,
+                "max_depth": max_depth,
+                "eval_metric": loss,
+                "nthread": n_jobs,
+            }
+            evals_result = {}
+            start_time = time()
+            xgb.train(params,
+                      dtrain=dtrain,
+                      num_boost_round=num_trees,
+                      evals=[(dval, "validation")],
+                      verbose_eval=False,
+                      evals_result=evals_result,
+                     )
+            train_time = time() - start_time
+
+            result["size"].append(indices.shape[0])
+            result["tree_method"].append(tree_method)
+            result["train_time"].append(train_time)
+            result["val_loss"].append(evals_result["validation"][loss][-1])
+            if verbose:
+                print(f">>> size: {indices.shape[0]:10d}, "
+                      f"tree_method: {tree_method:>6}, "
+                      f"train_time: {train_time:10.2f} seconds, "
+                      f"val_loss: {result['val_loss'][-1]:.4f}")
+
+    return result
+
+
+def xgb_external_memory(blocks,
+                        cache_prefix,
+                        test_size=0.1,
+                        seed=10701,
+                        loss_fn="LSE",
+                        lr=0.1,
+                        num_trees=100,
+                        booster="gbtree",
+                        subsample=1,
+                        max_depth=3,
+                        dart_params=None,
+                        n_jobs=4,
+                        tree_method="hist",
+                        max_bin=256,
+                        verbose=True):
+    """Trains an XGBoost GBRT on a dataset streamed from the
+    database block by block, using XGBoost's external memory
+    mode so that the dataset never has to fit in memory,
+    and validates it with a holdout split from the same stream.
+    Refer to `xgboost` for parameters not described below.
+
+    :blocks: Iterable of (features, outputs) blocks, e.g. the
+        generator of `extract_features(variant='stream')`, which is
+        read once
+    :cache_prefix: Path prefix of the external memory cache files
+    :test_size: Proportion of rows held out for validation
+    :seed: Seed of the train/validation split
+    :tree_method: Tree construction algorithm ("approx" or "hist",
+        "exact" does not support external memory)
+    :returns: The same as `xgboost`
+    """
+    assert tree_method != "exact", \
+        "ERROR: 'exact' tree method does not support external memory"
+    loss = {"LSE": "rmse"}[loss_fn]
+    objective = {"LSE": "reg:squarederror"}[loss_fn]
+
+    params = {
+        "tree_method": tree_method,
+        "max_bin": max_bin,
+        "booster": booster,
+        "objective": objective,
+        "learning_rate": lr,
+        "verbosity": 2 if verbose else 1,
+        "subsample": subsample,
+        "max_depth": max_depth,
+        "eval_metric": loss,
+        "nthread": n_jobs,
+    }
+    if booster == "dart":
+        assert dart_params is not None, \
+            "ERROR: Please provide DART-related parameters"
+        params['rate_drop'] = dart_params['rate_drop']
+        params['sample_type'] = dart_params['sample_type']
+        params['normalize_type'] = dart_params['normalize_type']
+
+    dtrain, dval = external_memory_dmatrices(blocks, cache_prefix,
+                                             test_size=test_size, seed=seed)
+    if verbose:
+        print(">>> External memory DMatrices ready, "
+              f"train rows: {dtrain.num_row()}, val rows: {dval.num_row()}")
+    watchlist = [(dtrain,"train"),(dval,"validation")]
+    evals_result = {}
+
+    model = xgb.train(params,
+                      dtrain=dtrain,
+                      num_boost_round=num_trees,
+                      evals=watchlist,
+                      verbose_eval=verbose,
+                      evals_result=evals_result,
+                      early_stopping_rounds=10,
+                     )
+    remove_block_cache(cache_prefix)
+
+    train_losses = evals_result["train"][loss]
+    val_losses   = evals_result["validation"][loss]
+
+    if verbose:
+        print(">>> Model training complete")
+    result = {
+        "val_loss":     val_losses[-1],
+        "val_losses":   val_losses,
+        "train_losses": train_losses,
+    }
+    return result, model
+
+
+def xgb_continue(features, outputs,
+                 model_path,
+                 refresh_leaves=False,
+                 loss_fn="LSE",
+                 lr=0.1,
+                 num_trees=100,
+                 subsample=1,
+                 max_depth=3,
+                 n_jobs=4,
+                 tree_method="hist",
+                 max_bin=256,
+                 verbose=True):
+    """Continues training a saved XGBoost model on new data only,
+    validating it with a holdout split from the new data.
+    Refer to `xgboost` for parameters not described below.
+
+    :features, outputs: The new dataset
+    :model_path: Path to the saved model to continue from
+    :refresh_leaves: If True, keeps the structure of the existing
+        trees and only refreshes their leaf values on the new data
+        (`process_type=update`), else adds `num_trees` new trees
+    :returns: The same as `xgboost`
+    """
+    loss = {"LSE": "rmse"}[loss_fn]
+    objective = {"LSE": "reg:squarederror"}[loss_fn]
+
+    f_train, f_val, o_train, o_val = \
+        train_test_split(features, outputs,
+                         test_size=0.1,
+                         shuffle=True,
+                         random_state=10701)
+    dtrain = xgb.DMatrix(f_train, label=o_train)
+    dval = xgb.DMatrix(f_val, label=o_val)
+
+    booster = xgb.Booster(model_file=model_path)
+    params = {
+        "tree_method": tree_method,
+        "max_bin": max_bin,
+        "objective": objective,
+        "learning_rate": lr,
+        "verbosity": 2 if verbose else 1,
+        "subsample": subsample,
+        "max_depth": max_depth,
+        "eval_metric": loss,
+        "nthread": n_jobs,
+    }
+    if refresh_leaves:
+        params["process_type"] = "update"
+        params["updater"] = "refresh"
+        params["refresh_leaf"] = True
+        # Every existing tree gets updated once
+        num_trees = len(booster.get_dump())
+
+    watchlist = [(dtrain,"train"),(dval,"validation")]
+    evals_result = {}
+
+    model = xgb.train(params,
+                      dtrain=dtrain,
+                      num_boost_round=num_trees,
+                      evals=watchlist,
+                      verbose_eval=verbose,
+                      evals_result=evals_result,
+                      early_stopping_rounds=None if refresh_leaves else 10,
+                      xgb_model=booster,
+                     )
+
+    train_losses = evals_result["train"][loss]
+    val_losses   = evals_result["validation"][loss]
+
+    if verbose:
+        print(">>> Model training complete")
+    result = {
+        "val_loss":     val_losses[-1],
+        "val_losses":   val_losses,
+        "train_losses": train_losses,
+    }
+    return result, model
 
 
 def xgb_load_and_predict(model_path, dmat_path, loss_fn="MSE"):
@@ -488,12 +1026,34 @@ def xgb_load_and_predict(model_path, dmat_path, loss_fn="MSE"):
     loss = {"MSE": lambda y,fx: np.sqrt(mean_squared_error(y,fx))}[loss_fn]
 
     model = xgb.Booster(model_file=model_path)
-    val_data = xgb.DMatrix(dmat_path + ".val")
+    val_data = load_dmatrix(dmat_path + ".val")
     predictions = model.predict(val_data)
     targets = val_data.get_label()
     return loss(targets,predictions)
 
 
+def get_data_params(args):
+    """Builds the keyword arguments of `extract_features`
+    for the dataset configured by `args`
+
+    :args: Argparse parsed object
+    :returns: Dictionary of `extract_features` arguments
+    """
+    return {
+        "table_name":"rides",
+        "variant":"random" if args.rand_subset > 0 else "all",
+        "size":args.rand_subset,
+        "datetime_onehot":args.datetime_one_hot,
+        "weekdays_onehot":args.weekdays_one_hot,
+        "include_loc_ids":args.loc_id,
+        "start_super_boro":SUPERBORO_CODE[args.start_sb],
+        "end_super_boro":SUPERBORO_CODE[args.end_sb] \
+                if args.end_sb > 0 \
+                else SUPERBORO_CODE[args.start_sb],
+        "stddev_multiplier":args.stddev_mul,
+    }
+
+
 def main():
     parsed_args = parser.parse_args()
 
@@ -509,25 +1069,35 @@ def main():
     # Set `--use-saved` automatically if `--save-path` has been given
     parsed_args.use_saved = (parsed_args.save_path is not None)
 
+    # Rides seen by the trained model, recorded with it when saved
+    seen = None
+    if parsed_args.continue_model is not None:
+        assert parsed_args.model == "xgboost" and not parsed_args.use_saved \
+            and parsed_args.rand_subset == 0, \
+            "ERROR: `--continue-model` is only supported by 'xgboost' " \
+            "trained on the whole dataset from the database"
+        continue_path = os.path.join(parsed_args.models_dir,
+                                     parsed_args.continue_model)
+        prev_watermark = get_model_watermark(continue_path)
+        assert prev_watermark is not None, \
+            f"ERROR: no watermark recorded in {continue_path}"
+        create_pickup_index(conn, "rides")
+
     if not parsed_args.use_saved:
-        data_params = {
-            "table_name":"rides",
-            "variant":"random" if parsed_args.rand_subset > 0 else "all",
-            "size":parsed_args.rand_subset,
-            "datetime_onehot":parsed_args.datetime_one_hot,
-            "weekdays_onehot":parsed_args.weekdays_one_hot,
-            "include_loc_ids":parsed_args.loc_id,
-            "start_super_boro":SUPERBORO_CODE[parsed_args.start_sb],
-            "end_super_boro":SUPERBORO_CODE[parsed_args.end_sb] \
-                    if parsed_args.end_sb > 0 \
-                    else SUPERBORO_CODE[parsed_args.start_sb],
-            "stddev_multiplier":parsed_args.stddev_mul,
-        }
+        data_params = get_data_params(parsed_args)
+        if parsed_args.continue_model is not None:
+            data_params["after_datetime"] = prev_watermark
         if parsed_args.verbose:
             start_time = time()
 
-        features, outputs = \
-            extract_features(conn, **data_params)
+        # A random subset leaves rides before any watermark unseen
+        if parsed_args.save_model and data_params["variant"] == "all":
+            seen = {}
+            data_params["seen"] = seen
+        # `xgb_sh` and `xgb_extmem` read the data themselves
+        if parsed_args.model not in ["xgb_sh", "xgb_extmem"]:
+            features, outputs = \
+                extract_features(conn, **data_params)
     else:
         # Parse dataset configurations from stored name
         parsed_args = parse_dmat_name(parsed_args)
@@ -545,12 +1115,14 @@ def main():
          "max_depth":parsed_args.max_depth,
          "subsample":parsed_args.subsample_rate,
          "gpu":parsed_args.gpu,
+         "tree_method":parsed_args.tree_method,
+         "max_bin":parsed_args.max_bin,
          "dart_params":dart_params,
          "verbose":parsed_args.verbose,
     }
 
-    # `xgb_gs` doesn't support `--use-saved`; see docs
-    if parsed_args.model != "xgb_gs":
+    # `xgb_sh`, `xgb_bench` and `xgb_extmem` don't support `--use-saved`; see docs
+    if parsed_args.model not in ["xgb_sh", "xgb_bench", "xgb_extmem"]:
          xgb_params["use_saved"] = parsed_args.use_saved
          xgb_params["save_path"] = parsed_args.save_path
 
@@ -563,13 +1135,31 @@ def main():
             print(">>> Data parsing complete, "
                   f"duration: {data_parsed_time - start_time} seconds")
         xgb_params["n_jobs"] = parsed_args.xgb_num_thread
-        result, model = xgboost(features if not parsed_args.use_saved else None,
-                                outputs  if not parsed_args.use_saved else None,
-                                **xgb_params,
-                               )
+        if parsed_args.continue_model is not None:
+            if features is None:
+                print(f">>> No new rides after {prev_watermark}")
+                conn.close()
+                return
+            result, model = xgb_continue(features, outputs,
+                                         continue_path,
+                                         refresh_leaves=parsed_args.refresh_leaves,
+                                         lr=parsed_args.learning_rate,
+                                         num_trees=parsed_args.num_trees,
+                                         subsample=parsed_args.subsample_rate,
+                                         max_depth=parsed_args.max_depth,
+                                         n_jobs=parsed_args.xgb_num_thread,
+                                         tree_method=parsed_args.tree_method,
+                                         max_bin=parsed_args.max_bin,
+                                         verbose=parsed_args.verbose,
+                                        )
+        else:
+            result, model = xgboost(features if not parsed_args.use_saved else None,
+                                    outputs  if not parsed_args.use_saved else None,
+                                    **xgb_params,
+                                   )
 
     elif parsed_args.model == "xgb_gs":
-        if parsed_args.verbose:
+        if not parsed_args.use_saved and parsed_args.verbose:
             data_parsed_time = time()
             print(">>> Data parsing complete, "
                   f"duration: {data_parsed_time - start_time} seconds")
@@ -577,9 +1167,12 @@ def main():
         # Set up parameter values to do grid-search over here
         param_grid = {"subsample": np.linspace(0.1,1,10)}
 
-        result = xgb_gridsearch(features, outputs,
+        result = xgb_gridsearch(features if not parsed_args.use_saved else None,
+                                outputs  if not parsed_args.use_saved else None,
                                 param_grid=param_grid,
                                 nfold=parsed_args.nfold,
+                                n_jobs=parsed_args.xgb_num_thread,
+                                seed=10701,
                                 **xgb_params,)
         if parsed_args.verbose:
             print(result)
@@ -596,6 +1189,86 @@ def main():
         conn.close()
         return
 
+    elif parsed_args.model == "xgb_sh":
+        assert not parsed_args.use_saved, \
+            "ERROR: 'xgb_sh' samples from the database, " \
+            "'--save-path' is not supported"
+
+        # Set up parameter values to search over here
+        param_grid = {"subsample": np.linspace(0.1,1,10)}
+
+        del xgb_params["verbose"]
+        result = xgb_successive_halving(conn, data_params,
+                                        param_grid=param_grid,
+                                        min_size=parsed_args.sh_min_size,
+                                        eta=parsed_args.sh_eta,
+                                        nfold=parsed_args.nfold,
+                                        seed=10701,
+                                        log_args=parsed_args if parsed_args.log else None,
+                                        verbose=True,
+                                        **xgb_params,)
+        print(f">>> Best parameters: {result['best_params']}, "
+              f"val_loss: {result['val_loss']:.4f}")
+
+        # Stored as file for analysis, similarly to `xgb_gs`
+        np.save("./sh_result.npy", result)
+        conn.close()
+        return
+
+    elif parsed_args.model == "xgb_bench":
+        assert not parsed_args.use_saved, \
+            "ERROR: 'xgb_bench' times training on extracted features, " \
+            "'--save-path' is not supported"
+
+        if parsed_args.verbose:
+            data_parsed_time = time()
+            print(">>> Data parsing complete, "
+                  f"duration: {data_parsed_time - start_time} seconds")
+
+        result = xgb_tree_method_benchmark(
+                    features, outputs,
+                    sizes=[int(size) for size in parsed_args.bench_sizes.split(",")],
+                    lr=parsed_args.learning_rate,
+                    num_trees=parsed_args.num_trees,
+                    booster=parsed_args.booster,
+                    subsample=parsed_args.subsample_rate,
+                    max_depth=parsed_args.max_depth,
+                    max_bin=parsed_args.max_bin,
+                    n_jobs=parsed_args.xgb_num_thread,
+                    verbose=True,
+                 )
+
+        # Stored as file for analysis, similarly to `xgb_gs`
+        np.save("./bench_result.npy", result)
+        conn.close()
+        return
+
+    elif parsed_args.model == "xgb_extmem":
+        assert not parsed_args.use_saved, \
+            "ERROR: 'xgb_extmem' streams from the database, " \
+            "'--save-path' is not supported"
+        assert parsed_args.rand_subset == 0, \
+            "ERROR: 'xgb_extmem' streams the whole table, " \
+            "'--rand-subset' is not supported"
+        data_params["variant"] = "stream"
+        data_params["block_size"] = parsed_args.batch_size \
+            if parsed_args.batch_size > 0 else int(1e6)
+        os.makedirs(parsed_args.cache_dir, exist_ok=True)
+        cache_prefix = os.path.join(parsed_args.cache_dir,
+                                    get_dmat_name(parsed_args, seed=10701))
+        xgb_params["n_jobs"] = parsed_args.xgb_num_thread
+        del xgb_params["gpu"]
+        result, model = xgb_external_memory(
+                            extract_features(conn, **data_params),
+                            cache_prefix,
+                            test_size=parsed_args.test_size,
+                            seed=10701,
+                            **xgb_params,
+                        )
+        if parsed_args.verbose:
+            print(">>> Training complete, "
+                  f"duration: {time() - start_time} seconds")
+
     elif parsed_args.model == "xgb_cv":
         if not parsed_args.use_saved and parsed_args.verbose:
             data_parsed_time = time()
@@ -620,9 +1293,11 @@ def main():
         create_plot(result, parsed_args.model)
 
     if parsed_args.save_model:
-        assert parsed_args.model == "xgboost", \
-            "ERROR: only 'xgboost' model can be saved"
-        model_path = xgb_save_model(model, log_time, parsed_args)
+        assert parsed_args.model in ["xgboost", "xgb_extmem"], \
+            "ERROR: only 'xgboost' and 'xgb_extmem' models can be saved"
+        model_path = xgb_save_model(model, log_time, parsed_args,
+                                    watermark=seen.get("watermark")
+                                    if seen is not None else None)
         if parsed_args.verbose:
             print(f">>> Model saved as: {model_path}")
         
@@ -1,11 +1,14 @@
 import numpy as np
+from scipy import sparse
 import xgboost as xgb
-from sklearn.model_selection import train_test_split
+from sklearn.model_selection import train_test_split, KFold
 
 import matplotlib.pyplot as plt
 from datetime import datetime as dt
 from pytz import timezone
 import os
+import glob
+import json
 
 SUPERBORO_CODE = {
     0: None,
@@ -37,23 +40,37 @@ def write_log(args, stats, dirname="logs"):
     :args: Argparse parsed object 
     :stats: dictionary containing training statistics
     :dirname: name of the directory to contain log files
-    :returns: None
+    :returns: The time string the log is named after
     """
 
     curr_time = dt.now().astimezone(timezone("US/Eastern")) \
                         .strftime("%Y-%m-%d-%H-%M-%S")
-    log_addr = os.path.join(create_dir(dirname), f"log_{curr_time}.txt")
-    with open(log_addr, "w") as log:
+    log_dir = create_dir(dirname)
+    # Don't overwrite logs written within the same second,
+    # e.g. by concurrent training jobs
+    log_name, log_idx = curr_time, 0
+    while True:
+        try:
+            log = open(os.path.join(log_dir, f"log_{log_name}.txt"), "x")
+            break
+        except FileExistsError:
+            log_idx += 1
+            log_name = f"{curr_time}_{log_idx}"
+    curr_time = log_name
+    with log:
         log.write(f"model: {args.model}, num_trees: {args.num_trees}, "
                   f"max_depth: {args.max_depth}, "
-                  f"booster: {args.booster}\n")
+                  f"booster: {args.booster}, "
+                  f"tree_method: {args.tree_method}, "
+                  f"max_bin: {args.max_bin}\n")
         log.write(f"subsample_rate: {args.subsample_rate}, "
                   f"learning_rate: {args.learning_rate}\n")
         log.write(f"datetime_one_hot: {args.datetime_one_hot}, "
                   f"weekdays_one_hot: {args.weekdays_one_hot}, "
                   f"loc_id: {args.loc_id}, "
                   f"stddev_mul: {args.stddev_mul:.1f}, "
-                  f"test_size: {args.test_size}\n")
+                  f"test_size: {args.test_size}, "
+                  f"rand_subset: {args.rand_subset}\n")
         log.write(f"start_sb: {args.start_sb}, ")
         log.write(f"end_sb: {args.end_sb}")
         log.write("\n\n")
@@ -123,6 +140,28 @@ def create_plot(stats, model_name, save=True):
         plt.show()
 
 
+def get_dmat_name(args, seed=None):
+    """Builds the name of a stored dataset, which encodes
+    the configurations given by `args` (see `save_dmatrix`)
+    and can be parsed back by `parse_dmat_name`
+
+    :args: Argparse object
+    :seed: Seed used for splitting the dataset
+    :returns: The dataset name (without directory or extension)
+    """
+    save_name = "dm"
+    save_name += f"_sb{args.start_sb}"
+    save_name += f"{args.end_sb}" if args.end_sb > 0 \
+                 else f"{args.start_sb}"
+    save_name += f"_sm{args.stddev_mul:.1f}"
+    save_name += f"_test{args.test_size}"
+    save_name += f"_doh{int(args.datetime_one_hot)}"
+    save_name += f"_woh{int(args.weekdays_one_hot)}"
+    save_name += f"_locid{int(args.loc_id)}"
+    save_name += f"_s{seed}" if seed is not None else "_random"
+    return save_name
+
+
 def save_dmatrix(features, outputs, args, seed=None):
     """Save training/validation DMatrices for XGBoost
     under configurations given by `args`.
@@ -131,25 +170,18 @@ def save_dmatrix(features, outputs, args, seed=None):
     - weekdays-one-hot
     - no-loc-id
     - test-size
+    - float32-cache
     The DMatrices are stored in 'data' dir under project
     root, and their names encode the configurations.
+    With `--float32-cache`, the datasets are instead stored
+    as float32 arrays (see `load_dmatrix`).
 
     :features, outputs: Loaded datasets (NumPy arrays)
     :args: Argparse object
     :seed: Seed for randomizing `train_test_split`
     :returns: None
     """
-    # Record configurations in dataset name
-    save_name = "dm"
-    save_name += f"_sb{args.start_sb}"
-    save_name += f"{args.end_sb}" if args.end_sb > 0 \
-                 else f"{args.start_sb}"
-    save_name += f"_sm{args.stddev_mul:.1f}"
-    save_name += f"_test{args.test_size}"
-    save_name += f"_doh{int(args.datetime_one_hot)}"
-    save_name += f"_woh{int(args.weekdays_one_hot)}"
-    save_name += f"_locid{int(args.loc_id)}"
-    save_name += f"_s{seed}" if seed is not None else "_random"
+    save_name = get_dmat_name(args, seed)
 
     data_dirpath = create_dir("data")
     train_path = os.path.join(data_dirpath, save_name + '.train')
@@ -165,6 +197,14 @@ def save_dmatrix(features, outputs, args, seed=None):
     else:
         f_train, o_train = features, outputs
 
+    if args.float32_cache:
+        save_float32_cache(f_train, o_train, train_path)
+        if args.test_size > 0:
+            save_float32_cache(f_val, o_val, val_path)
+        if args.verbose:
+            print(">>> Float32 cache saved to disk")
+        return
+
     # Store DMatrices
     dtrain = xgb.DMatrix(f_train, label=o_train)
     if args.test_size > 0:
@@ -177,6 +217,245 @@ def save_dmatrix(features, outputs, args, seed=None):
     if args.verbose:
         print(">>> DMatrices saved to disk")
 
+def save_float32_cache(features, outputs, path):
+    """Store a dataset as float32 arrays for `load_dmatrix`, half
+    the size of float64 ones. The features are not binned: XGBoost
+    can not save a binned `xgb.QuantileDMatrix`, so `load_dmatrix`
+    bins them again on every load
+
+    :features, outputs: The dataset (NumPy or sparse arrays)
+    :path: Path of the dataset, EXCLUDING the cache extensions
+    :returns: None
+    """
+    if sparse.issparse(features):
+        sparse.save_npz(path + ".features.npz",
+                        features.astype(np.float32).tocsr())
+    else:
+        np.save(path + ".features.npy", features.astype(np.float32))
+    np.save(path + ".labels.npy", outputs.astype(np.float32))
+
+
+def load_float32_cache(path):
+    """Load a dataset stored by `save_float32_cache`
+
+    :path: Path of the dataset, EXCLUDING the cache extensions
+    :returns: The (features, outputs) arrays
+    """
+    if os.path.exists(path + ".features.npz"):
+        features = sparse.load_npz(path + ".features.npz")
+    else:
+        features = np.load(path + ".features.npy")
+    return features, np.load(path + ".labels.npy")
+
+
+def load_dmatrix(path, max_bin=None, ref=None):
+    """Load a dataset stored by `save_dmatrix`.
+    If it has been stored with `--float32-cache`, `max_bin` is
+    given and the installed XGBoost supports it, the dataset is
+    loaded as an `xgb.QuantileDMatrix`. Its quantiles are sketched
+    and the features binned on every load, after which only the
+    bin indices are kept in memory.
+
+    :path: Path of the dataset, e.g. '{save_path}.train'
+    :max_bin: Maximum number of bins per feature, which has to
+        match the one used for training. `None` loads the
+        dataset as a regular `xgb.DMatrix`
+    :ref: The training `xgb.QuantileDMatrix`, whose bins are
+        reused when loading a validation dataset
+    :returns: `xgb.QuantileDMatrix` or `xgb.DMatrix`
+    """
+    if os.path.exists(path + ".labels.npy"):
+        features, outputs = load_float32_cache(path)
+        if max_bin is not None and hasattr(xgb, "QuantileDMatrix"):
+            return xgb.QuantileDMatrix(features, label=outputs,
+                                       max_bin=max_bin, ref=ref)
+        return xgb.DMatrix(features, label=outputs)
+    return xgb.DMatrix(path)
+
+
+def get_dataset_fingerprint(path):
+    """Identifies the stored version of a dataset by the size and
+    modification time of its files, e.g. to notice that a dataset
+    has been saved again under the same name
+
+    :path: Path of the dataset, e.g. '{save_path}.train'
+    :returns: np.array of the (size, mtime) of each existing file
+    """
+    return np.array([(os.stat(file_path).st_size, os.stat(file_path).st_mtime_ns)
+                     for file_path in (path, path + ".labels.npy",
+                                       path + ".features.npz", path + ".features.npy")
+                     if os.path.exists(file_path)], dtype=np.int64)
+
+
+def load_cv_folds(save_path, nfold, seed=None, verbose=False):
+    """Load the K-fold CV splits of a dataset stored by
+    `save_dmatrix`, building and caching them next to it
+    on first use. The fold index arrays are stored in
+    '{save_path}.cv{nfold}_s{seed}.folds.npz' and the fold
+    DMatrices in '{save_path}.cv{nfold}_s{seed}.fold{k}.train/.test',
+    so later runs with the same dataset and seed skip
+    shuffling and slicing the full dataset. The folds are rebuilt
+    if the dataset has been saved again since (see
+    `get_dataset_fingerprint`).
+
+    :save_path: The path to the stored dataset (EXCLUDING the suffix)
+    :nfold: Number of folds
+    :seed: Seed for shuffling the rows before splitting
+    :verbose: Whether to report if the folds were cached
+    :returns: List of (train, test) `xgb.DMatrix` pairs, one per fold
+    """
+    fold_prefix = f"{save_path}.cv{nfold}_s{seed}"
+    fold_paths = [(f"{fold_prefix}.fold{k}.train", f"{fold_prefix}.fold{k}.test")
+                  for k in range(nfold)]
+
+    fingerprint = get_dataset_fingerprint(save_path + ".train")
+    cached = os.path.exists(fold_prefix + ".folds.npz") \
+        and all(os.path.exists(path) for paths in fold_paths for path in paths)
+    if cached:
+        with np.load(fold_prefix + ".folds.npz") as cached_folds:
+            cached = "fingerprint" in cached_folds \
+                and np.array_equal(cached_folds["fingerprint"], fingerprint)
+        if not cached and verbose:
+            print(f">>> Rebuilding the folds of {fold_prefix}, "
+                  f"as the dataset has been saved again")
+
+    if cached:
+        if verbose:
+            print(f">>> Loading cached folds from {fold_prefix}")
+        return [(xgb.DMatrix(train_path), xgb.DMatrix(test_path))
+                for train_path, test_path in fold_paths]
+
+    dtrain = load_dmatrix(save_path + ".train")
+    kfold = KFold(n_splits=nfold, shuffle=True, random_state=seed)
+    splits = list(kfold.split(np.arange(dtrain.num_row())))
+    folds = []
+    for (train_idx, test_idx), (train_path, test_path) in zip(splits, fold_paths):
+        fold_train, fold_test = dtrain.slice(train_idx), dtrain.slice(test_idx)
+        fold_train.save_binary(train_path)
+        fold_test.save_binary(test_path)
+        folds.append((fold_train, fold_test))
+    # Written last, so that an interrupted caching is rebuilt
+    np.savez(fold_prefix + ".folds.npz", fingerprint=fingerprint,
+             **{f"{split}{k}": idx for k, (train_idx, test_idx) in enumerate(splits)
+                for split, idx in (("train", train_idx), ("test", test_idx))})
+    if verbose:
+        print(f">>> Folds cached as {fold_prefix}")
+    return folds
+
+
+def get_val_mask(num_rows, test_size, seed, block_num):
+    """Deterministically assigns the rows of one block of a
+    streamed dataset to the validation set, so that every
+    pass over the stream yields the same split
+
+    :num_rows: Number of rows in the block
+    :test_size: Proportion of rows to assign to validation
+    :seed: Seed of the split
+    :block_num: Index of the block within the stream
+    :returns: Boolean array, `True` for validation rows
+    """
+    rand = np.random.RandomState([seed, block_num])
+    return rand.random_sample(num_rows) < test_size
+
+
+def split_block_cache(blocks, cache_prefix, test_size=0.1, seed=0):
+    """Splits a stream of dataset blocks into training and
+    validation rows (see `get_val_mask`) in a single pass, and
+    stores both sides block by block (see `save_float32_cache`),
+    so that the stream is only read once however many times
+    XGBoost iterates over the blocks
+
+    :blocks: Iterable of (features, outputs) blocks
+    :cache_prefix: Path prefix of the block files
+    :test_size: Proportion of rows held out for validation
+    :seed: Seed of the split
+    :returns: The paths of the training and the validation blocks
+    """
+    train_paths, val_paths = [], []
+    for block_num, (features, outputs) in enumerate(blocks):
+        val_mask = get_val_mask(outputs.shape[0], test_size, seed, block_num)
+        for mask, paths, split in ((~val_mask, train_paths, "train"),
+                                   (val_mask, val_paths, "val")):
+            if not mask.any():
+                continue
+            path = f"{cache_prefix}.{split}.block{block_num}"
+            save_float32_cache(features[mask], outputs[mask], path)
+            paths.append(path)
+    return train_paths, val_paths
+
+
+def remove_block_cache(cache_prefix):
+    """Deletes the block files stored by `split_block_cache`,
+    once the DMatrices built from them are no longer needed
+
+    :cache_prefix: Path prefix of the block files
+    :returns: None
+    """
+    for path in glob.glob(glob.escape(cache_prefix) + ".*.block*"):
+        os.remove(path)
+
+
+if hasattr(xgb, "DataIter"):
+    class BlockFileIter(xgb.DataIter):
+        """Feeds the blocks stored by `split_block_cache` to
+        XGBoost one by one. XGBoost pages the blocks into the
+        `cache_prefix` files, so the full dataset never has to
+        be held in memory.
+        """
+
+        def __init__(self, paths, cache_prefix=None):
+            """
+            :paths: The paths of the blocks
+            :cache_prefix: Path prefix of the external memory cache
+            """
+            self._paths = paths
+            self._block_num = 0
+            super().__init__(cache_prefix=cache_prefix)
+
+        def reset(self):
+            self._block_num = 0
+
+        def next(self, input_data):
+            if self._block_num == len(self._paths):
+                return False
+            features, outputs = load_float32_cache(self._paths[self._block_num])
+            self._block_num += 1
+            input_data(data=features, label=outputs)
+            return True
+
+
+def external_memory_dmatrices(blocks, cache_prefix,
+                              test_size=0.1, seed=None):
+    """Builds external memory training/validation DMatrices
+    from a stream of dataset blocks, e.g. the one returned by
+    `extract_features(variant='stream')`, which is read once
+    and split by `split_block_cache`, then fed through
+    `BlockFileIter`. Needs an XGBoost that provides `xgb.DataIter`
+    (1.5 or later): the LibSVM files older versions page from
+    drop zero entries, which XGBoost would then treat as missing
+    values, unlike when training from memory.
+
+    :blocks: Iterable of (features, outputs) blocks
+    :cache_prefix: Path prefix of the cache files
+    :test_size: Proportion of rows held out for validation
+    :seed: Seed of the split (see `get_val_mask`)
+    :returns: The training and validation `xgb.DMatrix`
+    """
+    assert hasattr(xgb, "DataIter"), \
+        f"ERROR: external memory training needs XGBoost 1.5 or later " \
+        f"(found {xgb.__version__})"
+    seed = 0 if seed is None else seed
+    train_paths, val_paths = split_block_cache(blocks, cache_prefix,
+                                               test_size=test_size, seed=seed)
+    assert train_paths and val_paths, \
+        "ERROR: the stream holds too few rows to split off a validation set"
+    dtrain = xgb.DMatrix(BlockFileIter(train_paths,
+                                       cache_prefix=cache_prefix + ".train"))
+    dval = xgb.DMatrix(BlockFileIter(val_paths,
+                                     cache_prefix=cache_prefix + ".val"))
+    return dtrain, dval
+
+
 def parse_dmat_name(args):
     """Parses information from the name of the stored
     DMatrix dataset, and updates `args` to contain
@@ -202,7 +481,7 @@ def parse_dmat_name(args):
 
     return args
 
-def xgb_save_model(model, train_time_str, args):
+def xgb_save_model(model, train_time_str, args, watermark=None):
     """Save trained XGBoost model into directory
     specified by `--models-dir` argument
 
@@ -211,8 +490,14 @@ def xgb_save_model(model, train_time_str, args):
         for training the model has been created
         (to allow for matching with training log)
     :args: Argparse ArgumentParser object
+    :watermark: If not None, the latest pickup datetime of the
+        rides the model has been trained on, recorded in the
+        model metadata (see `get_model_watermark`)
     :returns: Path to the saved model
     """
+    if watermark is not None:
+        booster = model.get_booster() if hasattr(model, "get_booster") else model
+        booster.set_attr(pickup_watermark=watermark)
     models_dir = create_dir(args.models_dir)
     model_name = f"sb{args.start_sb}{args.end_sb}_sm{args.stddev_mul:.1f}" \
                  f"_{int(args.datetime_one_hot)}" \
@@ -222,3 +507,51 @@ def xgb_save_model(model, train_time_str, args):
     model_path = os.path.join(models_dir,model_name)
     model.save_model(model_path)
     return model_path
+
+
+def get_model_watermark(model_path):
+    """Reads the watermark recorded by `xgb_save_model`
+    from a saved XGBoost model
+
+    :model_path: Path to the saved model
+    :returns: The latest pickup datetime string of the rides the
+        model has been trained on, or None if not recorded
+    """
+    return xgb.Booster(model_file=model_path).attr("pickup_watermark")
+
+
+def read_model_manifest(path):
+    """Reads the manifest of trained super-borough models
+    written by `train_superboro_models.py`
+
+    :path: Path to the manifest (JSON) file
+    :returns: Dictionary mapping each feature configuration
+        (e.g. '111' for doh, woh and loc_id) to a dictionary
+        mapping each super-borough code (as a string) to the
+        "model_path", "val_loss", "dataset" and "log" of its model.
+        Empty if the manifest doesn't exist yet.
+    """
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r") as manifest_file:
+        return json.load(manifest_file)
+
+
+def update_model_manifest(path, feature_config, superboro, entry):
+    """Records a trained super-borough model in the manifest,
+    replacing the previous model of the same configuration
+
+    :path: Path to the manifest (JSON) file
+    :feature_config: Feature configuration string (see `read_model_manifest`)
+    :superboro: Super-borough code of the model
+    :entry: Dictionary describing the model
+    :returns: The updated manifest
+    """
+    manifest = read_model_manifest(path)
+    manifest.setdefault(feature_config, {})[str(superboro)] = entry
+    # Replace the manifest at once, so readers never see a partial file
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as manifest_file:
+        json.dump(manifest, manifest_file, indent=4, sort_keys=True)
+    os.replace(tmp_path, path)
+    return manifest
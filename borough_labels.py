@@ -6,3 +6,9 @@ BOROUGHS = {
     "Staten Island": 5,
     "EWR": 6
 }
+
+# Pairs of distinct boroughs that share a land border,
+# i.e. trips between them don't need to cross a bridge
+LAND_CONNECTED_BOROUGHS = [
+    ("Brooklyn", "Queens"),
+]
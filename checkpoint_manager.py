@@ -0,0 +1,153 @@
+import os
+import re
+import queue
+import threading
+import numpy as np
+
+
+def get_checkpoint_path(directory, epoch):
+    return os.path.join(directory, f"ckpt-{epoch:04d}.npz")
+
+
+def list_checkpoint_epochs(directory):
+    """
+    :directory: Directory of the checkpoints
+    :returns: Sorted list of the epochs with a checkpoint in it
+    """
+    if not os.path.isdir(directory):
+        return []
+    return sorted(int(match.group(1)) for match in
+                  (re.fullmatch(r"ckpt-(\d+)\.npz", name) for name in os.listdir(directory))
+                  if match is not None)
+
+
+def _keras_model(model):
+    return getattr(model, "model", model)
+
+
+def load_checkpoint(path, models):
+    """Loads the weights of a checkpoint into the models
+
+    :path: Path to the .npz checkpoint
+    :models: Dictionary of name -> Keras model (or object holding it
+        in `.model`), with the names the checkpoint was saved with
+    """
+    with np.load(path) as checkpoint:
+        for name, model in models.items():
+            model = _keras_model(model)
+            model.set_weights([checkpoint[f"{name}:{idx}"]
+                               for idx in range(len(model.weights))])
+
+
+class AsyncCheckpointManager:
+    """Writes the weights of a set of Keras models to
+    '{directory}/ckpt-{epoch:04d}.npz' in a background thread, keeping
+    only the latest `keep_last` of the checkpoints it wrote. Those of
+    others, e.g. of the run hot-started from, are left alone.
+
+    `save` only copies the weights on the calling thread, which keeps
+    the checkpoint consistent while training goes on. The optimizer
+    states are not part of the checkpoints."""
+
+    def __init__(self, directory, models, keep_last=3):
+        """
+        :directory: Directory to store the checkpoints in
+        :models: Dictionary of name -> Keras model, or object
+            holding its Keras model in `.model` (e.g. `BoroModel`)
+        :keep_last: Number of checkpoints to keep (0 keeps all)
+        """
+        self.directory = directory
+        self.models = models
+        self.keep_last = keep_last
+        # Epochs written by this manager, oldest first
+        self.written_epochs = []
+        os.makedirs(directory, exist_ok=True)
+
+        self.queue = queue.Queue()
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def get_path(self, epoch):
+        return get_checkpoint_path(self.directory, epoch)
+
+    def epochs(self):
+        """
+        :returns: Sorted list of the epochs with a checkpoint on disk
+        """
+        return list_checkpoint_epochs(self.directory)
+
+    def latest_epoch(self):
+        """
+        :returns: The latest checkpointed epoch, or None
+        """
+        epochs = self.epochs()
+        return epochs[-1] if epochs else None
+
+    def save(self, epoch):
+        """Queues a checkpoint of the current weights
+
+        :epoch: Epoch the checkpoint is labelled with
+        """
+        self._raise_error()
+        weights = {f"{name}:{idx}": weight
+                   for name, model in self.models.items()
+                   for idx, weight in enumerate(_keras_model(model).get_weights())}
+        self.queue.put((epoch, weights))
+
+    def _run(self):
+        while True:
+            epoch, weights = self.queue.get()
+            try:
+                if epoch is not None:
+                    self._write(epoch, weights)
+            except Exception as error:
+                self.error = error
+            finally:
+                self.queue.task_done()
+            if epoch is None:
+                return
+
+    def _write(self, epoch, weights):
+        path = self.get_path(epoch)
+        # Written under a temporary name, so that an interrupted
+        # write never leaves a truncated checkpoint behind
+        tmp_path = path[:-len(".npz")] + ".tmp.npz"
+        np.savez(tmp_path, **weights)
+        os.replace(tmp_path, path)
+
+        if epoch in self.written_epochs:
+            self.written_epochs.remove(epoch)
+        self.written_epochs.append(epoch)
+        if self.keep_last > 0:
+            while len(self.written_epochs) > self.keep_last:
+                old_path = self.get_path(self.written_epochs.pop(0))
+                if os.path.exists(old_path):
+                    os.remove(old_path)
+
+    def _raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError("ERROR: Writing a checkpoint failed") from error
+
+    def wait(self):
+        """Blocks until all queued checkpoints are written"""
+        self.queue.join()
+        self._raise_error()
+
+    def close(self):
+        """Writes the queued checkpoints and stops the background thread"""
+        self.queue.put((None, None))
+        self.thread.join()
+        self._raise_error()
+
+    def restore(self, epoch=None):
+        """Loads the weights of a checkpoint into the models
+
+        :epoch: Epoch of the checkpoint (default: the latest)
+        :returns: The epoch restored
+        """
+        epoch = self.latest_epoch() if epoch is None else epoch
+        assert epoch is not None, f"ERROR: No checkpoint in {self.directory}"
+        load_checkpoint(self.get_path(epoch), self.models)
+        return epoch
@@ -0,0 +1,116 @@
+import os
+import sys
+import json
+import socket
+import subprocess
+
+import tensorflow as tf
+
+
+def add_distributed_arguments(parser):
+    """Adds the multi-worker arguments to a script's parser
+
+    :parser: argparse.ArgumentParser of the script
+    """
+    parser.add_argument("--workers", type=str, default=None,
+                        help="comma-separated host:port of every worker, for data parallel "
+                             "training with one process per host (default: TF_CONFIG, if set)")
+    parser.add_argument("--worker-index", type=int, default=0,
+                        help="the index of this process in '--workers' (0: the chief)")
+    parser.add_argument("--local-workers", type=int, default=0,
+                        help="run this many workers as processes of this host, "
+                             "communicating over loopback")
+
+
+def get_strategy(workers=None, worker_index=0):
+    """Creates the strategy of data parallel training across the
+    workers, each training a replica of the model on its own shard
+    of the data, with the gradients all-reduced every step. Has to
+    run before TF executes any op.
+
+    :workers: List of the host:port of every worker, where None
+        reads the cluster from TF_CONFIG, if set
+    :worker_index: Index of this process in `workers`
+    :returns: A MultiWorkerMirroredStrategy, or the default
+        strategy when training on a single host
+    """
+    if workers:
+        os.environ["TF_CONFIG"] = json.dumps({
+            "cluster": {"worker": workers},
+            "task":    {"type": "worker", "index": worker_index}
+        })
+    elif "TF_CONFIG" not in os.environ:
+        return tf.distribute.get_strategy()
+
+    # Ring all-reduces over gRPC, as the workers are CPU hosts
+    options = tf.distribute.experimental.CommunicationOptions(
+        implementation=tf.distribute.experimental.CommunicationImplementation.RING)
+    return tf.distribute.MultiWorkerMirroredStrategy(communication_options=options)
+
+
+def get_worker_info(strategy):
+    """
+    :strategy: Strategy returned by `get_strategy`
+    :returns: Tuple of (number of workers, index of this worker)
+    """
+    resolver = getattr(strategy, "cluster_resolver", None)
+    if resolver is None or not resolver.cluster_spec().as_dict():
+        return 1, 0
+    return resolver.cluster_spec().num_tasks("worker"), resolver.task_id
+
+
+def get_free_ports(num_ports):
+    """
+    :returns: List of ports of this host that are free to listen on
+    """
+    sockets = [socket.socket() for _ in range(num_ports)]
+    for sock in sockets:
+        sock.bind(("localhost", 0))
+    ports = [sock.getsockname()[1] for sock in sockets]
+    for sock in sockets:
+        sock.close()
+    return ports
+
+
+def strip_arguments(argv, flags):
+    """Removes flags, along with their values, from the arguments
+
+    :argv: List of command line arguments
+    :flags: Flags to remove, e.g. ['--local-workers']
+    :returns: The remaining arguments
+    """
+    remaining = []
+    skip_value = False
+    for arg in argv:
+        if skip_value:
+            skip_value = False
+        elif arg in flags:
+            skip_value = True
+        elif arg.split("=")[0] not in flags:
+            remaining.append(arg)
+    return remaining
+
+
+def launch_local_workers(num_workers, script, args, intra_op_threads=0):
+    """Runs a script as the worker processes of a cluster on this
+    host, which listen on loopback ports, and waits for them
+
+    :num_workers: Number of worker processes
+    :script: Path to the script
+    :args: Arguments every worker is run with, to which
+        '--workers' and '--worker-index' are added
+    :intra_op_threads: Threads of each worker, where 0 splits
+        the cores of this host between the workers
+    :returns: List of the exit codes of the workers
+    """
+    workers = ",".join(f"localhost:{port}" for port in get_free_ports(num_workers))
+    if intra_op_threads == 0:
+        intra_op_threads = max(1, os.cpu_count() // num_workers)
+    print(f"Running {num_workers} workers at {workers}, "
+          f"with {intra_op_threads} threads each")
+
+    processes = [subprocess.Popen([sys.executable, script] + args +
+                                  ["--workers", workers, "--worker-index", str(worker_index),
+                                   "--intra-op-threads", str(intra_op_threads)])
+                 for worker_index in range(num_workers)]
+    return [process.wait() for process in processes]
@@ -0,0 +1,430 @@
+import xgboost as xgb
+import numpy as np
+
+import os
+import json
+import argparse
+import socketserver
+import threading
+import queue
+import traceback
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from http.client import HTTPConnection
+from urllib.parse import urlparse, parse_qs
+from time import time, perf_counter
+
+from baseline_utils import read_model_manifest
+from utils import create_connection
+from obtain_features import parse_datetime
+from feature_encoder import FeatureEncoder
+from xgb_ensemble import get_feature_layout, crossboro_batch_preproc_setup, \
+                         predict_trips
+
+
+parser = argparse.ArgumentParser(
+    description="Serves ETA predictions of the super-borough "
+        "XGBoost models over HTTP."
+    )
+
+# Models
+parser.add_argument("--manifest", type=str, default="models/manifest.json",
+                    help="Path to the manifest of trained super-borough "
+                         "models written by `train_superboro_models.py`")
+parser.add_argument("-doh", "--datetime-one-hot", action="store_true",
+                    help="Serve the models using one-hot date & time features")
+parser.add_argument("-woh", "--weekdays-one-hot", action="store_true",
+                    help="Serve the models using one-hot week-of-the-day features")
+parser.add_argument("--no-loc-id", dest='loc_id', action="store_false",
+                    help="Serve the models trained without the zone IDs")
+parser.add_argument("--db-path", type=str, default="./rides.db",
+                    help="Path to the sqlite3 database file.")
+parser.add_argument("--xgb-num-thread", type=int, default=4,
+                    help="Number of parallel threads for XGBoost")
+parser.add_argument("--encoder-cache-size", type=int, default=2**15,
+                    help="Number of encoded trips to memoize (0 to disable)")
+parser.add_argument("--eta-table", type=str, default=None,
+                    help="Answer from the ETA table stored at this path by "
+                         "`eta_table.py` instead of evaluating the models")
+
+# Serving
+parser.add_argument("--host", type=str, default="127.0.0.1",
+                    help="Host to listen on (default: 127.0.0.1)")
+parser.add_argument("--port", type=int, default=8080,
+                    help="Port to listen on (default: 8080)")
+parser.add_argument("--unix-socket", type=str, default=None,
+                    help="Listen on this Unix socket instead of a TCP port")
+parser.add_argument("--max-batch-size", type=int, default=256,
+                    help="Maximum number of trips predicted at once")
+parser.add_argument("--max-wait-ms", type=float, default=2,
+                    help="Maximum time a request waits for others "
+                         "to be batched with (default: 2)")
+
+# Benchmarking
+parser.add_argument("--bench", type=int, default=0,
+                    help="Instead of serving, send this many requests to an "
+                         "in-process server and report latency percentiles, "
+                         "with and without micro-batching")
+parser.add_argument("--bench-clients", type=int, default=16,
+                    help="Number of concurrent clients for `--bench`")
+
+
+class EtaPredictor:
+    """Predicts the ETAs of raw (PU, DO, pickup datetime) trips
+    with the super-borough models, encoding the trips the same
+    way as `get_naive_features` does for training"""
+
+    def __init__(self, conn, model_paths, datetime_onehot=False,
+                 weekdays_onehot=False, include_loc_ids=True, nthread=4,
+                 cache_size=2**15):
+        """
+        :conn: Connection to the database containing the
+            locations and coordinates (only read once, here)
+        :model_paths: Paths to the models of super-boros 1, 2 and 3
+        :datetime_onehot, weekdays_onehot, include_loc_ids:
+            The feature configuration the models were trained with
+        :nthread: Number of XGBoost threads per prediction
+        :cache_size: Number of encoded trips kept by the `FeatureEncoder`
+        """
+        self.models = [None] + [xgb.Booster(model_file=path) for path in model_paths]
+        for model in self.models[1:]:
+            model.set_param({"nthread": nthread})
+
+        self.encoder = FeatureEncoder(conn,
+                                      datetime_onehot=datetime_onehot,
+                                      weekdays_onehot=weekdays_onehot,
+                                      include_loc_ids=include_loc_ids,
+                                      maxsize=cache_size)
+        self.layout = get_feature_layout(datetime_onehot, weekdays_onehot,
+                                         include_loc_ids)
+        self.crossboro_batch_preproc = \
+            crossboro_batch_preproc_setup(conn, datetime_onehot,
+                                          weekdays_onehot, include_loc_ids)
+
+    def predict(self, pu_ids, do_ids, pickup_datetimes):
+        """Predicts the ETAs of a batch of trips
+
+        :pu_ids, do_ids: Lists of PU and DO location IDs (1 to 263)
+        :pickup_datetimes: List of pickup datetime strings,
+            formatted as 'YYYY-MM-DD HH:MM:SS'
+        :returns: np.array of the ETAs in seconds
+        """
+        features = self.encoder.encode(pu_ids, do_ids, pickup_datetimes)
+        return predict_trips(self.models, self.crossboro_batch_preproc,
+                             features, self.layout)
+
+
+class MicroBatcher:
+    """Collects the trips of concurrent requests and predicts
+    them together, with a single `predict` call per model.
+    A batch is predicted once it holds `max_batch_size` trips,
+    or `max_wait_ms` after its first request arrived."""
+
+    def __init__(self, predict_fn, max_batch_size=256, max_wait_ms=2):
+        """
+        :predict_fn: Function with the signature of `EtaPredictor.predict`
+        :max_batch_size: Maximum number of trips per batch
+        :max_wait_ms: Maximum time to wait for more requests
+        """
+        self.predict_fn = predict_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.requests = queue.Queue()
+        self.num_batches = 0
+        self.num_trips = 0
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, pu_ids, do_ids, pickup_datetimes):
+        """Queues the trips of a request
+
+        :returns: `Future` of the np.array of their ETAs
+        """
+        future = Future()
+        self.requests.put((pu_ids, do_ids, pickup_datetimes, future))
+        return future
+
+    def _run(self):
+        while True:
+            batch = [self.requests.get()]
+            batch_size = len(batch[0][0])
+            deadline = time() + self.max_wait
+            while batch_size < self.max_batch_size:
+                try:
+                    request = self.requests.get(timeout=max(0, deadline - time()))
+                except queue.Empty:
+                    break
+                batch.append(request)
+                batch_size += len(request[0])
+
+            pu_ids, do_ids, pickup_datetimes = [], [], []
+            for request in batch:
+                pu_ids += request[0]
+                do_ids += request[1]
+                pickup_datetimes += request[2]
+            try:
+                etas = self.predict_fn(pu_ids, do_ids, pickup_datetimes)
+            except Exception as error:
+                for request in batch:
+                    request[3].set_exception(error)
+                continue
+            self.num_batches += 1
+            self.num_trips += batch_size
+
+            start = 0
+            for request in batch:
+                end = start + len(request[0])
+                request[3].set_result(etas[start:end])
+                start = end
+
+
+def parse_trips(trips):
+    """Validates the trips of a request
+
+    :trips: List of [PU location ID, DO location ID, pickup datetime]
+    :returns: Lists of PU IDs, DO IDs and pickup datetimes
+    :raises: ValueError if a trip is malformed
+    """
+    pu_ids, do_ids, pickup_datetimes = [], [], []
+    for pu_id, do_id, pickup_datetime in trips:
+        pu_id, do_id = int(pu_id), int(do_id)
+        if not (1 <= pu_id <= 263 and 1 <= do_id <= 263):
+            raise ValueError(f"Location IDs must be between 1 and 263, "
+                             f"got {pu_id} and {do_id}")
+        parse_datetime([pickup_datetime])
+        pu_ids.append(pu_id)
+        do_ids.append(do_id)
+        pickup_datetimes.append(pickup_datetime)
+    return pu_ids, do_ids, pickup_datetimes
+
+
+class EtaRequestHandler(BaseHTTPRequestHandler):
+    """Answers ETA requests:
+        - GET /eta?pu=<ID>&do=<ID>&pickup=<YYYY-MM-DD HH:MM:SS>
+          returns {"eta": <seconds>}
+        - POST /eta with {"trips": [[<PU ID>, <DO ID>, <pickup>], ...]}
+          returns {"eta": [<seconds>, ...]}
+    """
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path != "/eta":
+            return self.reply(404, {"error": "Unknown path"})
+        query = parse_qs(url.query)
+        try:
+            trips = [[query["pu"][0], query["do"][0], query["pickup"][0]]]
+        except KeyError:
+            return self.reply(400, {"error": "Need 'pu', 'do' and 'pickup'"})
+        self.answer(trips, single=True)
+
+    def do_POST(self):
+        if urlparse(self.path).path != "/eta":
+            return self.reply(404, {"error": "Unknown path"})
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            trips = json.loads(self.rfile.read(length))["trips"]
+        except (ValueError, KeyError, TypeError):
+            return self.reply(400, {"error": "Need a JSON body with 'trips'"})
+        self.answer(trips, single=False)
+
+    def answer(self, trips, single):
+        try:
+            pu_ids, do_ids, pickup_datetimes = parse_trips(trips)
+        except (ValueError, TypeError, IndexError) as error:
+            return self.reply(400, {"error": f"Invalid trip: {error}"})
+        if len(pu_ids) == 0:
+            return self.reply(200, {"eta": []})
+        try:
+            etas = self.server.predict_fn(pu_ids, do_ids, pickup_datetimes)
+        except Exception as error:
+            # Answer rather than drop the connection, and keep serving
+            traceback.print_exc()
+            return self.reply(500, {"error": f"Prediction failed: {error!r}"})
+        self.reply(200, {"eta": float(etas[0]) if single else etas.tolist()})
+
+    def reply(self, status, body):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def address_string(self):
+        # Unix socket clients have no address
+        return str(self.client_address[0]) if self.client_address else "unix"
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        request, _ = super().get_request()
+        return request, ("unix", 0)
+
+
+def create_server(predict_fn, host="127.0.0.1", port=8080,
+                  unix_socket=None, verbose=False):
+    """Creates the HTTP server answering ETA requests
+
+    :predict_fn: Function with the signature of `EtaPredictor.predict`
+        to predict the requested trips with, called concurrently
+    :host, port: Address to listen on (port 0 picks a free port)
+    :unix_socket: If not None, path to a Unix socket to listen
+        on instead of `host` and `port`
+    :verbose: Whether to log every request
+    :returns: The server, to be started with `serve_forever`
+    """
+    if unix_socket is not None:
+        if os.path.exists(unix_socket):
+            os.remove(unix_socket)
+        server = UnixHTTPServer(unix_socket, EtaRequestHandler)
+    else:
+        server = ThreadingHTTPServer((host, port), EtaRequestHandler)
+        server.daemon_threads = True
+    server.predict_fn = predict_fn
+    server.verbose = verbose
+    return server
+
+
+def sample_trips(conn, num_trips, table_name="rides"):
+    """Samples (PU, DO, pickup datetime) trips from the database
+
+    :conn: Connection to the database
+    :num_trips: Number of trips to sample
+    :table_name: Name of the table holding the rides data
+    :returns: List of [PU ID, DO ID, pickup datetime]
+    """
+    cursor = conn.cursor()
+    cursor.execute('SELECT PULocationID, DOLocationID, tpep_pickup_datetime '
+                   f'FROM {table_name} '
+                   'WHERE PULocationID < 264 '
+                   'AND DOLocationID < 264 '
+                   f'ORDER BY RANDOM() LIMIT {num_trips}')
+    return [list(row) for row in cursor.fetchall()]
+
+
+def batched(batcher):
+    """Returns a thread-safe predict function going through `batcher`"""
+    return lambda *trips: batcher.submit(*trips).result()
+
+
+def benchmark(predict_fn, trips, num_clients=16):
+    """Serves `predict_fn` on a free local port, and measures the
+    latency of single-trip GET requests sent by concurrent clients
+
+    :predict_fn: Function passed to `create_server`
+    :trips: List of trips to request, obtained from `sample_trips`
+    :num_clients: Number of concurrent clients
+    :returns: A dictionary containing the following:
+        - "p50", "p99":     Latency percentiles in milliseconds
+        - "throughput":     Requests answered per second
+    """
+    server = create_server(predict_fn, port=0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    port = server.server_address[1]
+
+    latencies = [[] for _ in range(num_clients)]
+
+    def client(client_idx):
+        connection = HTTPConnection("127.0.0.1", port)
+        for pu_id, do_id, pickup_datetime in trips[client_idx::num_clients]:
+            start_time = perf_counter()
+            connection.request("GET", f"/eta?pu={pu_id}&do={do_id}"
+                                      f"&pickup={pickup_datetime.replace(' ', '%20')}")
+            response = connection.getresponse()
+            response.read()
+            latencies[client_idx].append(perf_counter() - start_time)
+            assert response.status == 200, f"ERROR: status {response.status}"
+        connection.close()
+
+    start_time = time()
+    clients = [threading.Thread(target=client, args=(client_idx,))
+               for client_idx in range(num_clients)]
+    for thread in clients:
+        thread.start()
+    for thread in clients:
+        thread.join()
+    duration = time() - start_time
+    server.shutdown()
+    server.server_close()
+
+    latencies = np.concatenate(latencies) * 1000
+    return {
+        "p50":        np.percentile(latencies, 50),
+        "p99":        np.percentile(latencies, 99),
+        "throughput": latencies.shape[0] / duration,
+    }
+
+
+def main():
+    args = parser.parse_args()
+    conn = create_connection(args.db_path)
+
+    if args.eta_table is not None:
+        # Imported here, as `eta_table` builds upon this module
+        from eta_table import EtaTable
+        eta_table = EtaTable(args.eta_table)
+        predict_fn = eta_table.predict
+        batcher = None
+    else:
+        models_key = f"{int(args.datetime_one_hot)}" \
+                     f"{int(args.weekdays_one_hot)}" \
+                     f"{int(args.loc_id)}"
+        manifest = read_model_manifest(args.manifest).get(models_key, {})
+        assert all(str(superboro) in manifest for superboro in (1, 2, 3)), \
+            f"ERROR: Need the models of all super-boros for features " \
+            f"{models_key} in {args.manifest}"
+        model_paths = [manifest[str(superboro)]["model_path"] for superboro in (1, 2, 3)]
+
+        predictor = EtaPredictor(conn, model_paths,
+                                 datetime_onehot=args.datetime_one_hot,
+                                 weekdays_onehot=args.weekdays_one_hot,
+                                 include_loc_ids=args.loc_id,
+                                 nthread=args.xgb_num_thread,
+                                 cache_size=args.encoder_cache_size)
+        batcher = MicroBatcher(predictor.predict, args.max_batch_size, args.max_wait_ms)
+        predict_fn = batched(batcher)
+
+    if args.bench > 0:
+        trips = sample_trips(conn, args.bench)
+        conn.close()
+        if batcher is None:
+            setups = [("table", predict_fn, None)]
+        else:
+            unbatched = MicroBatcher(predictor.predict, 1, 0)
+            setups = [("unbatched", batched(unbatched), unbatched),
+                      ("micro-batched", predict_fn, batcher)]
+        for name, bench_fn, bench_batcher in setups:
+            result = benchmark(bench_fn, trips, num_clients=args.bench_clients)
+            print(f">>> {name:>13}: p50 {result['p50']:.2f} ms, "
+                  f"p99 {result['p99']:.2f} ms, "
+                  f"{result['throughput']:.1f} requests/sec"
+                  + (f", {bench_batcher.num_trips / max(1, bench_batcher.num_batches):.1f} "
+                     "trips per predict" if bench_batcher is not None else ""))
+        if batcher is not None:
+            stats = predictor.encoder.stats()
+            print(f">>> Feature encoder: {stats['hits']} hits, "
+                  f"{stats['misses']} misses ({100*stats['hit_rate']:.1f}% hit rate)")
+        return
+    conn.close()
+
+    server = create_server(predict_fn, host=args.host, port=args.port,
+                           unix_socket=args.unix_socket, verbose=True)
+    address = args.unix_socket if args.unix_socket is not None \
+              else f"http://{args.host}:{server.server_address[1]}"
+    print(f">>> Serving ETAs at {address}/eta")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+
+if __name__ == "__main__":
+    main()
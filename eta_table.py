@@ -0,0 +1,210 @@
+import numpy as np
+
+import os
+import json
+import argparse
+import datetime
+from time import time, perf_counter
+
+from baseline_utils import read_model_manifest, create_dir
+from utils import create_connection
+from eta_service import EtaPredictor
+
+
+parser = argparse.ArgumentParser(
+    description="Precomputes the ETAs of the super-borough XGBoost "
+        "models for every pair of zones, weekday and time bucket."
+    )
+
+# Models
+parser.add_argument("--manifest", type=str, default="models/manifest.json",
+                    help="Path to the manifest of trained super-borough "
+                         "models written by `train_superboro_models.py`")
+parser.add_argument("-doh", "--datetime-one-hot", action="store_true",
+                    help="Use the models using one-hot date & time features")
+parser.add_argument("-woh", "--weekdays-one-hot", action="store_true",
+                    help="Use the models using one-hot week-of-the-day features")
+parser.add_argument("--no-loc-id", dest='loc_id', action="store_false",
+                    help="Use the models trained without the zone IDs")
+parser.add_argument("--db-path", type=str, default="./rides.db",
+                    help="Path to the sqlite3 database file.")
+parser.add_argument("--xgb-num-thread", type=int, default=4,
+                    help="Number of parallel threads for XGBoost")
+
+# Table
+parser.add_argument("--out", type=str, default="data/eta_table.npy",
+                    help="Path to store the table at (default: "
+                         "'data/eta_table.npy', with its metadata in "
+                         "'data/eta_table.npy.json')")
+parser.add_argument("--minute-bucket", type=int, default=60,
+                    help="Width of the time buckets in minutes, which "
+                         "has to divide a day (default: 60, i.e. hourly)")
+parser.add_argument("--reference-date", type=str, default="2018-06-04",
+                    help="Monday of the week whose dates are used for the "
+                         "date features of each weekday (default: 2018-06-04)")
+parser.add_argument("--bench", type=int, default=0,
+                    help="Instead of building, time this many lookups "
+                         "in the table stored at `--out`")
+
+
+def get_time_bucket(pickup_datetime, minute_bucket):
+    """Locates a pickup datetime within the table
+
+    :pickup_datetime: Datetime string, formatted as 'YYYY-MM-DD HH:MM:SS'
+    :minute_bucket: Width of the time buckets in minutes
+    :returns: A tuple of (weekday, time bucket), with weekdays
+        ranging from 0 (Monday) to 6 (Sunday)
+    """
+    weekday = datetime.date(int(pickup_datetime[0:4]),
+                            int(pickup_datetime[5:7]),
+                            int(pickup_datetime[8:10])).weekday()
+    minutes = int(pickup_datetime[11:13])*60 + int(pickup_datetime[14:16])
+    return weekday, minutes // minute_bucket
+
+
+def build_eta_table(predictor, reference_date="2018-06-04",
+                    minute_bucket=60, max_loc_id=263, verbose=True):
+    """Predicts the ETA of every (PU, DO, weekday, time bucket)
+    combination, each at the middle of its time bucket on the
+    corresponding day of the reference week. Trips across
+    super-boros take the minimum over the bridges, as in
+    `xgb_ensemble.predict_trips`.
+
+    :predictor: `EtaPredictor` holding the models
+    :reference_date: Date string ('YYYY-MM-DD') of a Monday
+    :minute_bucket: Width of the time buckets in minutes
+    :max_loc_id: The maximum possible value of location IDs
+    :verbose: Whether to print progress
+    :returns: np.array of shape (max_loc_id+1, max_loc_id+1, 7,
+        number of time buckets) holding the ETAs in seconds,
+        indexed by the location IDs themselves (NaN for ID 0)
+    """
+    monday = datetime.datetime.strptime(reference_date, "%Y-%m-%d")
+    assert monday.weekday() == 0, \
+        f"ERROR: The reference date {reference_date} is not a Monday"
+    assert (24*60) % minute_bucket == 0, \
+        "ERROR: The time buckets have to divide a day"
+    num_buckets = (24*60) // minute_bucket
+
+    table = np.full((max_loc_id+1, max_loc_id+1, 7, num_buckets),
+                    np.nan, dtype=np.float32)
+    loc_ids = np.arange(1, max_loc_id+1)
+    pu_ids = np.repeat(loc_ids, max_loc_id).tolist()
+    do_ids = np.tile(loc_ids, max_loc_id).tolist()
+
+    start_time = time()
+    for weekday in range(7):
+        for bucket in range(num_buckets):
+            pickup = monday + datetime.timedelta(
+                days=weekday, minutes=bucket*minute_bucket + minute_bucket // 2)
+            etas = predictor.predict(pu_ids, do_ids,
+                                     [pickup.strftime("%Y-%m-%d %H:%M:%S")]*len(pu_ids))
+            table[1:, 1:, weekday, bucket] = etas.reshape(max_loc_id, max_loc_id)
+        if verbose:
+            print(f">>> Weekday {weekday} complete, "
+                  f"duration: {time() - start_time:.2f} seconds")
+    return table
+
+
+def save_eta_table(table, path, metadata):
+    """Stores the table as a .npy file, which can be memory-mapped,
+    and its metadata in '{path}.json'
+
+    :table: np.array obtained from `build_eta_table`
+    :path: Path to the .npy file
+    :metadata: Dictionary describing the table, holding
+        at least "minute_bucket"
+    """
+    np.save(path, table)
+    with open(path + ".json", "w") as metadata_file:
+        json.dump(metadata, metadata_file, indent=4, sort_keys=True)
+
+
+class EtaTable:
+    """Looks up precomputed ETAs in a table stored by
+    `save_eta_table`, memory-mapped rather than loaded"""
+
+    def __init__(self, path):
+        """
+        :path: Path to the .npy file of the table
+        """
+        self.table = np.load(path, mmap_mode="r")
+        with open(path + ".json", "r") as metadata_file:
+            self.metadata = json.load(metadata_file)
+        self.minute_bucket = self.metadata["minute_bucket"]
+
+    def lookup(self, pu_id, do_id, pickup_datetime):
+        """Looks up the ETA of a single trip
+
+        :pu_id, do_id: PU and DO location IDs
+        :pickup_datetime: Datetime string, formatted as 'YYYY-MM-DD HH:MM:SS'
+        :returns: The ETA in seconds
+        """
+        weekday, bucket = get_time_bucket(pickup_datetime, self.minute_bucket)
+        return float(self.table[pu_id, do_id, weekday, bucket])
+
+    def predict(self, pu_ids, do_ids, pickup_datetimes):
+        """Looks up the ETAs of a batch of trips, with the
+        signature of `EtaPredictor.predict`
+
+        :returns: np.array of the ETAs in seconds
+        """
+        weekdays, buckets = zip(*[get_time_bucket(pickup_datetime, self.minute_bucket)
+                                  for pickup_datetime in pickup_datetimes])
+        return np.asarray(self.table[pu_ids, do_ids, list(weekdays), list(buckets)],
+                          dtype=float)
+
+
+def main():
+    args = parser.parse_args()
+
+    if args.bench > 0:
+        eta_table = EtaTable(args.out)
+        rand = np.random.RandomState(10701)
+        pu_ids = rand.randint(1, 264, args.bench).tolist()
+        do_ids = rand.randint(1, 264, args.bench).tolist()
+        pickups = [f"2018-06-{rand.randint(1, 31):02d} "
+                   f"{rand.randint(0, 24):02d}:{rand.randint(0, 60):02d}:00"
+                   for _ in range(args.bench)]
+        start_time = perf_counter()
+        for trip in zip(pu_ids, do_ids, pickups):
+            eta_table.lookup(*trip)
+        duration = perf_counter() - start_time
+        print(f">>> {args.bench} lookups, "
+              f"{duration / args.bench * 1e6:.2f} microseconds per lookup")
+        return
+
+    models_key = f"{int(args.datetime_one_hot)}" \
+                 f"{int(args.weekdays_one_hot)}" \
+                 f"{int(args.loc_id)}"
+    manifest = read_model_manifest(args.manifest).get(models_key, {})
+    assert all(str(superboro) in manifest for superboro in (1, 2, 3)), \
+        f"ERROR: Need the models of all super-boros for features " \
+        f"{models_key} in {args.manifest}"
+    model_paths = [manifest[str(superboro)]["model_path"] for superboro in (1, 2, 3)]
+
+    conn = create_connection(args.db_path)
+    predictor = EtaPredictor(conn, model_paths,
+                             datetime_onehot=args.datetime_one_hot,
+                             weekdays_onehot=args.weekdays_one_hot,
+                             include_loc_ids=args.loc_id,
+                             nthread=args.xgb_num_thread,
+                             cache_size=0)
+    conn.close()
+
+    table = build_eta_table(predictor,
+                            reference_date=args.reference_date,
+                            minute_bucket=args.minute_bucket)
+
+    create_dir(os.path.dirname(args.out) or ".")
+    save_eta_table(table, args.out, {
+        "minute_bucket":  args.minute_bucket,
+        "reference_date": args.reference_date,
+        "features":       models_key,
+        "model_paths":    model_paths,
+    })
+    print(f">>> ETA table of shape {table.shape} saved to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
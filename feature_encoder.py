@@ -0,0 +1,183 @@
+import numpy as np
+from scipy import sparse
+from threading import Lock
+from collections import OrderedDict
+
+from obtain_features import extract_all_coordinates, extract_all_boroughs, \
+    get_pair_feature_table, get_naive_features
+
+
+# Offsets of the seconds feature within the datetime block
+# of `obtain_date_time_features`, which is laid out as
+# [dates, months, hours, minutes, seconds, weekdays]
+SECONDS_OFFSET_ONEHOT = 31 + 12 + 24 + 60
+SECONDS_OFFSET_SCALAR = 4
+
+
+class FeatureEncoder:
+    """Encodes raw (PU, DO, pickup datetime) trips the same way as
+    `get_naive_features`, memoizing the encoded rows in an LRU cache.
+
+    The features of a trip only depend on its zone IDs and its pickup
+    datetime, and the latter only through its minute apart from the
+    seconds feature. Rows are therefore cached per (PU, DO, minute)
+    with the seconds set to 0, and the seconds of each trip are
+    written into its row when it is taken from the cache.
+    Encoding is thread-safe."""
+
+    def __init__(self, conn, datetime_onehot=True, weekdays_onehot=True,
+                 include_loc_ids=True, use_nn_ordering=False,
+                 maxsize=2**15, maxLocID=263):
+        """
+        :conn: Connection to the database containing the
+            locations and coordinates (only read once, here)
+        :datetime_onehot, weekdays_onehot, include_loc_ids, use_nn_ordering:
+            The feature layout, as passed to `get_naive_features`
+        :maxsize: Maximum number of cached rows, where 0
+            disables the cache (e.g. for batches of distinct trips)
+        :maxLocID: the maximum possible value of location IDs
+        """
+        self.datetime_onehot = datetime_onehot
+        self.weekdays_onehot = weekdays_onehot
+        self.include_loc_ids = include_loc_ids
+        self.use_nn_ordering = use_nn_ordering
+        self.maxsize = maxsize
+        self.maxLocID = maxLocID
+
+        self.coords = extract_all_coordinates(conn, 'coordinates')
+        self.boros = extract_all_boroughs(conn, 'locations')
+        self.pair_table = get_pair_feature_table(self.coords, self.boros,
+                                                 maxLocID=maxLocID,
+                                                 include_loc_ids=include_loc_ids,
+                                                 use_nn_ordering=use_nn_ordering)
+        self.sparse = include_loc_ids or datetime_onehot or weekdays_onehot
+
+        # The datetime block comes last if the static block leads, first otherwise
+        datetime_start = self.pair_table.shape[1] \
+            if include_loc_ids or use_nn_ordering else 0
+        self.seconds_col = datetime_start + (SECONDS_OFFSET_ONEHOT if datetime_onehot
+                                             else SECONDS_OFFSET_SCALAR)
+        self.num_features = None
+
+        self.cache = OrderedDict()
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def from_feature_type(cls, conn, feature_type, **kwargs):
+        """Creates the encoder of one of the layouts of
+        `train_boro_model.FEATURE_TYPES`
+
+        :feature_type: The `FEATURE_TYPES` entry of the layout
+        :kwargs: Passed on to the constructor, e.g. `use_nn_ordering`
+        """
+        return cls(conn,
+                   datetime_onehot=feature_type["datetime_onehot"],
+                   weekdays_onehot=feature_type["weekdays_onehot"],
+                   include_loc_ids=feature_type["include_loc_ids"],
+                   **kwargs)
+
+    def _encode_rows(self, keys):
+        """Encodes the trips of the given (PU, DO, minute) keys at 0 seconds
+
+        :keys: List of cache keys
+        :returns: List of cache entries, each holding either the
+            (indices, data, position of the seconds entry) of a
+            sparse row, or a dense row
+        """
+        pickups = [f"{minute}:00" for _, _, minute in keys]
+        rows = np.array([pickups, pickups,
+                         [pu_id for pu_id, _, _ in keys],
+                         [do_id for _, do_id, _ in keys]], dtype=object).T
+        features, _ = get_naive_features(rows, self.coords, self.boros,
+                                         maxLocID=self.maxLocID,
+                                         datetime_onehot=self.datetime_onehot,
+                                         weekdays_onehot=self.weekdays_onehot,
+                                         include_loc_ids=self.include_loc_ids,
+                                         use_nn_ordering=self.use_nn_ordering,
+                                         pair_table=self.pair_table)
+        self.num_features = features.shape[1]
+        if not self.sparse:
+            return list(features)
+
+        features.sort_indices()
+        entries = []
+        for i in range(features.shape[0]):
+            start, end = features.indptr[i], features.indptr[i+1]
+            indices = features.indices[start:end].copy()
+            entries.append((indices, features.data[start:end].copy(),
+                            int(np.searchsorted(indices, self.seconds_col))))
+        return entries
+
+    def encode(self, pu_ids, do_ids, pickup_datetimes):
+        """Encodes a batch of trips
+
+        :pu_ids, do_ids: Lists of PU and DO location IDs
+        :pickup_datetimes: List of pickup datetime strings,
+            formatted as 'YYYY-MM-DD HH:MM:SS'
+        :returns: a sparse csr_matrix or a numpy array (as
+            `get_naive_features` would) of the feature vectors
+        """
+        if self.maxsize == 0:
+            self.misses += len(pickup_datetimes)
+            rows = np.array([pickup_datetimes, pickup_datetimes, pu_ids, do_ids],
+                            dtype=object).T
+            features, _ = get_naive_features(rows, self.coords, self.boros,
+                                             maxLocID=self.maxLocID,
+                                             datetime_onehot=self.datetime_onehot,
+                                             weekdays_onehot=self.weekdays_onehot,
+                                             include_loc_ids=self.include_loc_ids,
+                                             use_nn_ordering=self.use_nn_ordering,
+                                             pair_table=self.pair_table)
+            return features
+
+        keys = [(int(pu_id), int(do_id), pickup[:16])
+                for pu_id, do_id, pickup in zip(pu_ids, do_ids, pickup_datetimes)]
+        seconds = np.array([int(pickup[17:19]) for pickup in pickup_datetimes])
+
+        with self.lock:
+            entries = [self.cache.get(key) for key in keys]
+            missing = {key: None for key, entry in zip(keys, entries) if entry is None}
+            self.misses += len(missing)
+            self.hits += len(keys) - len(missing)
+            if missing:
+                missing = dict(zip(missing, self._encode_rows(list(missing))))
+                entries = [missing[key] if entry is None else entry
+                           for key, entry in zip(keys, entries)]
+            for key in keys:
+                if key in missing:
+                    self.cache[key] = missing[key]
+                else:
+                    self.cache.move_to_end(key)
+            while len(self.cache) > self.maxsize:
+                self.cache.popitem(last=False)
+
+        if not self.sparse:
+            features = np.vstack(entries)
+            features[:, self.seconds_col] = seconds + 1
+            return features
+
+        lengths = np.array([len(indices) for indices, _, _ in entries])
+        indptr = np.concatenate([[0], np.cumsum(lengths)])
+        indices = np.concatenate([indices for indices, _, _ in entries])
+        data = np.concatenate([data for _, data, _ in entries])
+        seconds_pos = indptr[:-1] + np.array([pos for _, _, pos in entries])
+        if self.datetime_onehot:
+            indices[seconds_pos] += seconds
+        else:
+            data[seconds_pos] = seconds + 1
+        return sparse.csr_matrix((data, indices, indptr),
+                                 shape=(len(keys), self.num_features))
+
+    def stats(self):
+        """
+        :returns: Dictionary of the cache hits, misses, hit rate and size
+        """
+        lookups = self.hits + self.misses
+        return {
+            "hits":     self.hits,
+            "misses":   self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "size":     len(self.cache),
+        }
@@ -1,16 +1,20 @@
+import copy
 import numpy as np 
+from scipy import sparse
 # import tensorflow as tf 
 import tensorflow as tf
 # tf.disable_v2_behavior() 
 import tensorflow.keras.backend as K
-from tensorflow.compat.v1.keras.backend import set_session
 
 
-def create_boro_model(num_neurons_in_layers, input_dim):
-    inp = tf.keras.layers.Input(shape=(input_dim, ), name="input")
+def create_boro_model(num_neurons_in_layers, input_dim, sparse_input=False):
+    # With a sparse input, the first Dense layer multiplies the kernel
+    # with a SparseTensor, only touching the rows of non-zero features
+    inp = tf.keras.layers.Input(shape=(input_dim, ), sparse=sparse_input, name="input")
     h1 = tf.keras.layers.Dense(num_neurons_in_layers[0], activation='relu')(inp) 
     h2 = tf.keras.layers.Dense(num_neurons_in_layers[1], activation='relu')(h1) 
-    o = tf.keras.layers.Dense(1, activation='relu')(h2)
+    # The output stays in float32 under mixed precision
+    o = tf.keras.layers.Dense(1, activation='relu', dtype='float32')(h2)
 
     model = tf.keras.Model(inputs=inp, outputs=o) 
     # model.compile(loss='mse', optimizer=tf.keras.optimizers.Adam(learning_rate=learning_rate))
@@ -18,45 +22,110 @@ def create_boro_model(num_neurons_in_layers, input_dim):
 
 
 
-class BoroModel(object):
+def to_sparse_tensor(matrix):
+    """Converts a scipy sparse matrix to the input of a sparse Input
 
-    def __init__(self, sess, inp_dim, num_neurons_in_layers=[100,50], learning_rate=5e-4):
-        
-        self.sess = sess
-        set_session(self.sess)
+    :matrix: scipy sparse matrix of shape (batch size, input_dim)
+    :returns: tf.SparseTensor, with its indices in row-major order
+    """
+    matrix = sparse.csr_matrix(matrix)
+    matrix.sort_indices()
+    matrix = matrix.tocoo()
+    return tf.SparseTensor(
+        indices=np.stack([matrix.row, matrix.col], axis=1).astype(np.int64),
+        values=matrix.data.astype(np.float32),
+        dense_shape=np.array(matrix.shape, dtype=np.int64))
 
-        self.model = create_boro_model(num_neurons_in_layers, inp_dim)
 
-        self.optimizer = tf.keras.optimizers.Adam(learning_rate = learning_rate)
+def compile_step(step, use_tf_function=True, jit_compile=False):
+    """Compiles a training step into a graph with `tf.function`
+
+    :step: Python function of the step
+    :use_tf_function: Whether to compile the step, or to run it eagerly
+    :jit_compile: Whether to further compile the graph with XLA
+    :returns: The compiled function
+    """
+    if not use_tf_function:
+        return step
+    return tf.function(step, jit_compile=jit_compile)
 
-        self.gradient_loss_wrt_output = tf.compat.v1.placeholder(tf.float32, shape=(None, 1))
 
-        self.input_gradients = tf.gradients(
-            self.model.output, self.model.input, 
-            grad_ys=self.gradient_loss_wrt_output)
+def reset_steps(model):
+    """Recompiles the steps of a model whose Keras model was replaced,
+    as the steps traced so far hold the variables of the old one. The
+    optimizer, whose state belongs to those variables, starts afresh
+    with its current learning rate.
 
-        self.full_gradients = tf.gradients(
-            self.model.output, self.model.trainable_weights,
-            grad_ys=self.gradient_loss_wrt_output)
+    :model: `BoroModel` or `SelectorModel`
+    """
+    learning_rate = float(K.get_value(model.optimizer.learning_rate))
+    model.optimizer = tf.keras.optimizers.Adam(learning_rate = learning_rate)
+    model.compile_steps()
 
-        self.optimize_op = self.optimizer.apply_gradients(
-            zip(self.full_gradients, self.model.trainable_weights))
 
-        self.sess.run(tf.compat.v1.global_variables_initializer())
+def copy_model(model):
+    """
+    :model: `BoroModel` or `SelectorModel`
+    :returns: A copy of the model, with a new Keras model of the same
+        layers and weights and an optimizer of its own
+    """
+    model_copy = copy.copy(model)
+    model_copy.model = tf.keras.models.clone_model(model.model)
+    model_copy.model.set_weights(model.model.get_weights())
+    reset_steps(model_copy)
+    return model_copy
+
+
+class BoroModel(object):
+
+    def __init__(self, inp_dim, num_neurons_in_layers=[100,50], learning_rate=5e-4,
+                 sparse_input=False, use_tf_function=True, jit_compile=False):
 
+        self.sparse_input = sparse_input
+        self.model = create_boro_model(num_neurons_in_layers, inp_dim, sparse_input)
+
+        self.optimizer = tf.keras.optimizers.Adam(learning_rate = learning_rate)
+
+        self.use_tf_function = use_tf_function
+        self.jit_compile = jit_compile
+        self.compile_steps()
+
+    def compile_steps(self):
+        self.train_step = compile_step(self._train_step, self.use_tf_function, self.jit_compile)
+        self.gradients_step = compile_step(self._gradients_step, self.use_tf_function,
+                                           self.jit_compile)
+
+    def _train_step(self, inp, grads_loss_wrt_outputs):
+        with tf.GradientTape() as tape:
+            output = self.model(inp, training=True)
+        full_gradients = tape.gradient(output, self.model.trainable_weights,
+                                       output_gradients=grads_loss_wrt_outputs)
+        self.optimizer.apply_gradients(zip(full_gradients, self.model.trainable_weights))
+
+    def _gradients_step(self, inputs, grads_loss_wrt_outputs):
+        with tf.GradientTape() as tape:
+            tape.watch(inputs)
+            output = self.model(inputs, training=False)
+        return tape.gradient(output, inputs, output_gradients=grads_loss_wrt_outputs)
+
+    def feed_input(self, inp):
+        """Converts scipy sparse inputs to SparseTensors, and dense
+        ones to float32"""
+        if self.sparse_input and sparse.issparse(inp):
+            return to_sparse_tensor(inp)
+        return tf.convert_to_tensor(np.asarray(inp, dtype=np.float32))
 
     def train(self, inp, grads_loss_wrt_outputs):
-        self.sess.run(self.optimize_op, feed_dict={
-            self.model.input: inp,
-            self.gradient_loss_wrt_output: grads_loss_wrt_outputs 
-        })
+        self.train_step(self.feed_input(inp),
+                        tf.convert_to_tensor(grads_loss_wrt_outputs, dtype=tf.float32))
 
     def gradients(self, inputs, grads_loss_wrt_outputs):
-        gradients = self.sess.run(self.input_gradients, feed_dict={
-            self.model.input: inputs, 
-            self.gradient_loss_wrt_output: grads_loss_wrt_outputs 
-        }) 
-        return gradients[0]
+        # There are no gradients w.r.t. sparse inputs, which can only
+        # be fed from data, and never from an upstream model
+        assert not self.sparse_input, "ERROR: No input gradients for sparse inputs"
+        return self.gradients_step(self.feed_input(inputs),
+                                   tf.convert_to_tensor(grads_loss_wrt_outputs,
+                                                        dtype=tf.float32)).numpy()
 
 
     def save_model(self, path):
@@ -64,6 +133,7 @@ class BoroModel(object):
 
     def load_model(self, path):
         self.model = tf.keras.models.load_model(path, compile=True)
+        reset_steps(self)
 
     def save_model_weights(self, path):
         self.model.save_weights(path)
@@ -80,7 +150,8 @@ def create_selector_model(num_neurons_in_layers, fsize, dtsize, bridge_matrix1,
     dt_input = tf.keras.layers.Input(shape=[dtsize], name="dt_feature")
     f = tf.keras.layers.concatenate([pu_input, do_input, dt_input])
     f = tf.keras.layers.Dense(num_neurons_in_layers[0], activation='relu')(f)
-    f = tf.keras.layers.Dense(num_neurons_in_layers[1], activation='softmax')(f)
+    # float32 even under mixed precision, to be multiplied with the bridge matrices
+    f = tf.keras.layers.Dense(num_neurons_in_layers[1], activation='softmax', dtype='float32')(f)
 
     br_matrix1 = K.constant(bridge_matrix1)
     br_matrix2 = K.constant(bridge_matrix2)
@@ -99,46 +170,119 @@ def create_selector_model(num_neurons_in_layers, fsize, dtsize, bridge_matrix1,
 
 class SelectorModel(object):
 
-    def __init__(self, sess, num_neurons_in_layers, fsize, dtsize, 
-        bridge_matrix1, bridge_matrix2, learning_rate=1e-3):
+    def __init__(self, num_neurons_in_layers, fsize, dtsize, 
+        bridge_matrix1, bridge_matrix2, learning_rate=1e-3,
+        use_tf_function=True, jit_compile=False):
         
-        self.sess = sess
-        set_session(self.sess)
         self.model, self.pu_input, self.do_input, self.dt_input = create_selector_model(
                                         num_neurons_in_layers, fsize,
                                         dtsize, bridge_matrix1, bridge_matrix2)
         self.optimizer = tf.keras.optimizers.Adam(learning_rate = learning_rate)
-        
-        self.gradient_wrt_output = tf.compat.v1.placeholder(tf.float32,
-                shape=(None, 6*fsize+3*dtsize))
-        
-        self.full_gradients = tf.gradients(
-            self.model.output, self.model.trainable_weights,
-            grad_ys=self.gradient_wrt_output)
 
-        self.optimize_op = self.optimizer.apply_gradients(
-            zip(self.full_gradients, self.model.trainable_weights))
+        self.use_tf_function = use_tf_function
+        self.jit_compile = jit_compile
+        self.compile_steps()
 
-        self.sess.run(tf.compat.v1.global_variables_initializer())
+    def compile_steps(self):
+        self.train_step = compile_step(self._train_step, self.use_tf_function, self.jit_compile)
 
+    def _train_step(self, pu_input, do_input, dt_input, grads_wrt_outputs):
+        with tf.GradientTape() as tape:
+            output = self.model([pu_input, do_input, dt_input], training=True)
+        full_gradients = tape.gradient(output, self.model.trainable_weights,
+                                       output_gradients=grads_wrt_outputs)
+        self.optimizer.apply_gradients(zip(full_gradients, self.model.trainable_weights))
 
     def train(self, pu_input, do_input, dt_input, grads_wrt_outputs):
-        self.sess.run(self.optimize_op, feed_dict={
-            self.pu_input: pu_input,
-            self.do_input: do_input,
-            self.dt_input: dt_input,
-            self.gradient_wrt_output: grads_wrt_outputs 
-        })
+        self.train_step(*[tf.convert_to_tensor(np.asarray(x, dtype=np.float32))
+                          for x in (pu_input, do_input, dt_input, grads_wrt_outputs)])
 
     def save_model(self, path):
         tf.keras.models.save_model(self.model, path)
 
     def load_model(self, path):
         self.model = tf.keras.models.load_model(path, compile=True)
+        reset_steps(self)
 
     def save_model_weights(self, path):
         self.model.save_weights(path)
 
     def load_model_weights(self, path):
         self.model.load_weights(path)
-        
\ No newline at end of file
+
+
+class EnsembleModel(object):
+    """The selector -> (PU, bridge, DO) -> sum pipeline of one
+    (start, end) super-boro pair, trained with a single compiled
+    step per batch"""
+
+    def __init__(self, selector_model, pu_model, br_model, do_model,
+                 use_tf_function=True, jit_compile=False):
+        """
+        :selector_model: `SelectorModel` of the pair
+        :pu_model, br_model, do_model: `BoroModel`s of the start
+            super-boro, the bridges and the end super-boro
+        :use_tf_function: Whether to compile the steps with `tf.function`
+        :jit_compile: Whether to further compile them with XLA
+        """
+        self.selector_model = selector_model
+        self.models = [selector_model, pu_model, br_model, do_model]
+
+        self.use_tf_function = use_tf_function
+        self.jit_compile = jit_compile
+        self.compile_steps()
+
+    def compile_steps(self):
+        # The Keras models the steps are traced with
+        self.keras_models = [model.model for model in self.models]
+        self.train_step = compile_step(self._train_step, self.use_tf_function, self.jit_compile)
+        self.predict_step = compile_step(self._predict_step, self.use_tf_function,
+                                         self.jit_compile)
+
+    def check_steps(self):
+        """Recompiles the steps if a model was reloaded since they were"""
+        if any(model.model is not keras_model
+               for model, keras_model in zip(self.models, self.keras_models)):
+            self.compile_steps()
+
+    def _predict_step(self, pu_input, do_input, dt_input, training=False):
+        selector_model, pu_model, br_model, do_model = self.models
+        selection = selector_model.model([pu_input, do_input, dt_input], training=training)
+        pu_selection, br_selection, do_selection = tf.split(selection, 3, axis=1)
+        return pu_model.model(pu_selection, training=training) \
+               + br_model.model(br_selection, training=training) \
+               + do_model.model(do_selection, training=training)
+
+    def _train_step(self, pu_input, do_input, dt_input, values):
+        weights = [model.model.trainable_weights for model in self.models]
+        with tf.GradientTape() as tape:
+            total_time = self._predict_step(pu_input, do_input, dt_input, training=True)
+            errors = total_time - tf.expand_dims(values, axis=-1)
+            # The gradients of the summed squared errors, i.e. with
+            # 2*(total_time - values) flowing back from the output
+            sse = tf.reduce_sum(tf.square(errors))
+        gradients = tape.gradient(sse, weights)
+
+        # Each model keeps its own optimizer (and learning rate)
+        for model, model_weights, model_gradients in zip(self.models, weights, gradients):
+            model.optimizer.apply_gradients(zip(model_gradients, model_weights))
+
+        loss = tf.reduce_mean(tf.square(errors))
+        return loss, tf.sqrt(loss), total_time
+
+    def to_tensors(self, *inputs):
+        return [tf.convert_to_tensor(np.asarray(x, dtype=np.float32)) for x in inputs]
+
+    def train(self, pu_input, do_input, dt_input, values):
+        self.check_steps()
+        loss, rmse, total_time = self.train_step(*self.to_tensors(pu_input, do_input,
+                                                                 dt_input, values))
+        return loss.numpy(), rmse.numpy(), total_time.numpy()
+
+    def predict(self, pu_input, do_input, dt_input):
+        self.check_steps()
+        return self.predict_step(*self.to_tensors(pu_input, do_input, dt_input)).numpy()
+
+    def evaluate(self, pu_input, do_input, dt_input, values):
+        total_time = self.predict(pu_input, do_input, dt_input)
+        return np.sqrt(np.mean(np.square(total_time - np.expand_dims(values, axis=-1))))
@@ -169,8 +169,127 @@ def extract_all_boroughs(conn, table_name, maxLocID=263):
     return boroughs
 
 
+def get_pair_index(PULocID, DOLocID, maxLocID=263):
+    """Obtain the row index into the pair feature table
+    for each (PULocationID, DOLocationID) pair
+
+    :PULocID: list or np array of pick-up location IDs
+    :DOLocID: list or np array of drop-off location IDs
+    :maxLocID: the maximum possible value of location IDs
+    :returns: a numpy array of row indices
+    """
+    return np.asarray(PULocID, dtype=np.int64)*(maxLocID+1) \
+        + np.asarray(DOLocID, dtype=np.int64)
+
+
+def get_extra_pair_features(raw_coords, boros, maxLocID=263):
+    """Obtain the extended static features of every
+    (PULocationID, DOLocationID) pair, namely
+    [great-circle distance (km), initial bearing (degrees),
+    same-borough flag, bridge-crossing flag]
+
+    :raw_coords: list of unnormalized coordinates of locations,
+        as returned by `extract_all_coordinates(normalized=False)`
+    :boros: list of borough labels of locations, where index i
+        holds the one-hot label for borough of locationID i
+    :maxLocID: the maximum possible value of location IDs
+    :returns: a numpy array of dim ((maxLocID+1)**2, 4), with rows
+        ordered as given by `get_pair_index`
+    """
+    num_ids = maxLocID+1
+    PULocID = np.repeat(np.arange(num_ids), num_ids)
+    DOLocID = np.tile(np.arange(num_ids), num_ids)
+
+    # `parser.parse_geo_json` stores GeoJSON positions, which are
+    # (long, lat), under the (lat, long) columns of the table
+    lons = np.radians(raw_coords[:num_ids, 0])
+    lats = np.radians(raw_coords[:num_ids, 1])
+    lat1, lat2 = lats[PULocID], lats[DOLocID]
+    dlon = lons[DOLocID] - lons[PULocID]
+
+    hav = np.sin((lat2-lat1)/2)**2 + np.cos(lat1)*np.cos(lat2)*np.sin(dlon/2)**2
+    distance = 2*6371.0*np.arcsin(np.sqrt(np.clip(hav, 0, 1)))
+    bearing = np.degrees(np.arctan2(
+        np.sin(dlon)*np.cos(lat2),
+        np.cos(lat1)*np.sin(lat2) - np.sin(lat1)*np.cos(lat2)*np.cos(dlon)
+    )) % 360
+
+    # borough labels (0 for unknown) of each location
+    boro_labels = np.where(boros[:num_ids].any(axis=1),
+                           boros[:num_ids].argmax(axis=1)+1, 0)
+    PUBoro = boro_labels[PULocID]
+    DOBoro = boro_labels[DOLocID]
+    same_boro = (PUBoro == DOBoro) & (PUBoro > 0)
+
+    land_connected = np.zeros((7, 7), dtype=bool)
+    for boro1, boro2 in borough_labels.LAND_CONNECTED_BOROUGHS:
+        land_connected[borough_labels.BOROUGHS[boro1], borough_labels.BOROUGHS[boro2]] = True
+        land_connected[borough_labels.BOROUGHS[boro2], borough_labels.BOROUGHS[boro1]] = True
+    crosses_bridge = (PUBoro > 0) & (DOBoro > 0) & ~same_boro \
+        & ~land_connected[PUBoro, DOBoro]
+
+    return np.stack([distance, bearing, same_boro, crosses_bridge], axis=1)
+
+
+def get_pair_feature_table(coords, boros, maxLocID=263, include_loc_ids=True,
+    use_nn_ordering=False, raw_coords=None):
+    """Precompute the static part of the feature vectors (i.e. everything
+    other than the pick-up datetime) for every possible
+    (PULocationID, DOLocationID) pair, laid out in the same column
+    order as in `get_naive_features`
+
+    :coords: list of coordinates of locations, where index i
+        holds the coordinates of locationID i
+    :boros: list of borough labels of locations, where index i
+        holds the one-hot label for borough of locationID i
+    :maxLocID: the maximum possible value of location IDs
+    :include_loc_ids: boolean for whether to include locIds as one-hot
+        in the feature vectors, or not
+    :use_nn_ordering: rearranges returned vectors to better be used by
+        our neural networks
+    :raw_coords: if not None, unnormalized coordinates of locations used
+        to append the features from `get_extra_pair_features` (great-circle
+        distance, bearing, same-borough and bridge-crossing flags) right
+        after the static PU/DO features
+    :returns: a sparse csr_matrix (if include_loc_ids) or a numpy array
+        of dim ((maxLocID+1)**2, num_static_features), with rows
+        ordered as given by `get_pair_index`
+    """
+    num_ids = maxLocID+1
+    PULocID = np.repeat(np.arange(num_ids), num_ids)
+    DOLocID = np.tile(np.arange(num_ids), num_ids)
+    PUCoords = coords[PULocID]
+    DOCoords = coords[DOLocID]
+    PUBoroughs = boros[PULocID]
+    DOBoroughs = boros[DOLocID]
+
+    if include_loc_ids:
+        # location ID 0 is a dummy entry, and gets an all-zero one-hot
+        rows = np.arange(PULocID.shape[0])
+        PUvalid = PULocID > 0
+        DOvalid = DOLocID > 0
+        PULocIDs = sparse.csr_matrix(
+            (np.ones(PUvalid.sum()), (rows[PUvalid], PULocID[PUvalid]-1)),
+            shape=(rows.shape[0], maxLocID))
+        DOLocIDs = sparse.csr_matrix(
+            (np.ones(DOvalid.sum()), (rows[DOvalid], DOLocID[DOvalid]-1)),
+            shape=(rows.shape[0], maxLocID))
+        blocks = [PULocIDs, PUCoords, PUBoroughs, DOLocIDs, DOCoords, DOBoroughs]
+    elif use_nn_ordering:
+        blocks = [PUCoords, PUBoroughs, DOCoords, DOBoroughs]
+    else:
+        blocks = [PUCoords, DOCoords, PUBoroughs, DOBoroughs]
+
+    if raw_coords is not None:
+        blocks.append(get_extra_pair_features(raw_coords, boros, maxLocID))
+
+    if include_loc_ids:
+        return sparse.hstack(blocks, format="csr")
+    return np.hstack(blocks)
+
+
 def get_naive_features(rows, coords, boros, maxLocID=263, datetime_onehot=True, 
-    weekdays_onehot=True, include_loc_ids=True, use_nn_ordering=False):
+    weekdays_onehot=True, include_loc_ids=True, use_nn_ordering=False, pair_table=None):
     """Obtain the naive features to which contain
     the all the information available to us
     in the concatanted vector
@@ -189,6 +308,10 @@ def get_naive_features(rows, coords, boros, maxLocID=263, datetime_onehot=True,
         in the feature vectors, or not
     :use_nn_ordering: rearranges returned vectors to better be used by
         our neural networks
+    :pair_table: if not None, the table from `get_pair_feature_table`
+        (built with the same `include_loc_ids` and `use_nn_ordering`),
+        from which the static features of each ride are gathered
+        instead of being recomputed
     :returns: a sparse csr_matrix for the feature vectors(if we use any hot rep)
         or a numpy array for the features vectors, 
         and a np array for the time taken in seconds
@@ -204,27 +327,39 @@ def get_naive_features(rows, coords, boros, maxLocID=263, datetime_onehot=True,
     PUDatetime = obtain_date_time_features(p_datetime, datetime_onehot, weekdays_onehot)
     PULocID = list(map(int, rows[:, 2]))
     DOLocID = list(map(int, rows[:, 3]))
-    PUCoords = np.array([coords[i] for i in PULocID])
-    DOCoords = np.array([coords[i] for i in DOLocID])
-    PUBoroughs = np.array([boros[i] for i in PULocID])
-    DOBoroughs = np.array([boros[i] for i in DOLocID])
-    
-    if include_loc_ids:
-        PULocID = get_one_hot(PULocID, 1, maxLocID)
-        DOLocID = get_one_hot(DOLocID, 1, maxLocID)
-        feature_vectors = sparse.hstack([PULocID, PUCoords, PUBoroughs, 
-            DOLocID, DOCoords, DOBoroughs, PUDatetime], format="csr")
-    elif datetime_onehot or weekdays_onehot:
-        if use_nn_ordering:
-            feature_vectors = sparse.hstack([PUCoords, PUBoroughs, DOCoords, DOBoroughs, PUDatetime], format="csr")
-        else:
-            feature_vectors = sparse.hstack([PUDatetime, PUCoords, DOCoords, PUBoroughs, DOBoroughs], format="csr")
 
+    if pair_table is not None:
+        static_features = pair_table[get_pair_index(PULocID, DOLocID, maxLocID)]
+        if include_loc_ids or use_nn_ordering:
+            blocks = [static_features, PUDatetime]
+        else:
+            blocks = [PUDatetime, static_features]
+        if include_loc_ids or datetime_onehot or weekdays_onehot:
+            feature_vectors = sparse.hstack(blocks, format="csr")
+        else:
+            feature_vectors = np.hstack(blocks)
     else:
-        if use_nn_ordering:
-            feature_vectors = np.hstack([PUCoords, PUBoroughs, DOCoords, DOBoroughs, PUDatetime])
+        PUCoords = np.array([coords[i] for i in PULocID])
+        DOCoords = np.array([coords[i] for i in DOLocID])
+        PUBoroughs = np.array([boros[i] for i in PULocID])
+        DOBoroughs = np.array([boros[i] for i in DOLocID])
+
+        if include_loc_ids:
+            PULocID = get_one_hot(PULocID, 1, maxLocID)
+            DOLocID = get_one_hot(DOLocID, 1, maxLocID)
+            feature_vectors = sparse.hstack([PULocID, PUCoords, PUBoroughs, 
+                DOLocID, DOCoords, DOBoroughs, PUDatetime], format="csr")
+        elif datetime_onehot or weekdays_onehot:
+            if use_nn_ordering:
+                feature_vectors = sparse.hstack([PUCoords, PUBoroughs, DOCoords, DOBoroughs, PUDatetime], format="csr")
+            else:
+                feature_vectors = sparse.hstack([PUDatetime, PUCoords, DOCoords, PUBoroughs, DOBoroughs], format="csr")
+
         else:
-            feature_vectors = np.hstack([PUDatetime, PUCoords, DOCoords, PUBoroughs, DOBoroughs])
+            if use_nn_ordering:
+                feature_vectors = np.hstack([PUCoords, PUBoroughs, DOCoords, DOBoroughs, PUDatetime])
+            else:
+                feature_vectors = np.hstack([PUDatetime, PUCoords, DOCoords, PUBoroughs, DOBoroughs])
 
     delta = np.array([datetime.timedelta(
         days=d_datetime[0][i]-p_datetime[0][i],
@@ -329,11 +464,30 @@ def get_significant_data(features, values, cutoff):
 
 
 
-def extract_all_features(conn, table_name, coords_table_name='coordinates', boros_table_name='locations',
+def create_pickup_index(conn, table_name):
+    """Creates an index on the pickup datetimes of the given
+    table (unless already existing), so that the rides after
+    a watermark can be read without scanning the whole table
+
+    :conn: connection object to the database
+    :table_name: name of the table holding the rides data
+    """
+    cursor = conn.cursor()
+    cursor.execute(f'CREATE INDEX IF NOT EXISTS {table_name}_pickup_idx '
+                   f'ON {table_name} (tpep_pickup_datetime)')
+    conn.commit()
+
+
+def extract_block_features(conn, table_name, coords_table_name='coordinates', boros_table_name='locations',
     datetime_onehot=True, weekdays_onehot=True, include_loc_ids=True, start_super_boro=None,
-    end_super_boro=None, cutoff_val=1e5, two_way=True, use_nn_ordering=False):
-    """Extracts the features from all the data entries 
-    in the given table of the database
+    end_super_boro=None, cutoff_val=1e5, two_way=True, use_nn_ordering=False,
+    extra_pair_features=False, block_size=1e6, after_datetime=None, seen=None):
+    """Extracts the features from all the data entries
+    in the given table of the database, one block of
+    rows at a time and in table order, so that the whole
+    table can be streamed with bounded memory. The blocks
+    are ranges of rowids, which SQLite seeks to directly
+    instead of skipping over all the preceding rows
 
     :conn: connection object to the database
     :table_name: name of the table holding the rides data
@@ -352,16 +506,22 @@ def extract_all_features(conn, table_name, coords_table_name='coordinates', boro
     :cutoff_val: the cutoff value for an output to be significant
     :two_way: whether or not to include rides starting in end_super_bro and starting in start_super_boro
     :use_nn_ordering: whether or not to rearrange feature vectors to be used by our neural network
-    :returns: a sparse csr_matrix containing the feature vectors
-        and a numpy array containing the corresponding values
-        of the travel time
+    :extra_pair_features: whether or not to append the features from
+        `get_extra_pair_features`, laid out as in `get_pair_feature_table`
+    :block_size: the number of table rowids read per block
+    :after_datetime: if not None, only rides picked up strictly after this
+        datetime string (e.g. a watermark recorded by `xgb_save_model`) are extracted
+    :seen: if not None, a dictionary in which the latest pickup
+        datetime string of the rides read is kept under 'watermark',
+        which marks the rides a model trained on them has seen
+    :returns: a generator that yields the features of each
+        (non-empty) block as a (features, outputs) pair
     """
     assert not (start_super_boro is not None and end_super_boro is None),\
             'start_super_boro set without end_super_boro.'
     assert not (start_super_boro is None and end_super_boro is not None),\
             'end_super_boro set without start_super_boro.'
-    offset = 0
-    limit = 1e6
+    limit = int(block_size)
     batch_num = 0
     cursor = conn.cursor()
 
@@ -371,32 +531,44 @@ def extract_all_features(conn, table_name, coords_table_name='coordinates', boro
     # extracting boroughs for all locations
     boros = extract_all_boroughs(conn, boros_table_name)
 
-    count_cmd = (f'SELECT COUNT(PULocationID) FROM {table_name} ')
+    # precomputing the static features of every (PU, DO) pair
+    raw_coords = extract_all_coordinates(conn, coords_table_name, normalized=False) \
+        if extra_pair_features else None
+    pair_table = get_pair_feature_table(coords, boros, include_loc_ids=include_loc_ids,
+                                        use_nn_ordering=use_nn_ordering, raw_coords=raw_coords)
+
+    # The watermark is bound as a parameter of the queries
+    after_filter = 'AND tpep_pickup_datetime > ? ' if after_datetime is not None else ''
+    after_params = (after_datetime,) if after_datetime is not None else ()
+
+    # Both are read from the rowid index, without a table scan
     try:
-        cursor.execute(count_cmd)
+        cursor.execute(f'SELECT MIN(rowid), MAX(rowid) FROM {table_name}')
     except Error as e:
         print(e)
-    NUM_ROWS = cursor.fetchone()[0]
-    assert type(NUM_ROWS) is int, f'cursor.fetchone() has returned {type(NUM_ROWS)} instead of an int.'
+    MIN_ROWID, MAX_ROWID = cursor.fetchone()
+    if MIN_ROWID is None:
+        return
 
     print("Extracting data in batches of size {}".format(limit))
     stop_condition = False
-    set_flag = False
-    while batch_num*limit < NUM_ROWS:
+    while MIN_ROWID + batch_num*limit <= MAX_ROWID:
         print("Reading data for batch number {}".format(batch_num))
+        start_rowid = MIN_ROWID + batch_num*limit
         command = ('SELECT tpep_pickup_datetime, tpep_dropoff_datetime, '
                    'PULocationID, DOLocationID '
                    f'FROM {table_name} '
-                   f'WHERE PULocationID < 264 '
+                   f'WHERE rowid >= {start_rowid} '
+                   f'AND rowid < {start_rowid + limit} '
+                   f'AND PULocationID < 264 '
                    f'AND DOLocationID < 264 '
-                   f'LIMIT {limit} '
-                   f'OFFSET {offset}')
+                   f'{after_filter}')
 
         if start_super_boro is not None and end_super_boro is not None:
             command = filter_for_boros(command, start_super_boro, end_super_boro, two_way)
         
         try:
-            cursor.execute(command)
+            cursor.execute(command, after_params)
         except sqlite3.Error as e:
             print(e)
             stop_condition = True
@@ -408,31 +580,74 @@ def extract_all_features(conn, table_name, coords_table_name='coordinates', boro
         
         rows = np.array(cursor.fetchall())
         if len(rows) == 0:
-            offset += limit
             continue
+        if seen is not None:
+            watermark = str(max(rows[:, 0]))
+            if seen.get('watermark') is None or watermark > seen['watermark']:
+                seen['watermark'] = watermark
 
         print("Extracting features from the read data")
-        if not set_flag:
-            features, outputs = get_naive_features(rows, coords, boros, 
-                                    datetime_onehot=datetime_onehot, 
-                                    weekdays_onehot=weekdays_onehot, 
-                                    include_loc_ids=include_loc_ids,
-                                    use_nn_ordering=use_nn_ordering)
-            features, outputs = get_significant_data(features, outputs, cutoff_val)
-            set_flag = True
+        features, outputs = get_naive_features(rows, coords, boros, 
+                                datetime_onehot=datetime_onehot, 
+                                weekdays_onehot=weekdays_onehot, 
+                                include_loc_ids=include_loc_ids,
+                                use_nn_ordering=use_nn_ordering,
+                                pair_table=pair_table)
+        yield get_significant_data(features, outputs, cutoff_val)
+
+
+def extract_all_features(conn, table_name, coords_table_name='coordinates', boros_table_name='locations',
+    datetime_onehot=True, weekdays_onehot=True, include_loc_ids=True, start_super_boro=None,
+    end_super_boro=None, cutoff_val=1e5, two_way=True, use_nn_ordering=False,
+    extra_pair_features=False, after_datetime=None, seen=None):
+    """Extracts the features from all the data entries 
+    in the given table of the database
+
+    :conn: connection object to the database
+    :table_name: name of the table holding the rides data
+    :coords_table_name: name of the table holding the coordinates data
+    :boross_table_name: name of the table holding the boroughs data
+    :datetime_onehot: boolean for whether we want a onehot representation for
+        date and time values, or a single index one
+    :weekdays_onehot: boolean for whether we want a onehot representation for
+        day of the week value, or a single index one
+    :include_loc_ids: boolean for whether to include locIds as one-hot
+        in the feature vectors, or not 
+    :start_super_boro: if not None, a list of strings representing the boros that all rides should
+        start and end in. If not None, end_super_boro should also not be None.
+    :end_super_boro: if not None, a list of strings representing the boros that all rides should
+        start and end in. If not None, start_super_boro should also not be None.
+    :cutoff_val: the cutoff value for an output to be significant
+    :two_way: whether or not to include rides starting in end_super_bro and starting in start_super_boro
+    :use_nn_ordering: whether or not to rearrange feature vectors to be used by our neural network
+    :extra_pair_features: whether or not to append the features from
+        `get_extra_pair_features`, laid out as in `get_pair_feature_table`
+    :after_datetime: if not None, only rides picked up strictly after this
+        datetime string (e.g. a watermark recorded by `xgb_save_model`) are extracted
+    :seen: if not None, a dictionary in which the latest pickup
+        datetime string of the rides read is kept under 'watermark',
+        which marks the rides a model trained on them has seen
+    :returns: a sparse csr_matrix containing the feature vectors
+        and a numpy array containing the corresponding values
+        of the travel time (both None if no ride matches)
+    """
+    features, outputs = None, None
+    for features_sample, outputs_sample in extract_block_features(
+            conn, table_name, coords_table_name=coords_table_name, boros_table_name=boros_table_name,
+            datetime_onehot=datetime_onehot, weekdays_onehot=weekdays_onehot,
+            include_loc_ids=include_loc_ids, start_super_boro=start_super_boro,
+            end_super_boro=end_super_boro, cutoff_val=cutoff_val, two_way=two_way,
+            use_nn_ordering=use_nn_ordering, extra_pair_features=extra_pair_features,
+            after_datetime=after_datetime, seen=seen):
+        if features is None:
+            features, outputs = features_sample, outputs_sample
+        elif isinstance(features, np.ndarray) \
+            and isinstance(features_sample, np.ndarray):
+            features = np.vstack([features, features_sample])
+            outputs = np.concatenate((outputs, outputs_sample))
         else:
-            features_sample, outputs_sample = get_naive_features(rows, coords, boros, 
-                                                datetime_onehot=datetime_onehot, 
-                                                weekdays_onehot=weekdays_onehot, 
-                                                include_loc_ids=include_loc_ids)
-            features_sample, outputs_sample = get_significant_data(features_sample, outputs_sample, cutoff_val)
-            if isinstance(features, np.ndarray) \
-                and isinstance(features_sample, np.ndarray):
-                features = np.vstack([features, features_sample])
-            else:
-                features = sparse.vstack([features, features_sample], format="csr")
+            features = sparse.vstack([features, features_sample], format="csr")
             outputs = np.concatenate((outputs, outputs_sample))
-        offset += limit
 
     return features, outputs
 
@@ -440,7 +655,8 @@ def extract_all_features(conn, table_name, coords_table_name='coordinates', boro
 def extract_random_data_features(conn, table_name, random_size, 
     coords_table_name='coordinates', boros_table_name='locations', 
     start_super_boro=None, end_super_boro=None, datetime_onehot=True, weekdays_onehot=True, 
-    include_loc_ids=True, cutoff_val=1e5, two_way=True, use_nn_ordering=False):
+    include_loc_ids=True, cutoff_val=1e5, two_way=True, use_nn_ordering=False,
+    extra_pair_features=False):
     """Extracts the features from a random batch of data 
     from the table of the database
 
@@ -462,6 +678,8 @@ def extract_random_data_features(conn, table_name, random_size,
     :cutoff_val: the cutoff value for an output to be significant
     :two_way: whether or not to include rides starting in end_super_bro and starting in start_super_boro
     :use_nn_ordering: whether or not to rearrange feature vectors to be used by our neural network
+    :extra_pair_features: whether or not to append the features from
+        `get_extra_pair_features`, laid out as in `get_pair_feature_table`
     :returns: a sparse csr_matrix containing the feature vectors
         and a numpy array containing the corresponding values
         of the travel time
@@ -479,6 +697,12 @@ def extract_random_data_features(conn, table_name, random_size,
     # extracting boroughs for all locations
     boros = extract_all_boroughs(conn, boros_table_name)
 
+    # precomputing the static features of every (PU, DO) pair
+    raw_coords = extract_all_coordinates(conn, coords_table_name, normalized=False) \
+        if extra_pair_features else None
+    pair_table = get_pair_feature_table(coords, boros, include_loc_ids=include_loc_ids,
+                                        use_nn_ordering=use_nn_ordering, raw_coords=raw_coords)
+
     command = ('SELECT tpep_pickup_datetime, tpep_dropoff_datetime, '
                'PULocationID, DOLocationID '
                f'FROM {table_name} '
@@ -505,7 +729,7 @@ def extract_random_data_features(conn, table_name, random_size,
     print("Making feature vectors from the extracted data")
     features, outputs = get_naive_features(rows, coords, boros, datetime_onehot=datetime_onehot, 
                             weekdays_onehot=weekdays_onehot, include_loc_ids=include_loc_ids,
-                            use_nn_ordering=use_nn_ordering)
+                            use_nn_ordering=use_nn_ordering, pair_table=pair_table)
 
     features, outputs = get_significant_data(features, outputs, cutoff_val)
     return features, outputs
@@ -515,7 +739,8 @@ def extract_batch_features(conn, table_name, batch_size, block_size,
     coords_table_name='coordinates', boros_table_name='locations',
     datetime_onehot=True, weekdays_onehot=True, include_loc_ids=True,
     replace_blk=False, verbose=False, start_super_boro=None,
-    end_super_boro=None, cutoff_val=1e5, two_way=True, use_nn_ordering=False):
+    end_super_boro=None, cutoff_val=1e5, two_way=True, use_nn_ordering=False,
+    extra_pair_features=False):
     """Extracts the features from a batch of data
     from the table of the database, without shuffling
 
@@ -542,6 +767,8 @@ def extract_batch_features(conn, table_name, batch_size, block_size,
     :cutoff_val: the cutoff value for an output to be significant
     :two_way: whether or not to include rides starting in end_super_bro and starting in start_super_boro
     :use_nn_ordering: whether or not to rearrange feature vectors to be used by our neural network
+    :extra_pair_features: whether or not to append the features from
+        `get_extra_pair_features`, laid out as in `get_pair_feature_table`
     :returns: a generator that yields each minibatch
         as a (features, outputs) pair.
     """
@@ -558,6 +785,12 @@ def extract_batch_features(conn, table_name, batch_size, block_size,
     # extracting boroughs for all locations
     boros = extract_all_boroughs(conn, boros_table_name)
 
+    # precomputing the static features of every (PU, DO) pair
+    raw_coords = extract_all_coordinates(conn, coords_table_name, normalized=False) \
+        if extra_pair_features else None
+    pair_table = get_pair_feature_table(coords, boros, include_loc_ids=include_loc_ids,
+                                        use_nn_ordering=use_nn_ordering, raw_coords=raw_coords)
+
     if verbose:
         count_start = time()
     count_cmd = (f'SELECT COUNT(PULocationID) FROM {table_name} ')
@@ -612,12 +845,14 @@ def extract_batch_features(conn, table_name, batch_size, block_size,
             preproc_start = time()
             if i == 0:
                 features, outputs = get_naive_features(rows, coords, boros, datetime_onehot=datetime_onehot, 
-                                        weekdays_onehot=weekdays_onehot, include_loc_ids=include_loc_ids, use_nn_ordering=use_nn_ordering)
+                                        weekdays_onehot=weekdays_onehot, include_loc_ids=include_loc_ids, use_nn_ordering=use_nn_ordering,
+                                        pair_table=pair_table)
                 if verbose:
                     print(f">>> Time taken for preproc: {time() - preproc_start} seconds")
             else:
                 features_sample, outputs_sample = get_naive_features(rows, coords, boros, datetime_onehot=datetime_onehot, 
-                                                    weekdays_onehot=weekdays_onehot, include_loc_ids=include_loc_ids)
+                                                    weekdays_onehot=weekdays_onehot, include_loc_ids=include_loc_ids,
+                                                    use_nn_ordering=use_nn_ordering, pair_table=pair_table)
                 if verbose:
                     print(f">>> Time taken for preproc: {time() - preproc_start} seconds")
                 if isinstance(features, np.ndarray) \
@@ -635,7 +870,7 @@ def extract_batch_features(conn, table_name, batch_size, block_size,
 def extract_features(conn, table_name, variant='all', size=None, block_size=None, 
     datetime_onehot=True, weekdays_onehot=True, include_loc_ids=True, start_super_boro=None, 
     end_super_boro=None, stddev_multiplier=1, cutoff_data_csv='./data_analysis/multiplier_tbl.csv', two_way=True,
-    use_nn_ordering=False):
+    use_nn_ordering=False, extra_pair_features=False, after_datetime=None, seen=None):
     """Reads the data from the database and obtains the features
 
     :conn: connection object to the database
@@ -647,10 +882,12 @@ def extract_features(conn, table_name, variant='all', size=None, block_size=None
             - batch: Extracts the features from a batch of data
             from the table of the database, without shuffling, and 
             returns a generator for it
+            - stream : extracts features from all the data, in table
+            order, and returns a generator over blocks of them
     :size: the size of the batch of data
         (Used only if variant='random' or 'batch')
     :block_size: the size of blocks
-        (Used only if variant='batch')
+        (Used only if variant='batch' or 'stream')
     :datetime_onehot: boolean for whether we want a onehot represnetation for
         date and time values, or a single index one
     :weekdays_onehot: boolean for whether we want a onehot represnetation for
@@ -665,10 +902,19 @@ def extract_features(conn, table_name, variant='all', size=None, block_size=None
     :cutoff_data_csv: the csv file containing the cutoff for different multiplier values
     :two_way: whether or not to include rides starting in end_super_bro and starting in start_super_boro
     :use_nn_ordering: whether or not to rearrange feature vectors to be used by our neural network
+    :extra_pair_features: whether or not to append the features from
+        `get_extra_pair_features`, laid out as in `get_pair_feature_table`
+    :after_datetime: if not None, only rides picked up strictly after this
+        datetime string are extracted (Used only if variant='all' or 'stream')
+    :seen: if not None, a dictionary in which the latest pickup
+        datetime string of the rides read is kept under 'watermark'
+        (Used only if variant='all' or 'stream')
     :returns: a sparse csr_matrix containing the feature vectors
         and a numpy array containing the corresponding values
         of the travel time
     """
+    if after_datetime is not None and variant not in ['all', 'stream']:
+        sys.exit("after_datetime is only supported for variants 'all' and 'stream'.")
 
     cutoff_val = get_cutoff_value(stddev_multiplier, cutoff_data_csv)
 
@@ -676,7 +922,9 @@ def extract_features(conn, table_name, variant='all', size=None, block_size=None
         print('Extracting features from all the data in {}'.format(table_name))
         features, outputs = extract_all_features(conn, table_name, datetime_onehot=datetime_onehot, 
                                 weekdays_onehot=weekdays_onehot, include_loc_ids=include_loc_ids, start_super_boro=start_super_boro, 
-                                end_super_boro=end_super_boro, cutoff_val=cutoff_val, two_way=two_way, use_nn_ordering=use_nn_ordering)
+                                end_super_boro=end_super_boro, cutoff_val=cutoff_val, two_way=two_way, use_nn_ordering=use_nn_ordering,
+                                extra_pair_features=extra_pair_features, after_datetime=after_datetime,
+                                seen=seen)
 
     elif variant == 'random':
         if not isinstance(size, int):
@@ -684,7 +932,8 @@ def extract_features(conn, table_name, variant='all', size=None, block_size=None
         print('Extracting features from a random batch of data of size {} in {}'.format(size, table_name))
         features, outputs = extract_random_data_features(conn, table_name, size, datetime_onehot=datetime_onehot, 
                                 weekdays_onehot=weekdays_onehot, include_loc_ids=include_loc_ids, start_super_boro=start_super_boro,
-                                end_super_boro=end_super_boro, cutoff_val=cutoff_val, two_way=two_way, use_nn_ordering=use_nn_ordering)
+                                end_super_boro=end_super_boro, cutoff_val=cutoff_val, two_way=two_way, use_nn_ordering=use_nn_ordering,
+                                extra_pair_features=extra_pair_features)
 
     elif variant == 'batch':
         if size is None:
@@ -696,10 +945,21 @@ def extract_features(conn, table_name, variant='all', size=None, block_size=None
         print('Extracting features from a batch of data of size {} block_size in {}'.format(size, block_size, table_name))
         return extract_batch_features(conn, table_name, size, block_size, datetime_onehot=datetime_onehot,
                     weekdays_onehot=weekdays_onehot, include_loc_ids=include_loc_ids,replace_blk=True, verbose=False,
-                    start_super_boro=start_super_boro, end_super_boro=end_super_boro, cutoff_val=cutoff_val, two_way=two_way, use_nn_ordering=use_nn_ordering)
+                    start_super_boro=start_super_boro, end_super_boro=end_super_boro, cutoff_val=cutoff_val, two_way=two_way, use_nn_ordering=use_nn_ordering,
+                    extra_pair_features=extra_pair_features)
+
+    elif variant == 'stream':
+        if block_size is None:
+            sys.exit("Please provide an block_size value.")
+        print('Streaming features from all the data in {} in blocks of size {}'.format(table_name, block_size))
+        return extract_block_features(conn, table_name, datetime_onehot=datetime_onehot,
+                    weekdays_onehot=weekdays_onehot, include_loc_ids=include_loc_ids, start_super_boro=start_super_boro,
+                    end_super_boro=end_super_boro, cutoff_val=cutoff_val, two_way=two_way, use_nn_ordering=use_nn_ordering,
+                    extra_pair_features=extra_pair_features, block_size=block_size, after_datetime=after_datetime,
+                    seen=seen)
     
     else:
-        sys.exit("Type must be one of {'all', 'random', 'batch'}.")
+        sys.exit("Type must be one of {'all', 'random', 'batch', 'stream'}.")
 
     return features, outputs
 
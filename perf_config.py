@@ -0,0 +1,195 @@
+import os
+import sys
+import json
+import resource
+from time import time
+
+import tensorflow as tf
+
+
+def add_perf_arguments(parser):
+    """Adds the CPU performance arguments to a script's parser
+
+    :parser: argparse.ArgumentParser of the script
+    """
+    parser.add_argument("--intra-op-threads", type=int, default=0,
+                        help="threads used within an op (0: one per core, TF's default)")
+    parser.add_argument("--inter-op-threads", type=int, default=0,
+                        help="ops run concurrently (0: TF's default)")
+    parser.add_argument("--bfloat16", default=False, action='store_true',
+                        help="train with bfloat16 mixed precision, "
+                             "if the CPU supports bfloat16 natively")
+    parser.add_argument("--batch-autotune-mb", type=int, default=0,
+                        help="pick the largest batch size whose training steps "
+                             "stay within this many MB of memory (0: off)")
+
+
+def cpu_supports_bfloat16():
+    """Whether the CPU has native bfloat16 instructions (AVX512-BF16 or
+    AMX), without which bfloat16 is emulated and slower than float32
+
+    :returns: Boolean
+    """
+    try:
+        with open("/proc/cpuinfo", "r") as cpuinfo:
+            flags = cpuinfo.read()
+    except OSError:
+        return False
+    return "avx512_bf16" in flags or "amx_bf16" in flags
+
+
+def onednn_enabled():
+    """Whether TF runs its CPU ops through oneDNN. TF reads
+    TF_ENABLE_ONEDNN_OPTS when it is imported, so it has to be set
+    in the environment of the script; it is on by default on x86
+    Linux since TF 2.9.
+
+    :returns: Boolean
+    """
+    setting = os.environ.get("TF_ENABLE_ONEDNN_OPTS")
+    if setting is not None:
+        return setting == "1"
+    major, minor = (int(v) for v in tf.__version__.split(".")[:2])
+    return sys.platform.startswith("linux") and (major, minor) >= (2, 9)
+
+
+def apply_perf_config(args):
+    """Configures TF from the arguments of `add_perf_arguments`. Has
+    to run before TF executes any op, i.e. at the start of `main`.
+    bfloat16 only covers the hidden layers: `models` keeps the outputs
+    of the boro models and of the selector softmax in float32.
+
+    :args: Parsed arguments
+    :returns: Dictionary of the applied configuration
+    """
+    if args.intra_op_threads > 0:
+        tf.config.threading.set_intra_op_parallelism_threads(args.intra_op_threads)
+    if args.inter_op_threads > 0:
+        tf.config.threading.set_inter_op_parallelism_threads(args.inter_op_threads)
+
+    precision = "float32"
+    if args.bfloat16:
+        if cpu_supports_bfloat16():
+            tf.keras.mixed_precision.set_global_policy("mixed_bfloat16")
+            precision = "mixed_bfloat16"
+        else:
+            print("WARNING: The CPU has no native bfloat16 support, "
+                  "training in float32 instead")
+
+    config = {
+        "intra_op_threads": tf.config.threading.get_intra_op_parallelism_threads(),
+        "inter_op_threads": tf.config.threading.get_inter_op_parallelism_threads(),
+        "precision":        precision,
+        "onednn":           onednn_enabled(),
+        "cpu_count":        os.cpu_count(),
+    }
+    print(f"Performance configuration: {config}")
+    return config
+
+
+def save_perf_config(path, config, **results):
+    """Stores the configuration along with its results (e.g. samples/sec)
+
+    :path: Path to the .json file
+    :config: Dictionary returned by `apply_perf_config`
+    :results: Values to store along with it
+    """
+    with open(path, "w") as config_file:
+        json.dump({**config, **results}, config_file, indent=4, sort_keys=True)
+
+
+def current_rss_mb():
+    """
+    :returns: The resident memory of the process, in MB, or None
+        where /proc/self/statm is missing (i.e. outside of Linux)
+    """
+    try:
+        with open("/proc/self/statm", "r") as statm:
+            resident_pages = int(statm.read().split()[1])
+    except OSError:
+        return None
+    return resident_pages * os.sysconf("SC_PAGE_SIZE") / 2**20
+
+
+def reset_peak_rss():
+    """Resets the peak resident memory of the process to its current
+    resident memory, which Linux supports since 4.0
+
+    :returns: Whether the peak was reset
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as clear_refs:
+            clear_refs.write("5")
+    except OSError:
+        return False
+    return True
+
+
+def peak_rss_mb():
+    """
+    :returns: The peak resident memory of the process, in MB, since
+        it started or since the last `reset_peak_rss`
+    """
+    try:
+        with open("/proc/self/status", "r") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 2**10
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kB on Linux, bytes on macOS
+    return peak / 2**20 if sys.platform == "darwin" else peak / 2**10
+
+
+def autotune_batch_size(train_step, make_batch, memory_budget_mb,
+                        min_batch_size=256, max_batch_size=2**16, num_steps=5):
+    """Finds the largest batch size, among powers of two times
+    `min_batch_size`, whose training steps stay within the memory
+    budget. The memory of a batch size is the peak resident memory
+    of its steps over the resident memory before tuning, the peak
+    being reset before every batch size. Outside of Linux, it is the
+    growth of the peak of the process since tuning started instead,
+    which misses the memory of batch sizes staying below an earlier
+    peak.
+
+    :train_step: Function running a training step on a batch
+    :make_batch: Function returning a batch of the given size
+    :memory_budget_mb: Memory budget of training, in MB
+    :min_batch_size, max_batch_size: Range of the batch sizes
+    :num_steps: Number of steps timed per batch size
+    :returns: Tuple of (batch size, list of the dictionaries
+        describing every batch size tried)
+    """
+    baseline_mb = current_rss_mb()
+    if baseline_mb is None:
+        baseline_mb = peak_rss_mb()
+    best_batch_size = min_batch_size
+    results = []
+
+    batch_size = min_batch_size
+    while batch_size <= max_batch_size:
+        reset_peak_rss()
+        batch = make_batch(batch_size)
+        # The first step traces the graph for the new batch shape
+        train_step(batch)
+        start_time = time()
+        for _ in range(num_steps):
+            train_step(batch)
+        duration = time() - start_time
+        memory_mb = peak_rss_mb() - baseline_mb
+
+        results.append({
+            "batch_size":      batch_size,
+            "memory_mb":       memory_mb,
+            "samples_per_sec": num_steps*batch_size / duration,
+        })
+        print(f"Batch size {batch_size}: {memory_mb:.1f} MB, "
+              f"{results[-1]['samples_per_sec']:.1f} samples/sec")
+        if memory_mb > memory_budget_mb:
+            break
+        best_batch_size = batch_size
+        batch_size *= 2
+
+    print(f"Using batches of {best_batch_size} for a budget of {memory_budget_mb} MB")
+    return best_batch_size, results
@@ -0,0 +1,234 @@
+import math
+import numpy as np
+
+
+class ExactSum:
+    """Exact sum of float64 values. Every finite double is an integer
+    multiple of 2**-1126 (a 53-bit integer mantissa times a power of
+    two, down to the subnormals), so the sum is kept as such a Python
+    integer, whatever the number of values. It does not depend on the
+    order the values are added or merged in, and is rounded to float64
+    only once, when reported. Non-finite values are summed apart."""
+
+    # frexp exponent of the smallest subnormal, plus the mantissa bits
+    SCALE_BITS = 1073 + 53
+
+    def __init__(self):
+        self.total = 0
+        self.nonfinite = 0.0
+
+    def add(self, values):
+        """
+        :values: np.array of the values to add
+        """
+        values = np.asarray(values, dtype=np.float64).ravel()
+        finite = np.isfinite(values)
+        if not finite.all():
+            self.nonfinite += float(np.sum(values[~finite]))
+            values = values[finite]
+        if values.shape[0] == 0:
+            return
+
+        # values = mantissas * 2**(shifts - SCALE_BITS), exactly
+        mantissas, exponents = np.frexp(values)
+        mantissas = (mantissas * 2.0**53).astype(np.int64)
+        shifts = exponents.astype(np.int64) + 1073
+
+        # Sums the mantissas of every exponent in int64, split into
+        # halves of 27 and 26 bits so that they can not overflow
+        order = np.argsort(shifts, kind="stable")
+        shifts, mantissas = shifts[order], mantissas[order]
+        starts = np.flatnonzero(np.r_[True, shifts[1:] != shifts[:-1]])
+        high_sums = np.add.reduceat(mantissas >> 26, starts)
+        low_sums = np.add.reduceat(mantissas & (2**26 - 1), starts)
+        for shift, high_sum, low_sum in zip(shifts[starts].tolist(), high_sums.tolist(),
+                                            low_sums.tolist()):
+            self.total += ((high_sum << 26) + low_sum) << shift
+
+    def merge(self, other):
+        """
+        :other: ExactSum to add
+        :returns: self
+        """
+        self.total += other.total
+        self.nonfinite += other.nonfinite
+        return self
+
+    def value(self):
+        """
+        :returns: The sum, correctly rounded to float64
+        """
+        return self.total / (1 << self.SCALE_BITS) + self.nonfinite
+
+    def mean(self, count):
+        """
+        :count: Number of values summed
+        :returns: The sum divided by count, correctly rounded to float64
+        """
+        return self.total / (count << self.SCALE_BITS) + self.nonfinite / count
+
+
+class ErrorStats:
+    """Streaming statistics of the errors of predicted trip durations.
+
+    The sums of the errors, absolute errors and squared errors are
+    kept exactly (see `ExactSum`), so that the RMSE of many batches
+    is that of all their errors, whatever the batches, and not one
+    derived from the running RMSEs. Only the squares are rounded,
+    each to float64. The MSE is then the correctly rounded mean of
+    those squares, which can differ in the last digits from the
+    (order-dependent) float sum of the squared errors. The quantiles
+    of the absolute errors come from a logarithmic sketch with
+    buckets of bounded relative width. Non-finite errors (of NaN or
+    infinite predictions) only enter the sums, so that the RMSE shows
+    them, and are counted apart from the sketch and the min/max of
+    the finite errors. All statistics can be merged,
+    e.g. from the (start, end) pairs into a global report, or across
+    processes."""
+
+    def __init__(self, relative_accuracy=0.01):
+        """
+        :relative_accuracy: Maximum relative error of the quantiles
+        """
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.count = 0
+        self.squared_error_sum = ExactSum()
+        self.error_sum = ExactSum()
+        self.absolute_error_sum = ExactSum()
+        self.min_error = math.inf
+        self.max_error = -math.inf
+        # bucket i holds absolute errors in (gamma**(i-1), gamma**i]
+        self.buckets = {}
+        self.zero_count = 0
+        self.nonfinite_count = 0
+
+    def update(self, predictions, values):
+        """Adds a batch of predictions
+
+        :predictions: np.array of the predicted durations
+        :values: np.array of the actual durations
+        """
+        errors = np.asarray(predictions, dtype=np.float64).ravel() \
+                 - np.asarray(values, dtype=np.float64).ravel()
+        if errors.shape[0] == 0:
+            return
+        absolute_errors = np.abs(errors)
+
+        self.count += errors.shape[0]
+        self.squared_error_sum.add(errors**2)
+        self.error_sum.add(errors)
+        self.absolute_error_sum.add(absolute_errors)
+
+        finite = np.isfinite(errors)
+        self.nonfinite_count += errors.shape[0] - int(finite.sum())
+        if not finite.all():
+            errors = errors[finite]
+            absolute_errors = absolute_errors[finite]
+            if errors.shape[0] == 0:
+                return
+        self.min_error = min(self.min_error, float(errors.min()))
+        self.max_error = max(self.max_error, float(errors.max()))
+
+        nonzero = absolute_errors[absolute_errors > 0]
+        self.zero_count += errors.shape[0] - nonzero.shape[0]
+        indices, counts = np.unique(np.ceil(np.log(nonzero) / np.log(self.gamma)).astype(np.int64),
+                                    return_counts=True)
+        for index, count in zip(indices.tolist(), counts.tolist()):
+            self.buckets[index] = self.buckets.get(index, 0) + count
+
+    def merge(self, other):
+        """Adds the statistics of another `ErrorStats` with the same accuracy
+
+        :other: ErrorStats
+        :returns: self
+        """
+        assert other.gamma == self.gamma, \
+            "ERROR: Only statistics of the same accuracy can be merged"
+        self.count += other.count
+        self.squared_error_sum.merge(other.squared_error_sum)
+        self.error_sum.merge(other.error_sum)
+        self.absolute_error_sum.merge(other.absolute_error_sum)
+        self.min_error = min(self.min_error, other.min_error)
+        self.max_error = max(self.max_error, other.max_error)
+        self.zero_count += other.zero_count
+        self.nonfinite_count += other.nonfinite_count
+        for index, count in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + count
+        return self
+
+    def sse(self):
+        return self.squared_error_sum.value()
+
+    def mse(self):
+        return self.squared_error_sum.mean(self.count) if self.count > 0 else math.nan
+
+    def rmse(self):
+        return math.sqrt(self.mse())
+
+    def mae(self):
+        return self.absolute_error_sum.mean(self.count) if self.count > 0 else math.nan
+
+    def bias(self):
+        """The mean of the predictions minus the actual durations"""
+        return self.error_sum.mean(self.count) if self.count > 0 else math.nan
+
+    def quantile(self, q):
+        """Approximates a quantile of the finite absolute errors, within
+        `relative_accuracy` of the one of rank q*(number of them - 1)
+
+        :q: Quantile, between 0 and 1
+        """
+        finite_count = self.count - self.nonfinite_count
+        if finite_count == 0:
+            return math.nan
+        rank = q * (finite_count - 1)
+        seen = self.zero_count
+        if rank < seen:
+            return 0.0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if rank < seen:
+                return 2 * self.gamma**index / (self.gamma + 1)
+        return 2 * self.gamma**max(self.buckets) / (self.gamma + 1)
+
+    def report(self, quantiles=(0.5, 0.9, 0.99)):
+        """
+        :quantiles: Quantiles of the absolute errors to report
+        :returns: Dictionary of the statistics
+        """
+        report = {
+            "count":     self.count,
+            "rmse":      self.rmse(),
+            "mae":       self.mae(),
+            "bias":      self.bias(),
+            "min_error": self.min_error,
+            "max_error": self.max_error,
+            "nonfinite_count": self.nonfinite_count,
+        }
+        for q in quantiles:
+            report[f"p{100*q:g}_abs_error"] = self.quantile(q)
+        return report
+
+    def __str__(self):
+        if self.count == 0:
+            return "no samples"
+        return (f"RMSE {self.rmse():.4f}, MAE {self.mae():.4f}, bias {self.bias():.4f}, "
+                f"errors in [{self.min_error:.1f}, {self.max_error:.1f}], "
+                f"|error| p50 {self.quantile(0.5):.1f} / p90 {self.quantile(0.9):.1f} "
+                f"/ p99 {self.quantile(0.99):.1f} over {self.count} samples"
+                + (f", {self.nonfinite_count} of them non-finite"
+                   if self.nonfinite_count > 0 else ""))
+
+
+def merge_stats(stats):
+    """Merges `ErrorStats` (e.g. of every pair) into global statistics
+
+    :stats: Iterable of ErrorStats
+    :returns: A new ErrorStats
+    """
+    stats = list(stats)
+    merged = ErrorStats(stats[0].relative_accuracy) if stats else ErrorStats()
+    for pair_stats in stats:
+        merged.merge(pair_stats)
+    return merged
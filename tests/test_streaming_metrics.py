@@ -0,0 +1,117 @@
+import math
+import pickle
+from fractions import Fraction
+
+import numpy as np
+import pytest
+
+from streaming_metrics import ExactSum, ErrorStats, merge_stats
+
+
+def exact_sum(values):
+    return float(sum(Fraction(float(value)) for value in values))
+
+
+def test_exact_sum_is_exact():
+    rand = np.random.RandomState(10701)
+    values = rand.standard_normal(2000) * 10.0**rand.randint(-300, 300, 2000)
+    values = np.r_[values, 5e-324, -5e-324, 2.2e-308, 1.7e308, -1.7e308, 0.0, -0.0]
+
+    total = ExactSum()
+    for chunk in np.array_split(values, 7):
+        total.add(chunk)
+    assert total.value() == exact_sum(values)
+    assert total.value() == math.fsum(values.tolist())
+    assert total.mean(values.shape[0]) == \
+        float(sum(Fraction(float(value)) for value in values) / values.shape[0])
+
+
+def test_exact_sum_ignores_order_and_batching():
+    rand = np.random.RandomState(10701)
+    values = rand.rand(10000) * 3600
+
+    in_order = ExactSum()
+    in_order.add(values)
+    shuffled = ExactSum()
+    for chunk in np.array_split(rand.permutation(values), 13):
+        chunk_sum = ExactSum()
+        chunk_sum.add(chunk)
+        shuffled.merge(chunk_sum)
+    assert in_order.total == shuffled.total
+
+
+def test_exact_sum_of_non_finite_values():
+    total = ExactSum()
+    total.add(np.array([1.0, np.inf]))
+    assert total.value() == np.inf
+    total.add(np.array([np.nan]))
+    assert math.isnan(total.value())
+
+
+def test_non_finite_errors_stay_out_of_the_sketch():
+    stats = ErrorStats()
+    stats.update(np.array([np.nan, 1.0, np.inf]), np.array([0.0, 0.0, 0.0]))
+    assert stats.count == 3
+    assert stats.nonfinite_count == 2
+    assert math.isnan(stats.rmse())
+    assert stats.min_error == stats.max_error == 1.0
+    assert stats.quantile(0.5) == pytest.approx(1.0, rel=stats.relative_accuracy)
+    assert stats.report()["nonfinite_count"] == 2
+    assert "2 of them non-finite" in str(stats)
+
+    merged = merge_stats([stats, stats])
+    assert merged.nonfinite_count == 4
+    assert merged.quantile(0.99) == pytest.approx(1.0, rel=stats.relative_accuracy)
+
+
+def test_merged_stats_match_all_errors():
+    rand = np.random.RandomState(10701)
+    values = rand.rand(5000) * 3600
+    predictions = values + rand.standard_normal(5000) * 300
+    errors = predictions - values
+
+    pair_stats = []
+    for rows in np.array_split(rand.permutation(5000), 3):
+        stats = ErrorStats()
+        for batch in np.array_split(rows, 7):
+            stats.update(predictions[batch], values[batch])
+        pair_stats.append(stats)
+    merged = merge_stats(pickle.loads(pickle.dumps(stats)) for stats in pair_stats)
+
+    assert merged.count == 5000
+    assert merged.mse() == float(sum(Fraction(float(error)**2) for error in errors) / 5000)
+    assert merged.rmse() == pytest.approx(np.sqrt(np.mean(errors**2)), rel=1e-15)
+    assert merged.mae() == pytest.approx(np.mean(np.abs(errors)), rel=1e-15)
+    assert merged.bias() == pytest.approx(np.mean(errors), rel=1e-12, abs=1e-12)
+    assert merged.min_error == errors.min()
+    assert merged.max_error == errors.max()
+
+
+@pytest.mark.parametrize("relative_accuracy", [0.01, 0.05])
+def test_quantiles_within_relative_accuracy(relative_accuracy):
+    rand = np.random.RandomState(10701)
+    errors = rand.lognormal(5, 2, 20000) * rand.choice([-1, 1], 20000)
+    errors[:500] = 0
+
+    stats = ErrorStats(relative_accuracy)
+    for batch in np.array_split(errors, 9):
+        stats.update(batch, np.zeros(batch.shape[0]))
+
+    sorted_errors = np.sort(np.abs(errors))
+    for q in (0.01, 0.5, 0.9, 0.99, 1.0):
+        expected = sorted_errors[int(q * (errors.shape[0] - 1))]
+        assert stats.quantile(q) == pytest.approx(expected, rel=relative_accuracy)
+
+
+def test_empty_stats():
+    stats = ErrorStats()
+    stats.update(np.array([]), np.array([]))
+    assert stats.count == 0
+    assert math.isnan(stats.rmse())
+    assert math.isnan(stats.quantile(0.5))
+    assert str(stats) == "no samples"
+
+
+def test_merging_needs_the_same_accuracy():
+    with pytest.raises(AssertionError):
+        ErrorStats(0.01).merge(ErrorStats(0.02))
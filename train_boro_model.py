@@ -1,16 +1,24 @@
 import os
+import sys
+import json
 import datetime
 import argparse
+import tempfile
 import numpy as np
-from tqdm import tqdm
+from time import time
 from scipy import sparse
-from models import BoroModel, create_boro_model
+from models import BoroModel, create_boro_model, to_sparse_tensor
+from perf_config import add_perf_arguments, apply_perf_config, save_perf_config, \
+                        autotune_batch_size
+from distributed import add_distributed_arguments, get_strategy, get_worker_info, \
+                        launch_local_workers, strip_arguments
 from utils import create_connection
 from obtain_features import extract_features
 
 import tensorflow as tf
 from sklearn.model_selection import train_test_split
-from tensorflow.keras.callbacks import CSVLogger, ModelCheckpoint
+from tensorflow.keras.callbacks import CSVLogger, ModelCheckpoint, EarlyStopping, \
+                                       ReduceLROnPlateau
 
 
 SUPER_BOROS = [
@@ -50,6 +58,17 @@ FEATURE_TYPES = {
         }
 }
 
+# The validation RMSE tracked for early stopping and the learning rate
+VAL_METRIC = "val_root_mean_squared_error"
+
+VALIDATION_DEFAULTS = {
+    "patience":    5,
+    "min_delta":   1.0,
+    "lr_patience": 2,
+    "lr_factor":   0.5,
+    "min_lr":      1e-5
+}
+
 
 parser = argparse.ArgumentParser()
 parser.add_argument("--db-path", type=str, default="./rides.db",
@@ -70,105 +89,524 @@ parser.add_argument("--batch-size", type=int, default=1000,
                     help="the batch size to be used for trained")
 parser.add_argument("--model-path", type=str, default=None,
                     help="Path to the model to hot start from")
-
-
-def nn_batch_generator(X_data, y_data, batch_size):
-    samples_per_epoch = X_data.shape[0]
-    number_of_batches = int(samples_per_epoch/batch_size)
-    counter=0
-    index = np.arange(np.shape(y_data)[0])
-    p_bar = tqdm(total = number_of_batches+1)
-    while 1:
-        index_batch = index[batch_size*counter:batch_size*(counter+1)]
-        X_batch = X_data[index_batch,:].todense()
-        y_batch = y_data[index_batch]
-        counter += 1
-        yield np.array(X_batch),y_batch
-        p_bar.update(1)
-        if (counter > number_of_batches):
-            counter=0
-            p_bar.close()
-            p_bar = tqdm(total = number_of_batches+1)
+parser.add_argument("--sparse-input", default=False, action='store_true',
+                    help="feed sparse features to the model as they are, "
+                         "instead of densifying them (needs '--variant batch')")
+parser.add_argument("--bench-sparse", type=int, default=0,
+                    help="instead of training, time this many training batches "
+                         "of random one-hot features with dense and sparse inputs")
+parser.add_argument("--learning-rate", type=float, default=1e-3,
+                    help="the initial learning rate")
+parser.add_argument("--val-split", type=float, default=0.1,
+                    help="the fraction of the training samples held out for validation")
+parser.add_argument("--patience", type=int, default=VALIDATION_DEFAULTS["patience"],
+                    help="stop after this many epochs without a better validation RMSE (0: never)")
+parser.add_argument("--min-delta", type=float, default=VALIDATION_DEFAULTS["min_delta"],
+                    help="the decrease of the validation RMSE (in seconds) that counts as better")
+parser.add_argument("--lr-patience", type=int, default=VALIDATION_DEFAULTS["lr_patience"],
+                    help="reduce the learning rate after this many epochs "
+                         "without a better validation RMSE (0: never)")
+parser.add_argument("--lr-factor", type=float, default=VALIDATION_DEFAULTS["lr_factor"],
+                    help="the factor the learning rate is reduced by")
+parser.add_argument("--min-lr", type=float, default=VALIDATION_DEFAULTS["min_lr"],
+                    help="the minimum learning rate")
+parser.add_argument("--model-dir", type=str, default=None,
+                    help="the directory of the trained model (default: a new one in 'models')")
+parser.add_argument("--bench-workers", type=int, default=0,
+                    help="instead of training, time training on random features with "
+                         "1, 2, 4, ... up to this many local workers")
+parser.add_argument("--bench-batches", type=int, default=100,
+                    help="the number of batches per worker timed by '--bench-workers'")
+# Run by the workers of '--bench-workers'
+parser.add_argument("--bench-output", type=str, default=None, help=argparse.SUPPRESS)
+add_perf_arguments(parser)
+add_distributed_arguments(parser)
+
+
+def save_features_mmap(features_file, features):
+    """Stores features so that `load_features_mmap` can memory-map them.
+    Sparse features are stored as the .npy files of their CSR arrays,
+    as .npz archives can not be memory-mapped.
+
+    :features_file: Path of the features, ending in '.npy'
+    :features: Sparse csr_matrix or np.array of the features
+    """
+    if sparse.issparse(features):
+        features = features.tocsr()
+        prefix = features_file[:-len(".npy")]
+        np.save(f"{prefix}.data.npy", features.data)
+        np.save(f"{prefix}.indices.npy", features.indices)
+        np.save(f"{prefix}.indptr.npy", features.indptr)
+        np.save(f"{prefix}.shape.npy", np.array(features.shape))
+    else:
+        np.save(features_file, features)
+
+
+def load_features_mmap(features_file, isSparse):
+    """Memory-maps the features stored by `save_features_mmap`.
+    Sparse features stored as '{features_file}.npz' by earlier
+    versions are loaded into memory instead.
+
+    :features_file: Path of the features, ending in '.npy'
+    :isSparse: Whether the features are sparse
+    :returns: Sparse csr_matrix or np.array of the features
+    """
+    if not isSparse:
+        return np.load(features_file, mmap_mode="r")
+
+    prefix = features_file[:-len(".npy")]
+    if not os.path.exists(f"{prefix}.data.npy"):
+        return sparse.load_npz(features_file + ".npz")
+    return sparse.csr_matrix((np.load(f"{prefix}.data.npy", mmap_mode="r"),
+                              np.load(f"{prefix}.indices.npy", mmap_mode="r"),
+                              np.load(f"{prefix}.indptr.npy", mmap_mode="r")),
+                             shape=tuple(np.load(f"{prefix}.shape.npy")), copy=False)
+
+
+def make_dataset(features, values, indices, batch_size, shuffle=True,
+                 densify=True, seed=None, num_shards=1, shard_index=0):
+    """Builds the tf.data pipeline feeding the rows `indices` of the
+    (possibly memory-mapped) features. The rows are reshuffled at the
+    start of every epoch, gathered by parallel calls and prefetched.
+
+    The rows are gathered by a `tf.py_function`, which holds the GIL
+    outside of the NumPy and SciPy indexing it calls, so the parallel
+    calls only overlap in those. Gathering in-graph would need the
+    features as tensors, i.e. in memory rather than memory-mapped.
+
+    :features: Sparse csr_matrix or np.array of the features
+    :values: np.array of the output values
+    :indices: np.array of the rows making up the dataset
+    :batch_size: Number of rows per batch
+    :shuffle: Whether to shuffle the rows every epoch
+    :densify: Whether sparse features are converted to dense
+        batches, or fed to the model as tf.SparseTensor
+    :seed: Seed of the shuffling
+    :num_shards, shard_index: Number of workers the rows are split
+        between, and the index of the worker reading this shard
+    :returns: tf.data.Dataset of (features, values) batches
+    """
+    if num_shards > 1:
+        # Equal shards, for every worker to run as many steps
+        indices = indices[:len(indices) - len(indices) % num_shards][shard_index::num_shards]
+
+    num_features = features.shape[1]
+    isSparse = sparse.issparse(features)
+
+    def load_batch(batch_indices):
+        # Sorted rows are read in file order from the memory map
+        batch_indices = np.sort(batch_indices.numpy())
+        batch_values = np.asarray(values[batch_indices], dtype=np.float32)
+        if not isSparse:
+            return np.asarray(features[batch_indices], dtype=np.float32), batch_values
+        batch = features[batch_indices].tocoo()
+        coords = np.stack([batch.row, batch.col], axis=1).astype(np.int64)
+        return coords, batch.data.astype(np.float32), batch_values
+
+    def to_tensors(batch_indices):
+        if not isSparse:
+            X, y = tf.py_function(load_batch, [batch_indices], [tf.float32, tf.float32])
+            X.set_shape([None, num_features])
+        else:
+            coords, data, y = tf.py_function(load_batch, [batch_indices],
+                                             [tf.int64, tf.float32, tf.float32])
+            dense_shape = tf.stack([tf.shape(y, out_type=tf.int64)[0],
+                                    tf.constant(num_features, dtype=tf.int64)])
+            X = tf.sparse.reorder(tf.SparseTensor(coords, data, dense_shape))
+            if densify:
+                X = tf.sparse.to_dense(X)
+                X.set_shape([None, num_features])
+        y.set_shape([None])
+        return X, y
+
+    dataset = tf.data.Dataset.from_tensor_slices(indices)
+    if shuffle:
+        dataset = dataset.shuffle(len(indices), seed=seed,
+                                  reshuffle_each_iteration=True)
+    dataset = dataset.batch(batch_size)
+    dataset = dataset.map(to_tensors, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    return dataset.prefetch(tf.data.experimental.AUTOTUNE)
+
+
+def distribute_dataset(strategy, make_shard):
+    """Has every worker build the dataset of its own shard, whose
+    batches are those of its replica, rather than splitting up
+    global batches read by every worker
+
+    :strategy: Strategy returned by `distributed.get_strategy`
+    :make_shard: Function of (number of shards, shard index)
+        returning the tf.data.Dataset of that shard
+    :returns: The dataset to fit or evaluate the model on
+    """
+    if get_worker_info(strategy)[0] == 1:
+        return make_shard(1, 0)
+    return strategy.distribute_datasets_from_function(
+        lambda context: make_shard(context.num_input_pipelines, context.input_pipeline_id))
+
+
+def get_num_batches(num_rows, num_shards, batch_size):
+    """
+    :returns: The number of batches of every shard of `make_dataset`,
+        which Keras needs to be given for distributed datasets
+    """
+    return int(np.ceil((num_rows - num_rows % num_shards)/num_shards/batch_size))
+
+
+class ThroughputLogger(tf.keras.callbacks.Callback):
+    """Reports the training samples/sec of every epoch, and adds it
+    to the epoch logs (and thereby to those of `CSVLogger`)"""
+
+    def __init__(self, num_samples):
+        """
+        :num_samples: Number of training samples per epoch
+        """
+        super().__init__()
+        self.num_samples = num_samples
+        self.samples_per_sec = []
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.start_time = time()
+
+    def on_epoch_end(self, epoch, logs=None):
+        samples_per_sec = self.num_samples / (time() - self.start_time)
+        print(f"Epoch {epoch+1}: {samples_per_sec:.1f} samples/sec")
+        self.samples_per_sec.append(samples_per_sec)
+        if logs is not None:
+            logs["samples_per_sec"] = samples_per_sec
+
+
+class BestWeights(tf.keras.callbacks.Callback):
+    """Keeps the weights of the epoch with the best validation RMSE
+    in '{model_dir}/best_weights.h5', and restores them at the end
+    of training, whether it stopped early or not"""
+
+    def __init__(self, model_dir, min_delta=0.0):
+        """
+        :model_dir: Directory of the trained model
+        :min_delta: Decrease of the validation RMSE that counts as better
+        """
+        super().__init__()
+        self.path = os.path.join(model_dir, 'best_weights.h5')
+        self.min_delta = min_delta
+        self.best = np.inf
+        self.best_epoch = None
+
+    def on_epoch_end(self, epoch, logs=None):
+        val_rmse = (logs or {}).get(VAL_METRIC)
+        if val_rmse is not None and val_rmse < self.best - self.min_delta:
+            print(f"Epoch {epoch+1}: validation RMSE improved to {val_rmse:.4f}")
+            self.best = val_rmse
+            self.best_epoch = epoch + 1
+            self.model.save_weights(self.path)
+
+    def on_train_end(self, logs=None):
+        if self.best_epoch is not None:
+            print(f"Restoring the weights of epoch {self.best_epoch}, "
+                  f"with a validation RMSE of {self.best:.4f}")
+            self.model.load_weights(self.path)
+
+
+def get_validation_callbacks(model_dir, validation):
+    """Creates the callbacks tracking the validation RMSE
+
+    :model_dir: Directory of the trained model
+    :validation: Dictionary of the early stopping ('patience',
+        'min_delta') and learning rate schedule ('lr_patience',
+        'lr_factor', 'min_lr') settings, overriding VALIDATION_DEFAULTS
+    :returns: Tuple of (the BestWeights callback, list of all callbacks)
+    """
+    validation = {**VALIDATION_DEFAULTS, **(validation or {})}
+    best_weights = BestWeights(model_dir, validation['min_delta'])
+    callbacks = [best_weights]
+    if validation['lr_patience'] > 0:
+        callbacks.append(ReduceLROnPlateau(monitor=VAL_METRIC, mode='min',
+                                           factor=validation['lr_factor'],
+                                           patience=validation['lr_patience'],
+                                           min_delta=validation['min_delta'],
+                                           min_lr=validation['min_lr'], verbose=1))
+    if validation['patience'] > 0:
+        # BestWeights restores the best weights, not EarlyStopping
+        callbacks.append(EarlyStopping(monitor=VAL_METRIC, mode='min',
+                                       patience=validation['patience'],
+                                       min_delta=validation['min_delta'], verbose=1))
+    return best_weights, callbacks
+
+
+def random_features(num_rows, input_dim, nnz_per_row=14, rand=None):
+    """Random binary features with as many non-zeros per row as
+    our one-hot feature vectors
+
+    :num_rows: Number of rows
+    :input_dim: Width of the feature vectors
+    :nnz_per_row: Number of non-zero features per row
+    :rand: np.random.RandomState
+    :returns: Sparse csr_matrix of the features
+    """
+    rand = rand if rand is not None else np.random.RandomState()
+    # Sorted draws spread apart by their rank are distinct columns, as
+    # repeated indices can not be densified by tf.sparse.to_dense
+    cols = np.sort(rand.randint(0, input_dim - nnz_per_row + 1, (num_rows, nnz_per_row)), axis=1)
+    cols += np.arange(nnz_per_row)
+    return sparse.csr_matrix(
+        (np.ones(num_rows*nnz_per_row), cols.ravel(),
+         np.arange(0, num_rows*nnz_per_row+1, nnz_per_row)),
+        shape=(num_rows, input_dim))
+
+
+def autotune_boro_batch_size(input_dim, memory_budget_mb, sparse_input=False, seed=10701):
+    """Finds the largest batch size of the boro model within the
+    memory budget, training a throwaway model on random features
+
+    :input_dim: Width of the feature vectors
+    :memory_budget_mb: Memory budget of training, in MB
+    :sparse_input: Whether the model takes sparse inputs
+    :seed: Seed of the random features
+    :returns: Tuple of (batch size, results), as returned by
+        `perf_config.autotune_batch_size`
+    """
+    rand = np.random.RandomState(seed)
+    model = create_boro_model([200,50], input_dim, sparse_input)
+    model.compile(optimizer=tf.keras.optimizers.Adam(learning_rate = 1e-3),
+                  loss=tf.keras.losses.MeanSquaredError())
+
+    def make_batch(batch_size):
+        features = random_features(batch_size, input_dim, rand=rand)
+        features = to_sparse_tensor(features) if sparse_input \
+                   else features.toarray().astype(np.float32)
+        return features, (rand.rand(batch_size)*3600).astype(np.float32)
+
+    return autotune_batch_size(lambda batch: model.train_on_batch(*batch),
+                               make_batch, memory_budget_mb)
+
+
+def benchmark_sparse_input(input_dim, batch_size=1000, num_batches=100,
+                           nnz_per_row=14, seed=10701):
+    """Compares the training throughput of the boro model fed with
+    densified batches against feeding them as tf.SparseTensor
+
+    :input_dim: Width of the feature vectors
+    :batch_size: Number of rows per batch
+    :num_batches: Number of batches to time
+    :nnz_per_row: Number of non-zero features per row (14 for
+        feature type 3: 2 loc IDs, 4 coordinates, 2 boroughs and
+        6 date & time one-hots)
+    :seed: Seed of the random features
+    """
+    rand = np.random.RandomState(seed)
+    num_rows = batch_size*num_batches
+    features = random_features(num_rows, input_dim, nnz_per_row, rand)
+    values = rand.rand(num_rows)*3600
+
+    num_neurons_in_layers = [200, 50]
+    dense_bytes = batch_size*input_dim*4
+    sparse_bytes = batch_size*nnz_per_row*(2*8 + 4)
+    print(f"Input per batch: {dense_bytes/1e6:.2f} MB dense, {sparse_bytes/1e6:.2f} MB sparse "
+          f"({dense_bytes/sparse_bytes:.1f}x), first-layer FLOPs: "
+          f"{input_dim/nnz_per_row:.1f}x fewer with sparse inputs")
+
+    for sparse_input in (False, True):
+        model = create_boro_model(num_neurons_in_layers, input_dim, sparse_input)
+        model.compile(optimizer=tf.keras.optimizers.Adam(learning_rate = 1e-3),
+                      loss=tf.keras.losses.MeanSquaredError())
+        data = make_dataset(features, values, np.arange(num_rows), batch_size,
+                            shuffle=False, densify=not sparse_input)
+        # The first batches trace the graph
+        model.fit(data.take(2), verbose=0)
+        start_time = time()
+        model.fit(data, verbose=0)
+        duration = time() - start_time
+        print(f"{'Sparse' if sparse_input else 'Dense'} input: "
+              f"{num_rows/duration:.1f} samples/sec, "
+              f"{duration/num_batches*1e3:.2f} ms per batch")
+
+
+def benchmark_distributed(strategy, input_dim, batch_size=1000, num_batches=100,
+                          sparse_input=False, output_file=None, seed=10701):
+    """Times the training of the boro model on random features, run
+    by every worker of `benchmark_workers` on its shard of them
+
+    :strategy: Strategy returned by `distributed.get_strategy`
+    :input_dim: Width of the feature vectors
+    :batch_size: Number of rows per batch of a worker
+    :num_batches: Number of batches timed per worker
+    :sparse_input: Whether the model takes sparse inputs
+    :output_file: Path to the .json file the chief stores
+        the samples/sec of the cluster in
+    :seed: Seed of the random features, the same on every worker
+    """
+    num_workers, worker_index = get_worker_info(strategy)
+    rand = np.random.RandomState(seed)
+    num_rows = batch_size*num_batches*num_workers
+    features = random_features(num_rows, input_dim, rand=rand)
+    values = rand.rand(num_rows)*3600
+
+    def make_shard(num_shards, shard_index, num_warmup_batches=None):
+        data = make_dataset(features, values, np.arange(num_rows), batch_size, shuffle=False,
+                            densify=not sparse_input, num_shards=num_shards,
+                            shard_index=shard_index)
+        return data if num_warmup_batches is None else data.take(num_warmup_batches)
+
+    with strategy.scope():
+        model = create_boro_model([200,50], input_dim, sparse_input)
+        model.compile(optimizer=tf.keras.optimizers.Adam(learning_rate = 1e-3),
+                      loss=tf.keras.losses.MeanSquaredError())
+        data = distribute_dataset(strategy, make_shard)
+        # The first batches trace the graph
+        warmup_data = distribute_dataset(
+            strategy, lambda num_shards, shard_index: make_shard(num_shards, shard_index, 2))
+    model.fit(warmup_data, steps_per_epoch=2, verbose=0)
+    start_time = time()
+    model.fit(data, steps_per_epoch=num_batches, verbose=0)
+    duration = time() - start_time
+
+    samples_per_sec = num_rows/duration
+    print(f"Worker {worker_index} of {num_workers}: {samples_per_sec:.1f} samples/sec "
+          f"in total, {duration/num_batches*1e3:.2f} ms per batch")
+    if worker_index == 0 and output_file is not None:
+        with open(output_file, 'w') as f:
+            json.dump({"num_workers": num_workers, "samples_per_sec": samples_per_sec}, f)
+
+
+def benchmark_workers(max_workers, args, intra_op_threads=0):
+    """Runs `benchmark_distributed` with 1, 2, 4, ... up to
+    `max_workers` workers on this host, and reports how the
+    throughput scales. As local workers share the cores of the
+    host, this checks the training and communication of the
+    cluster; across hosts, run one worker per host with '--workers'.
+
+    :max_workers: Maximum number of workers
+    :args: Arguments of the workers, e.g. the feature type
+    :intra_op_threads: Threads of each worker (0: the cores split
+        between the workers)
+    :returns: Dictionary of the samples/sec by number of workers
+    """
+    worker_counts = sorted({min(2**i, max_workers) for i in range(max_workers.bit_length()+1)})
+    samples_per_sec = {}
+    for num_workers in worker_counts:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            output_file = os.path.join(tmp_dir, 'bench.json')
+            exit_codes = launch_local_workers(num_workers, os.path.abspath(__file__),
+                                              args + ["--bench-output", output_file],
+                                              intra_op_threads)
+            assert not any(exit_codes), f"ERROR: The workers exited with {exit_codes}"
+            with open(output_file, 'r') as f:
+                samples_per_sec[num_workers] = json.load(f)["samples_per_sec"]
+
+    for num_workers in worker_counts:
+        speedup = samples_per_sec[num_workers]/samples_per_sec[1]
+        print(f"{num_workers} workers: {samples_per_sec[num_workers]:.1f} samples/sec, "
+              f"{speedup:.2f}x speedup, {speedup/num_workers:.0%} efficiency")
+    return samples_per_sec
 
 
 def train_on_batches(model, data_generator, data_gen_args, saved, features_file, values_file,
-                model_dir, isSparse=True, num_epochs=20, batch_size=1000, start_epoch=0):
+                model_dir, isSparse=True, num_epochs=20, batch_size=1000, start_epoch=0,
+                sparse_input=False, learning_rate=1e-3, val_split=0.1, validation=None,
+                strategy=None):
+
+    strategy = strategy if strategy is not None else tf.distribute.get_strategy()
+    num_workers, worker_index = get_worker_info(strategy)
 
     if not saved:
         features, values = data_generator(**data_gen_args)
-        if isSparse:
-            sparse.save_npz(features_file, features)
-        else:
-            np.save(features_file, features)
+        save_features_mmap(features_file, features)
         np.save(values_file, values)
-    else:
-        if isSparse:
-            print(f"Loading sparse features from {features_file}.npz")
-            features = sparse.load_npz(features_file+".npz")
-        else:
-            print(f"Loading dense features from {features_file}")
-            features = np.load(features_file, allow_pickle=True)
-        
-        print(f"Loading output values from {values_file}")
-        values = np.load(values_file, allow_pickle=True)
-
-
-    train_features, test_features, train_values, test_values = train_test_split(
-            features, values, test_size=0.1, random_state=42)
-
-    # train_features, val_features, train_values, val_values = train_test_split(
-            # train_features_, train_values_, test_size=0.05, random_state=42)
-
-    total_samples = train_features.shape[0]
-    steps_per_epoch = int(total_samples/batch_size)+1
-    
-
-    optimizer = tf.keras.optimizers.Adam(learning_rate = 1e-3)
-    model.compile(optimizer=optimizer, loss=tf.keras.losses.MeanSquaredError(),
-         metrics=[tf.keras.metrics.RootMeanSquaredError()])
+        del features, values
+
+    print(f"Memory-mapping {'sparse' if isSparse else 'dense'} features from {features_file}")
+    features = load_features_mmap(features_file, isSparse)
+    print(f"Memory-mapping output values from {values_file}")
+    values = np.load(values_file, mmap_mode="r")
+
+    # Splitting the row indices gives the same split as splitting the data
+    train_indices, test_indices = train_test_split(
+            np.arange(features.shape[0]), test_size=0.1, random_state=42)
+    # The validation samples are held out once, and never trained on
+    train_indices, val_indices = train_test_split(
+            train_indices, test_size=val_split, random_state=42)
+
+    # Every worker trains on batches of `batch_size` rows of its own shard
+    total_samples = train_indices.shape[0] - train_indices.shape[0] % num_workers
+    steps_per_epoch = get_num_batches(train_indices.shape[0], num_workers, batch_size)
+    validation_steps = get_num_batches(val_indices.shape[0], num_workers, batch_size)
+
+    # Repeated, as Keras keeps iterating the datasets it is given the
+    # steps of across epochs, each repetition being an epoch
+    with strategy.scope():
+        train_data = distribute_dataset(strategy, lambda num_shards, shard_index: make_dataset(
+            features, values, train_indices, int(batch_size), shuffle=True,
+            densify=not sparse_input, seed=42, num_shards=num_shards,
+            shard_index=shard_index).repeat())
+        val_data = distribute_dataset(strategy, lambda num_shards, shard_index: make_dataset(
+            features, values, val_indices, int(batch_size), shuffle=False,
+            densify=not sparse_input, num_shards=num_shards,
+            shard_index=shard_index).repeat())
+        test_data = distribute_dataset(strategy, lambda num_shards, shard_index: make_dataset(
+            features, values, test_indices, int(batch_size), shuffle=False,
+            densify=not sparse_input, num_shards=num_shards, shard_index=shard_index))
+
+        optimizer = tf.keras.optimizers.Adam(learning_rate = learning_rate)
+        model.compile(optimizer=optimizer, loss=tf.keras.losses.MeanSquaredError(),
+             metrics=[tf.keras.metrics.RootMeanSquaredError()])
 
     model_weights_dir = os.path.join(model_dir,'weights')
     mc = ModelCheckpoint(os.path.join(model_weights_dir,'weights_{epoch:08d}.h5'), 
                                     save_weights_only=True, save_freq='epoch')
     csv_logger = CSVLogger(os.path.join(model_dir, 'log.csv'), append=True, separator=';')
+    throughput = ThroughputLogger(total_samples)
+    best_weights, validation_callbacks = get_validation_callbacks(model_dir, validation)
     os.mkdir(model_weights_dir)
-    print(f'Starting training on {total_samples} samples, with batches of {batch_size}, having {steps_per_epoch} batches per epoch')
-
-    model.fit_generator(nn_batch_generator(train_features, train_values, batch_size=int(batch_size)), 
-                        epochs=num_epochs, verbose=2, steps_per_epoch=steps_per_epoch, callbacks=[csv_logger, mc],
-                        initial_epoch=start_epoch)
-
-    test_samples = test_features.shape[0]
-    evaluation_steps = int(test_samples/batch_size)+1
-    print(f"Evalutating model on {test_features.shape[0]} samples, with batches of {batch_size}, having {evaluation_steps} batches in total")
-    test_scores = model.evaluate(nn_batch_generator(test_features, test_values, batch_size=int(batch_size)),
-                                    steps=evaluation_steps, verbose=0)
+    print(f'Starting training on {total_samples} samples, with batches of {batch_size}, having {steps_per_epoch} batches per epoch, '
+          f'validating on {val_indices.shape[0]} samples' +
+          (f', as worker {worker_index} of {num_workers}' if num_workers > 1 else ''))
+
+    # The throughput logger goes first, for its entry to reach the CSV log
+    model.fit(train_data, epochs=num_epochs, verbose=2, validation_data=val_data,
+              steps_per_epoch=steps_per_epoch, validation_steps=validation_steps,
+              callbacks=[throughput, csv_logger, mc] + validation_callbacks,
+              initial_epoch=start_epoch)
+
+    test_samples = test_indices.shape[0]
+    evaluation_steps = get_num_batches(test_samples, num_workers, batch_size)
+    print(f"Evalutating model on {test_samples} samples, with batches of {batch_size}, having {evaluation_steps} batches in total")
+    test_scores = model.evaluate(test_data, steps=evaluation_steps, verbose=0)
     print(f"Model evalutaion on test data\n {test_scores}")
 
     with open(os.path.join(model_dir, 'eval.txt'), 'w') as f:
         f.write(str(test_scores))
 
-    tf.keras.models.save_model(model, os.path.join(model_dir, f'model_{num_epochs}'))
+    save_best_model(model, model_dir, best_weights, num_epochs)
+    return throughput.samples_per_sec
+
+
+
 
 
+def save_best_model(model, model_dir, best_weights, num_epochs):
+    """Saves the model, holding the best weights, as
+    'model_{epoch}' after the epoch of the best weights
 
+    :best_weights: The BestWeights callback of training
+    :num_epochs: The epoch saved after, if none was validated
+    """
+    best_epoch = best_weights.best_epoch if best_weights.best_epoch is not None else num_epochs
+    with open(os.path.join(model_dir, 'best.txt'), 'w') as f:
+        f.write(f'epoch: {best_epoch}, val_RMSE: {best_weights.best}\n')
+    tf.keras.models.save_model(model, os.path.join(model_dir, f'model_{best_epoch}'))
 
 
 def train(model, data_generator, data_gen_args, saved, features_file, values_file, 
-            model_dir, isSparse=False, num_epochs=20, batch_size=1000, start_epoch=0):
+            model_dir, isSparse=False, num_epochs=20, batch_size=1000, start_epoch=0,
+            learning_rate=1e-3, val_split=0.1, validation=None):
     
     if not saved:
         features, values = data_generator(**data_gen_args)
-        if isSparse:
-            sparse.save_npz(features_file, features)
-        else:
-            np.save(features_file, features)
+        save_features_mmap(features_file, features)
         np.save(values_file, values)
     else:
         if isSparse:
-            print(f"Reading sparse features from {features_file}.npz")
-            features = sparse.load_npz(features_file+".npz")
-            features = features.toarray()
+            print(f"Reading sparse features from {features_file}")
+            features = load_features_mmap(features_file, isSparse).toarray()
         else:
             print(f"Reading dense features from {features_file}")
             features = np.load(features_file, allow_pickle=True)
@@ -177,8 +615,11 @@ def train(model, data_generator, data_gen_args, saved, features_file, values_fil
 
     train_features, test_features, train_values, test_values = train_test_split(
             features, values, test_size=0.1, random_state=42)
+    # Held out once and shuffled, unlike the last rows sliced off by validation_split
+    train_features, val_features, train_values, val_values = train_test_split(
+            train_features, train_values, test_size=val_split, random_state=42)
 
-    optimizer = tf.keras.optimizers.Adam(learning_rate = 1e-3)
+    optimizer = tf.keras.optimizers.Adam(learning_rate = learning_rate)
     model.compile(optimizer=optimizer, loss=tf.keras.losses.MeanSquaredError(),
          metrics=[tf.keras.metrics.RootMeanSquaredError()])
 
@@ -188,8 +629,12 @@ def train(model, data_generator, data_gen_args, saved, features_file, values_fil
     mc = ModelCheckpoint(os.path.join(model_weights_dir,'weights_{epoch:08d}.h5'), 
                                      save_weights_only=True, period=2)
 
+    throughput = ThroughputLogger(train_features.shape[0])
+    best_weights, validation_callbacks = get_validation_callbacks(model_dir, validation)
     model.fit(train_features, train_values, epochs=num_epochs, batch_size=batch_size,
-                validation_split=0.1, verbose=1, callbacks=[csv_logger, mc], initial_epoch=start_epoch)
+                validation_data=(val_features, val_values), verbose=1,
+                callbacks=[throughput, csv_logger, mc] + validation_callbacks,
+                initial_epoch=start_epoch)
 
     test_scores = model.evaluate(test_features, test_values, verbose=0, callbacks=[csv_logger])
     print(f"Model evalutaion on test data\n {test_scores}")
@@ -197,12 +642,36 @@ def train(model, data_generator, data_gen_args, saved, features_file, values_fil
     with open(os.path.join(model_dir, 'eval.txt'), 'w') as f:
         f.write(str(test_scores))
 
-    tf.keras.models.save_model(model, os.path.join(model_dir, f'model_{num_epochs}'))
+    save_best_model(model, model_dir, best_weights, num_epochs)
+    return throughput.samples_per_sec
+
+
+def get_model_dir(super_boro, feature_type):
+    dt_now = datetime.datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
+    return os.path.join("models",  f'{dt_now}_{super_boro[0]}_f{feature_type}')
 
 
 def main():
     parsed_args = parser.parse_args()
 
+    # Run this script as several workers on this host, over loopback
+    if parsed_args.local_workers > 0 or parsed_args.bench_workers > 0:
+        # The workers get their own cluster and threads from `launch_local_workers`
+        args = strip_arguments(sys.argv[1:], ['--local-workers', '--bench-workers', '--workers',
+                                              '--worker-index', '--intra-op-threads'])
+        if parsed_args.bench_workers > 0:
+            benchmark_workers(parsed_args.bench_workers, args, parsed_args.intra_op_threads)
+            return
+        if parsed_args.model_dir is None:
+            args += ["--model-dir", get_model_dir(SUPER_BOROS[parsed_args.superboro_id],
+                                                  parsed_args.feature_type)]
+        exit_codes = launch_local_workers(parsed_args.local_workers, os.path.abspath(__file__),
+                                          args, parsed_args.intra_op_threads)
+        if any(exit_codes):
+            print(f"ERROR: The workers exited with {exit_codes}")
+            exit(1)
+        return
+
     conn = create_connection(parsed_args.db_path, check_same_thread=False)
 
     feature_type = parsed_args.feature_type
@@ -214,19 +683,58 @@ def main():
     batch_size = parsed_args.batch_size
     model_path = parsed_args.model_path
 
+    sparse_input = parsed_args.sparse_input
+    perf_config = apply_perf_config(parsed_args)
+    workers = parsed_args.workers.split(",") if parsed_args.workers else None
+    strategy = get_strategy(workers, parsed_args.worker_index)
+    num_workers, worker_index = get_worker_info(strategy)
+
     feature_vec_size = FEATURE_TYPES[feature_type]['size']
     super_boro = SUPER_BOROS[superboro_id]
 
-    if not model_path is None:
-        model = tf.keras.models.load_model(model_path)
-        start_epoch = int(model_path.split("_")[-1])
-    else:
-        model = create_boro_model([200,50], feature_vec_size)
-        start_epoch = 0
+    validation = {
+        "patience":    parsed_args.patience,
+        "min_delta":   parsed_args.min_delta,
+        "lr_patience": parsed_args.lr_patience,
+        "lr_factor":   parsed_args.lr_factor,
+        "min_lr":      parsed_args.min_lr
+    }
+
+    if parsed_args.bench_sparse > 0:
+        benchmark_sparse_input(feature_vec_size, batch_size, parsed_args.bench_sparse)
+        return
+
+    if parsed_args.bench_output is not None:
+        benchmark_distributed(strategy, feature_vec_size, batch_size, parsed_args.bench_batches,
+                              sparse_input, parsed_args.bench_output)
+        return
+
+    assert not sparse_input or (variant == 'batch' and is_sparse), \
+        "ERROR: Sparse inputs need sparse features and '--variant batch'"
+    # Every worker reads its shard of the saved features
+    assert num_workers == 1 or (variant == 'batch' and saved), \
+        "ERROR: Multi-worker training needs '--variant batch' and '--saved' features"
+
+    autotune_results = None
+    if parsed_args.batch_autotune_mb > 0:
+        batch_size, autotune_results = autotune_boro_batch_size(
+            feature_vec_size, parsed_args.batch_autotune_mb, sparse_input)
+
+    # The variables of the model are mirrored on every worker
+    with strategy.scope():
+        if not model_path is None:
+            model = tf.keras.models.load_model(model_path)
+            start_epoch = int(model_path.split("_")[-1])
+        else:
+            model = create_boro_model([200,50], feature_vec_size, sparse_input)
+            start_epoch = 0
 
-    dt_now = datetime.datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
-    model_dir = os.path.join("models",  f'{dt_now}_{super_boro[0]}_f{feature_type}')
-    os.mkdir(model_dir)
+    model_dir = parsed_args.model_dir if parsed_args.model_dir is not None \
+                else get_model_dir(super_boro, feature_type)
+    if worker_index > 0:
+        # The chief keeps the model, the other workers write theirs aside
+        model_dir = os.path.join(model_dir, f'worker_{worker_index}')
+    os.makedirs(model_dir, exist_ok=num_workers > 1)
 
     sql_batch_size = 1e6
     sql_block_size = 1e5
@@ -249,11 +757,18 @@ def main():
     values_file = os.path.join('data', f'values_{super_boro[0]}_{feature_type}.npy')
 
     if variant == 'all':
-        train(model, data_generator, data_generator_arguments, saved, features_file, 
-                values_file, model_dir, is_sparse, num_epochs, batch_size, start_epoch)
+        samples_per_sec = train(model, data_generator, data_generator_arguments, saved, features_file, 
+                values_file, model_dir, is_sparse, num_epochs, batch_size, start_epoch,
+                parsed_args.learning_rate, parsed_args.val_split, validation)
     elif variant == 'batch':
-        train_on_batches(model, data_generator, data_generator_arguments, saved,
-                features_file, values_file, model_dir, is_sparse, num_epochs, batch_size, start_epoch)
+        samples_per_sec = train_on_batches(model, data_generator, data_generator_arguments, saved,
+                features_file, values_file, model_dir, is_sparse, num_epochs, batch_size, start_epoch,
+                sparse_input, parsed_args.learning_rate, parsed_args.val_split, validation,
+                strategy)
+
+    save_perf_config(os.path.join(model_dir, 'perf_config.json'), perf_config,
+                     batch_size=batch_size, samples_per_sec=samples_per_sec,
+                     batch_autotune=autotune_results, num_workers=num_workers)
 
 
 
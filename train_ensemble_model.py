@@ -1,13 +1,21 @@
 import os
 import pprint
+import signal
 import argparse
 import numpy as np
 import pickle as pkl
+from time import time
 import tensorflow as tf
 from tqdm import tqdm
 from sklearn.model_selection import train_test_split
 
-from models import SelectorModel, BoroModel
+from scipy import sparse
+from models import SelectorModel, BoroModel, EnsembleModel, copy_model
+from checkpoint_manager import AsyncCheckpointManager, get_checkpoint_path, \
+                               list_checkpoint_epochs, load_checkpoint
+from streaming_metrics import ErrorStats, merge_stats
+from perf_config import add_perf_arguments, apply_perf_config, save_perf_config, \
+                        autotune_batch_size
 from utils import create_connection
 from obtain_features import extract_all_coordinates, extract_all_boroughs, get_one_hot, extract_features
 from train_boro_model import FEATURE_TYPES
@@ -26,6 +34,11 @@ boro_models = { }
 
 br_model = None# bridge time prediction model
 
+ensembles = { }
+
+# set by SIGUSR1, to export the SavedModels at the end of the current epoch
+export_requested = False
+
 
 parser = argparse.ArgumentParser()
 parser.add_argument("--db-path", type=str, default="./rides.db",
@@ -41,65 +54,45 @@ parser.add_argument("--batch-size", type=int, default=1000,
 parser.add_argument("--hot-start", default=False, action='store_true',
                     help="whether to start with pre-trained weights for all models")
 parser.add_argument("--start-epoch", type=int, default=0,
-                    help='the epoch number to start from')
+                    help='the epoch number to start from (default with --hot-start: '
+                         'after the latest checkpoint in the ensemble directory)')
 parser.add_argument("--ensemble-dir", type=str, default="ensemble",
-                    help='the directory storing the ensemble model to hot-start from')
-
-
-def ensemble_predict(featurePU, featureDO, featureDT, selector_model, pu_model, do_model, output=None):
-    prediction = selector_model.model.predict([featurePU, featureDO, featureDT])
-    pu_input, br_input, do_input = np.hsplit(prediction, 3)
-
-    pu_time = pu_model.model.predict(pu_input)
-    br_time = br_model.model.predict(br_input)
-    do_time = do_model.model.predict(do_input)
-    total_time = pu_time + br_time + do_time
-
-    output = np.expand_dims(output, axis=-1)
-
+                    help='the directory the ensemble models are exported to '
+                         'and hot-started from, and storing the checkpoints of training')
+parser.add_argument("--schedule", type=str, default="proportional",
+                    choices=["proportional", "round-robin", "sequential"],
+                    help='how the batches of the super-boro pairs are interleaved in an epoch')
+parser.add_argument("--xla", default=False, action='store_true',
+                    help='whether to compile the training steps with XLA')
+parser.add_argument("--bench-steps", type=int, default=0,
+                    help='instead of training, time this many training steps run '
+                         'eagerly, compiled with tf.function, and with XLA')
+parser.add_argument("--keep-checkpoints", type=int, default=3,
+                    help='the number of epoch checkpoints to keep (0: all)')
+parser.add_argument("--export-every", type=int, default=0,
+                    help='also export the SavedModels every this many epochs (0: only after '
+                         'training). They can be requested anytime by sending SIGUSR1.')
+add_perf_arguments(parser)
+
+
+def ensemble_predict(featurePU, featureDO, featureDT, ensemble_model, output=None):
     if output is None:
-        return total_time
-    else:
-        rmse = np.sqrt(np.mean(np.square(np.subtract(total_time, output))))
-        return rmse
+        return ensemble_model.predict(featurePU, featureDO, featureDT)
+    return ensemble_model.evaluate(featurePU, featureDO, featureDT, output)
 
-def ensemble_train_batch(featurePU, featureDO, featureDT, output, selector_model, pu_model, do_model):
-    """A single step of the ensemble training
+def ensemble_train_batch(featurePU, featureDO, featureDT, output, ensemble_model):
+    """A single step of the ensemble training, in a single compiled step
 
     :featurePU: [PULocID, PUCoords, PUBorough]
     :featureDO: [DOLocID, DOCoords, DOBorough]
     :featureDT: [PUDatetime]
-    :selector_model: selector model to be used
-    :pu_model: the PU point model
-    :do_model: the DO point model
+    :output: the trip durations
+    :ensemble_model: the `EnsembleModel` of the selector of the
+        (start, end) pair, with its PU, bridge and DO models
+    :returns: the MSE and RMSE of the batch, and the predictions
+        it was trained on
     """
-    prediction = selector_model.model.predict([featurePU, featureDO, featureDT])
-    pu_input, br_input, do_input = np.hsplit(prediction, 3)
-
-    pu_time = pu_model.model.predict(pu_input)
-    br_time = br_model.model.predict(br_input)
-    do_time = do_model.model.predict(do_input)
-    total_time = pu_time + br_time + do_time
-
-    output = np.expand_dims(output, axis=-1)
-
-    loss = np.mean(np.square(total_time-output))
-    rmse = np.sqrt(loss)
-    loss_grads = 2*(total_time - output)
-
-    pu_model.train(pu_input, loss_grads)
-    br_model.train(br_input, loss_grads)
-    do_model.train(do_input, loss_grads)
-
-    pu_grads = pu_model.gradients(pu_input, loss_grads)
-    br_grads = br_model.gradients(br_input, loss_grads)
-    do_grads = do_model.gradients(do_input, loss_grads)
-
-    grads_wrt_sel_output = np.hstack([pu_grads, br_grads, do_grads])
-
-    selector_model.train(featurePU, featureDO, featureDT, grads_wrt_sel_output)
-
-    return loss, rmse
+    return ensemble_model.train(featurePU, featureDO, featureDT, output)
 
 
 def get_loc_vector(locId, coords, boros, includelocId=False, maxLocId=263):
@@ -237,125 +230,261 @@ def batch_nn_generator(PUfeatures, DOfeatures, DTfeatures, values, batch_size):
             counter=0
 
 
-def train(PUfeatures, DOfeatures, DTfeatures, values, num_epochs=5, batch_size=1000, start_epoch=0):
+def get_pair_schedule(num_batches, schedule='proportional', rand=None):
+    """Orders the training batches of an epoch across the (start, end) pairs
+
+    :num_batches: dictionary of the number of batches of every pair
+    :schedule: 'proportional' spreads the batches of every pair evenly
+        over the epoch, 'round-robin' takes a batch of every pair with
+        batches left in turn, and 'sequential' trains on the pairs one
+        after another
+    :rand: np.random.RandomState, offsetting the proportional schedule
+    :returns: the list of pairs to take a batch from, in order
+    """
+    if schedule == 'sequential':
+        return [pair for pair in num_batches for _ in range(num_batches[pair])]
+
+    if schedule == 'round-robin':
+        return [pair for batch in range(max(num_batches.values()))
+                for pair in num_batches if batch < num_batches[pair]]
+
+    if schedule == 'proportional':
+        rand = rand if rand is not None else np.random.RandomState()
+        # the batch i of a pair sits at (i + offset)/num_batches of the epoch
+        positions = [((batch + offset)/num_batches[pair], pair)
+                     for pair, offset in zip(num_batches, rand.rand(len(num_batches)))
+                     for batch in range(num_batches[pair])]
+        return [pair for _, pair in sorted(positions)]
+
+    raise ValueError(f"Unknown schedule '{schedule}'")
+
+
+def train(PUfeatures, DOfeatures, DTfeatures, values, num_epochs=5, batch_size=1000, start_epoch=0,
+          schedule='proportional', checkpoints=None, export_every=0, ensemble_dir='ensemble'):
+    """Trains the ensembles, checkpointing their weights after every epoch
+
+    :checkpoints: AsyncCheckpointManager of the models (default: none)
+    :export_every: Export the full models every this many epochs
+        besides after the last one (0: only after the last one)
+    :ensemble_dir: Directory to export the models into
+    :returns: The samples/sec of every epoch
+    """
+    global export_requested
 
     boros = [1,2,3]
 
     with open('ensemble_log.txt', 'w') as f:
         f.write(f'epoch, train_RMSE, val_RMSE\n')
+    with open('ensemble_pairs_log.txt', 'w') as f:
+        f.write(f'epoch, start_boro, end_boro, train_RMSE, samples_per_sec\n')
+
+    epoch_samples_per_sec = []
 
     for epoch in range(start_epoch, start_epoch+num_epochs):
 
         print(f"\nEpoch {epoch+1}/{start_epoch+num_epochs}")
 
         # training
-        print("Training")
-        train_RMSE = 0.0
-        num_samples_dealt = 0
-
-        for start_boro in boros:
-            for end_boro in boros:
-
-                if start_boro == end_boro:
-                    continue
-
-                print(f'Start Boro {start_boro}, End boro {end_boro}')
-
-                batch_gen_args = {
-                    "PUfeatures": PUfeatures[start_boro][end_boro]['train'],
-                    "DOfeatures": DOfeatures[start_boro][end_boro]['train'],
-                    "DTfeatures": DTfeatures[start_boro][end_boro]['train'],
-                    "values": values[start_boro][end_boro]['train'],
-                    "batch_size": batch_size
-                }
-
-                total_samples = values[start_boro][end_boro]['train'].shape[0]
-                num_batches = int(total_samples/batch_size) + 1
-                counter = 0
-                p_bar = tqdm(total = num_batches)
-                samples_seen = 0
-                local_RMSE = 0.0
-
-                for pu_batch, do_batch, dt_batch, values_batch in batch_nn_generator(**batch_gen_args):
-                    # train on batch
-                    loss, rmse = ensemble_train_batch(pu_batch, do_batch, dt_batch, values_batch, selectors[start_boro][end_boro],
-                        boro_models[start_boro], boro_models[end_boro])
-                    num_samples_in_batch = pu_batch.shape[0]
-                    train_SE = samples_seen*(local_RMSE**2) + num_samples_in_batch*(rmse**2)
-                    samples_seen += num_samples_in_batch
-                    local_RMSE = np.sqrt(train_SE/samples_seen)
-                    counter += 1
-                    p_bar.update(1)
-                    if counter >= num_batches:
-                        break
-                p_bar.close()
-                print(f"Local RMSE: {local_RMSE}")
-                train_SE = num_samples_dealt*(train_RMSE**2) + samples_seen*(local_RMSE**2)
-                num_samples_dealt += samples_seen
-                train_RMSE = np.sqrt(train_SE/num_samples_dealt)
+        print(f"Training, with {schedule} scheduling of the pairs")
+        pairs = [(start_boro, end_boro) for start_boro in boros for end_boro in boros
+                 if start_boro != end_boro]
+        batch_generators = {}
+        num_batches = {}
+        for start_boro, end_boro in pairs:
+            batch_generators[start_boro, end_boro] = batch_nn_generator(
+                PUfeatures[start_boro][end_boro]['train'],
+                DOfeatures[start_boro][end_boro]['train'],
+                DTfeatures[start_boro][end_boro]['train'],
+                values[start_boro][end_boro]['train'],
+                batch_size)
+            total_samples = values[start_boro][end_boro]['train'].shape[0]
+            num_batches[start_boro, end_boro] = int(np.ceil(total_samples/batch_size))
+
+        pair_stats = {pair: ErrorStats() for pair in pairs}
+        pair_duration = {pair: 0.0 for pair in pairs}
+
+        pair_schedule = get_pair_schedule(num_batches, schedule, np.random.RandomState(epoch))
+        p_bar = tqdm(total = len(pair_schedule))
+        epoch_start = time()
+        for start_boro, end_boro in pair_schedule:
+            pu_batch, do_batch, dt_batch, values_batch = next(batch_generators[start_boro, end_boro])
+            # train on batch, with the selector of its pair
+            step_start = time()
+            loss, rmse, predictions = ensemble_train_batch(pu_batch, do_batch, dt_batch, values_batch,
+                ensembles[start_boro][end_boro])
+            pair_duration[start_boro, end_boro] += time() - step_start
+            pair_stats[start_boro, end_boro].update(predictions, values_batch)
+            p_bar.update(1)
+        p_bar.close()
+        epoch_duration = time() - epoch_start
+
+        with open('ensemble_pairs_log.txt', 'a') as f:
+            for start_boro, end_boro in pairs:
+                stats = pair_stats[start_boro, end_boro]
+                samples_per_sec = stats.count/max(1e-9, pair_duration[start_boro, end_boro])
+                print(f'Start Boro {start_boro}, End boro {end_boro}: '
+                      f'Local {stats}, {samples_per_sec:.1f} samples/sec')
+                f.write(f'{epoch}, {start_boro}, {end_boro}, {stats.rmse()}, {samples_per_sec}\n')
+        train_stats = merge_stats(pair_stats.values())
+        train_RMSE = train_stats.rmse()
+        epoch_samples_per_sec.append(train_stats.count/epoch_duration)
+        print(f'Training: {train_stats}')
+        print(f'Trained on {train_stats.count} samples in {epoch_duration:.1f} seconds, '
+              f'{epoch_samples_per_sec[-1]:.1f} samples/sec')
 
         # validation
         print("Validation")
-        RMSE = 0.0
-        num_samples_dealt = 0
-        for start_boro in boros:
-            for end_boro in boros:
-
-                if start_boro == end_boro:
-                    continue
-
-                print(f'Start Boro {start_boro}, End boro {end_boro}')
-                batch_gen_args = {
-                    "PUfeatures": PUfeatures[start_boro][end_boro]['test'],
-                    "DOfeatures": DOfeatures[start_boro][end_boro]['test'],
-                    "DTfeatures": DTfeatures[start_boro][end_boro]['test'],
-                    "values": values[start_boro][end_boro]['test'],
-                    "batch_size": batch_size
-                }
-
-                total_samples = values[start_boro][end_boro]['test'].shape[0]
-                num_batches = int(total_samples/batch_size) + 1
-                counter = 0
-                p_bar = tqdm(total = num_batches)
-                samples_seen = 0
-                local_RMSE = 0.0
-
-
-                for pu_batch, do_batch, dt_batch, values_batch in batch_nn_generator(**batch_gen_args):
-                    # validation
-                    rmse = ensemble_predict(pu_batch, do_batch, dt_batch, selectors[start_boro][end_boro],
-                        boro_models[start_boro], boro_models[end_boro], values_batch)
-                    num_samples_in_batch = pu_batch.shape[0]
-                    SE = samples_seen*(local_RMSE**2) + num_samples_in_batch*(rmse**2)
-                    samples_seen += num_samples_in_batch
-                    local_RMSE = np.sqrt(SE/samples_seen)
-                    counter += 1
-                    p_bar.update(1)
-                    if counter >= num_batches:
-                        break
-                p_bar.close()
-                print(f"Local RMSE: {local_RMSE}")
-                SE = num_samples_dealt*(RMSE**2) + samples_seen*(local_RMSE**2)
-                num_samples_dealt += samples_seen
-                RMSE = np.sqrt(SE/num_samples_dealt)
+        val_stats = {}
+        for start_boro, end_boro in pairs:
+            print(f'Start Boro {start_boro}, End boro {end_boro}')
+            total_samples = values[start_boro][end_boro]['test'].shape[0]
+            num_batches = int(np.ceil(total_samples/batch_size))
+            batch_generator = batch_nn_generator(
+                PUfeatures[start_boro][end_boro]['test'],
+                DOfeatures[start_boro][end_boro]['test'],
+                DTfeatures[start_boro][end_boro]['test'],
+                values[start_boro][end_boro]['test'],
+                batch_size)
+
+            val_stats[start_boro, end_boro] = ErrorStats()
+            for _ in tqdm(range(num_batches)):
+                pu_batch, do_batch, dt_batch, values_batch = next(batch_generator)
+                predictions = ensemble_predict(pu_batch, do_batch, dt_batch,
+                    ensembles[start_boro][end_boro])
+                val_stats[start_boro, end_boro].update(predictions, values_batch)
+            print(f"Local {val_stats[start_boro, end_boro]}")
+        RMSE = merge_stats(val_stats.values()).rmse()
+        print(f"Validation: {merge_stats(val_stats.values())}")
 
         print(f'At epoch: {epoch}, training RMSE: {train_RMSE}, validation RMSE: {RMSE}\n')
 
         with open('ensemble_log.txt', 'a') as f:
             f.write(f'{epoch}, {train_RMSE}, {RMSE}\n')
 
-        save_models(epoch)
+        if checkpoints is not None:
+            checkpoints.save(epoch)
+        last_epoch = epoch == start_epoch+num_epochs-1
+        if last_epoch or export_requested or \
+                (export_every > 0 and (epoch+1) % export_every == 0):
+            export_requested = False
+            save_models(epoch, ensemble_dir)
 
+    if checkpoints is not None:
+        checkpoints.close()
 
-def save_models(epoch):
+    return epoch_samples_per_sec
+
+
+def request_export(signum, frame):
+    global export_requested
+    export_requested = True
+    print("Exporting the models at the end of the epoch")
+
+
+def get_named_models():
+    """
+    :returns: Dictionary of all the models trained, by their checkpoint names
+    """
+    boros = [1,2,3]
+    models = {}
+    for start_boro in boros:
+        for end_boro in boros:
+            if start_boro != end_boro:
+                models[f'selector_{start_boro}_{end_boro}'] = selectors[start_boro][end_boro]
+    for boro in boros:
+        models[f'boro_{boro}'] = boro_models[boro]
+    models['bridge'] = br_model
+    return models
+
+
+def benchmark_steps(PUfeatures, DOfeatures, DTfeatures, values, batch_size=1000,
+                    num_steps=100, start_boro=1, end_boro=2):
+    """Times the training steps of one (start, end) pair when run
+    eagerly, compiled with tf.function, and compiled with XLA
+
+    :PUfeatures, DOfeatures, DTfeatures, values: the data as
+        returned by `load_cross_superboros`
+    :batch_size: the number of samples per step
+    :num_steps: the number of steps to time
+    :start_boro, end_boro: the pair whose models are trained
+    """
+    batch_gen_args = {
+        "PUfeatures": PUfeatures[start_boro][end_boro]['train'],
+        "DOfeatures": DOfeatures[start_boro][end_boro]['train'],
+        "DTfeatures": DTfeatures[start_boro][end_boro]['train'],
+        "values": values[start_boro][end_boro]['train'],
+        "batch_size": batch_size
+    }
+    # full batches only, so that every step runs the same trace
+    num_full_batches = int(values[start_boro][end_boro]['train'].shape[0]/batch_size)
+    assert num_full_batches > 0, "ERROR: Not enough samples for a single batch"
+    batches = []
+    for batch in batch_nn_generator(**batch_gen_args):
+        if len(batches) == min(num_steps, num_full_batches):
+            break
+        batches.append(batch)
+
+    for name, use_tf_function, jit_compile in [("eager", False, False),
+                                                ("tf.function", True, False),
+                                                ("tf.function + XLA", True, True)]:
+        ensemble_model = EnsembleModel(selectors[start_boro][end_boro], boro_models[start_boro],
+                                       br_model, boro_models[end_boro],
+                                       use_tf_function=use_tf_function, jit_compile=jit_compile)
+        # the first steps trace and compile the graph
+        for pu_batch, do_batch, dt_batch, values_batch in batches[:2]:
+            ensemble_model.train(pu_batch, do_batch, dt_batch, values_batch)
+
+        start_time = time()
+        for step in range(num_steps):
+            pu_batch, do_batch, dt_batch, values_batch = batches[step % len(batches)]
+            ensemble_model.train(pu_batch, do_batch, dt_batch, values_batch)
+        duration = time() - start_time
+        print(f'{name}: {duration/num_steps*1e3:.2f} ms per step, '
+              f'{num_steps*batch_size/duration:.1f} samples/sec')
+
+
+def autotune_ensemble_batch_size(PUfeatures, DOfeatures, DTfeatures, values,
+                                 memory_budget_mb, start_boro=1, end_boro=2):
+    """Finds the largest batch size of the ensemble training steps within
+    the memory budget, on the data of one (start, end) pair. The steps
+    train copies of the models, which leaves the weights and optimizer
+    states of the models themselves untouched.
+
+    :PUfeatures, DOfeatures, DTfeatures, values: the data as
+        returned by `load_cross_superboros`
+    :memory_budget_mb: the memory budget of training, in MB
+    :start_boro, end_boro: the pair whose models are trained
+    :returns: tuple of (batch size, results), as returned by
+        `perf_config.autotune_batch_size`
+    """
+    ensemble_model = ensembles[start_boro][end_boro]
+    ensemble_copy = EnsembleModel(*[copy_model(model) for model in ensemble_model.models],
+                                  use_tf_function=ensemble_model.use_tf_function,
+                                  jit_compile=ensemble_model.jit_compile)
+    num_samples = values[start_boro][end_boro]['train'].shape[0]
+
+    def make_batch(batch_size):
+        # repeat the samples of small pairs to fill large batches
+        rows = np.arange(batch_size) % num_samples
+        batch = [features[start_boro][end_boro]['train'][rows]
+                 for features in (PUfeatures, DOfeatures, DTfeatures)]
+        batch = [x.toarray() if sparse.issparse(x) else x for x in batch]
+        return batch + [values[start_boro][end_boro]['train'][rows]]
+
+    return autotune_batch_size(lambda batch: ensemble_copy.train(*batch),
+                               make_batch, memory_budget_mb)
+
+
+def save_models(epoch, ensemble_dir='ensemble'):
+    """Exports the weights and the SavedModels of all the models"""
     boros = [1,2,3]
-    if not os.path.isdir('ensemble'):
-        os.mkdir('ensemble')
+    if not os.path.isdir(ensemble_dir):
+        os.makedirs(ensemble_dir)
     for start_boro in boros:
         for end_boro in boros:
             if start_boro == end_boro:
                 continue
-            path = os.path.join('ensemble', 'selectors')
+            path = os.path.join(ensemble_dir, 'selectors')
             if not os.path.isdir(path):
                 os.mkdir(path)
             path = os.path.join(path, f'start_{start_boro}_end_{end_boro}')
@@ -367,7 +496,7 @@ def save_models(epoch):
             selectors[start_boro][end_boro].save_model(path)
 
     for boro in boros:
-        path = os.path.join('ensemble', 'boro_models')
+        path = os.path.join(ensemble_dir, 'boro_models')
         if not os.path.isdir(path):
             os.mkdir(path)
         path = os.path.join(path, f'boro_{boro}')
@@ -378,7 +507,7 @@ def save_models(epoch):
         path = os.path.join(path, f'epoch_{epoch}')
         boro_models[boro].save_model(path)
 
-    path = os.path.join('ensemble', 'bridge')
+    path = os.path.join(ensemble_dir, 'bridge')
     if not os.path.isdir(path):
         os.mkdir(path)
     weight_path = os.path.join(path, f'weights-{epoch:04d}.h5')
@@ -388,6 +517,13 @@ def save_models(epoch):
 
 
 def load_hot_start(epoch, ensemble_dir='ensemble'):
+    """Loads the weights of all the models after an epoch, from its
+    checkpoint if it is still kept, or else from its exported weights"""
+    checkpoint_path = get_checkpoint_path(os.path.join(ensemble_dir, 'checkpoints'), epoch)
+    if os.path.isfile(checkpoint_path):
+        load_checkpoint(checkpoint_path, get_named_models())
+        return
+
     boros = [1,2,3]
     for start_boro in boros:
         for end_boro in boros:
@@ -413,10 +549,10 @@ def main():
     global selectors
     global boro_models
     global br_model
-
-    tf.compat.v1.disable_eager_execution()
+    global ensembles
 
     parsed_args = parser.parse_args()
+    perf_config = apply_perf_config(parsed_args)
 
     feature_type = parsed_args.feature_type
     db_name = parsed_args.db_path
@@ -426,6 +562,10 @@ def main():
     hot_start = parsed_args.hot_start
     start_epoch = parsed_args.start_epoch
     ensemble_dir = parsed_args.ensemble_dir
+    checkpoint_dir = os.path.join(ensemble_dir, 'checkpoints')
+    # Checkpoints of another run would be taken for those of this one
+    assert hot_start or not list_checkpoint_epochs(checkpoint_dir), \
+        f"ERROR: {checkpoint_dir} holds checkpoints, hot start from them or remove them"
 
 
     boro_model_weights = {
@@ -447,8 +587,6 @@ def main():
     # 1: Manhattan, 2: Queens, 3: Staten Island
     bridge_matrix = create_bridge_matrices(conn)
 
-    sess = tf.compat.v1.Session()
-
     # create selector networks
     fsize = PUfeatures[1][2]['train'].shape[1]
     dtsize = DTfeatures[1][2]['train'].shape[1]
@@ -460,28 +598,59 @@ def main():
         for target_boro in boros:
             if boro == target_boro:
                 continue
-            selectors[boro][target_boro] = SelectorModel(sess, [100, bridge_matrix[boro][target_boro].shape[1]],
+            selectors[boro][target_boro] = SelectorModel([100, bridge_matrix[boro][target_boro].shape[1]],
                                                 fsize, dtsize, bridge_matrix[boro][target_boro], bridge_matrix[target_boro][boro])
 
 
     # load boro models
     feature_vec_size = FEATURE_TYPES[feature_type]['size']
     for boro in boros:
-        boro_models[boro] = BoroModel(sess, feature_vec_size, [200, 50])
+        boro_models[boro] = BoroModel(feature_vec_size, [200, 50])
         boro_models[boro].load_model_weights(boro_model_weights[boro])
 
     # create bridge model
-    br_model = BoroModel(sess, feature_vec_size, [100, 50])
+    br_model = BoroModel(feature_vec_size, [100, 50])
 
     # hot start
     if hot_start:
         if start_epoch == 0:
-            print("Please provide a start epoch if you hot start.")
-            exit(1)
+            checkpointed_epochs = list_checkpoint_epochs(checkpoint_dir)
+            if not checkpointed_epochs:
+                print("Please provide a start epoch if you hot start without checkpoints.")
+                exit(1)
+            start_epoch = checkpointed_epochs[-1] + 1
+        print(f"Hot starting from epoch {start_epoch-1}")
         load_hot_start(start_epoch-1, ensemble_dir)
 
-    # train
-    train(PUfeatures, DOfeatures, DTfeatures, values, num_epochs, batch_size, start_epoch)
+    # chain the models of every (start, end) pair into a single graph
+    for boro in boros:
+        ensembles[boro] = {}
+        for target_boro in boros:
+            if boro == target_boro:
+                continue
+            ensembles[boro][target_boro] = EnsembleModel(selectors[boro][target_boro],
+                                                boro_models[boro], br_model, boro_models[target_boro],
+                                                jit_compile=parsed_args.xla)
+
+    if parsed_args.bench_steps > 0:
+        benchmark_steps(PUfeatures, DOfeatures, DTfeatures, values, batch_size, parsed_args.bench_steps)
+        return
+
+    autotune_results = None
+    if parsed_args.batch_autotune_mb > 0:
+        batch_size, autotune_results = autotune_ensemble_batch_size(
+            PUfeatures, DOfeatures, DTfeatures, values, parsed_args.batch_autotune_mb)
+
+    # train, checkpointing in the background
+    checkpoints = AsyncCheckpointManager(checkpoint_dir, get_named_models(),
+                                         keep_last=parsed_args.keep_checkpoints)
+    signal.signal(signal.SIGUSR1, request_export)
+    samples_per_sec = train(PUfeatures, DOfeatures, DTfeatures, values, num_epochs, batch_size,
+          start_epoch, parsed_args.schedule, checkpoints, parsed_args.export_every,
+          ensemble_dir)
+    save_perf_config('ensemble_perf_config.json', perf_config, batch_size=batch_size,
+                     schedule=parsed_args.schedule, xla=parsed_args.xla,
+                     samples_per_sec=samples_per_sec, batch_autotune=autotune_results)
 
 
 if __name__ == "__main__":
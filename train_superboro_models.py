@@ -0,0 +1,159 @@
+import os
+import argparse
+import multiprocessing as mp
+from time import time
+
+from baseline_utils import *
+from obtain_features import *
+from baseline_model import parser as baseline_parser
+from baseline_model import xgboost, get_data_params
+
+
+parser = argparse.ArgumentParser(
+    description="Trains the XGBoost model of every super-borough "
+        "for every feature configuration, and records them in "
+        "the manifest read by `xgb_ensemble.py`. Arguments not "
+        "listed below are passed on to `baseline_model.py` "
+        "(e.g. '--num-trees 500 --max-depth 8')."
+    )
+
+parser.add_argument("--superboros", type=str, default="1,2,3",
+                    help="Comma-separated super-borough codes to train "
+                         "models for (1: Bronx, EWR, Manhattan | "
+                         "2: Brooklyn, Queens | 3: Staten Island)")
+parser.add_argument("--feature-configs", type=str, default="111,001,110",
+                    help="Comma-separated feature configurations to train "
+                         "models for, each given by 0/1 digits for "
+                         "datetime-one-hot, weekdays-one-hot and loc-id")
+parser.add_argument("--n-jobs", type=int, default=1,
+                    help="Number of models to train concurrently. The CPU "
+                         "cores are split evenly across them")
+parser.add_argument("--manifest", type=str, default="models/manifest.json",
+                    help="Path to the manifest of trained models")
+
+DATA_SEED = 10701
+
+
+def get_job_argv(superboro, feature_config, nthread, train_argv):
+    """Builds the `baseline_model.py` arguments of one model
+
+    :superboro: Super-borough code of the model
+    :feature_config: Feature configuration string, e.g. '111'
+    :nthread: Number of XGBoost threads of the job
+    :train_argv: Arguments shared by all the models
+    :returns: List of command-line arguments
+    """
+    argv = list(train_argv)
+    argv += ["--start-sb", str(superboro),
+             "--end-sb", str(superboro),
+             "--xgb-num-thread", str(nthread)]
+    if feature_config[0] == "1":
+        argv.append("--datetime-one-hot")
+    if feature_config[1] == "1":
+        argv.append("--weekdays-one-hot")
+    if feature_config[2] == "0":
+        argv.append("--no-loc-id")
+    return argv
+
+
+def dataset_exists(dataset_path):
+    """Whether `save_dmatrix` has already stored the dataset
+
+    :dataset_path: The path to the dataset (EXCLUDING the suffix)
+    :returns: Boolean
+    """
+    return os.path.exists(dataset_path + ".train") \
+        or os.path.exists(dataset_path + ".train.labels.npy")
+
+
+def train_superboro_model(job):
+    """Trains and saves one super-borough model. The features
+    are extracted and stored with `save_dmatrix` only if no
+    earlier run has stored the same dataset yet.
+
+    :job: Tuple of (superboro, feature_config, argv), where
+        argv is obtained from `get_job_argv`
+    :returns: Tuple of (superboro, feature_config, entry), where
+        entry is the dictionary recorded in the manifest
+    """
+    superboro, feature_config, argv = job
+    args = baseline_parser.parse_args(argv)
+    assert args.test_size > 0, \
+        "ERROR: The models are validated on the holdout of '--test-size'"
+    dataset_path = os.path.join("data", get_dmat_name(args, seed=DATA_SEED))
+
+    start_time = time()
+    if not dataset_exists(dataset_path):
+        conn = create_connection(args.db_path)
+        features, outputs = extract_features(conn, **get_data_params(args))
+        conn.close()
+        save_dmatrix(features, outputs, args, seed=DATA_SEED)
+        del features, outputs
+
+    dart_params = {
+         "rate_drop":args.rate_drop,
+         "sample_type":args.sample_type,
+         "normalize_type":args.normalize_type,
+    } if args.booster == "dart" else None
+    result, model = xgboost(booster=args.booster,
+                            lr=args.learning_rate,
+                            num_trees=args.num_trees,
+                            max_depth=args.max_depth,
+                            subsample=args.subsample_rate,
+                            dart_params=dart_params,
+                            n_jobs=args.xgb_num_thread,
+                            tree_method=args.tree_method,
+                            max_bin=args.max_bin,
+                            use_saved=True,
+                            save_path=dataset_path,
+                            verbose=args.verbose,
+                           )
+
+    log_time = write_log(args=args, stats=result)
+    model_path = xgb_save_model(model, log_time, args)
+    entry = {
+        "model_path": os.path.relpath(model_path),
+        "val_loss":   float(result["val_loss"]),
+        "dataset":    dataset_path,
+        "log":        log_time,
+    }
+    print(f">>> sb{superboro}{superboro}, features {feature_config}: "
+          f"val_loss {entry['val_loss']:.4f}, "
+          f"duration: {time() - start_time:.2f} seconds")
+    return superboro, feature_config, entry
+
+
+def main():
+    args, train_argv = parser.parse_known_args()
+
+    superboros = [int(sb) for sb in args.superboros.split(",")]
+    feature_configs = args.feature_configs.split(",")
+    for feature_config in feature_configs:
+        assert len(feature_config) == 3 and set(feature_config) <= {"0", "1"}, \
+            f"ERROR: Invalid feature configuration '{feature_config}'"
+
+    n_jobs = max(1, args.n_jobs)
+    nthread = max(1, mp.cpu_count() // n_jobs)
+    jobs = [(superboro, feature_config,
+             get_job_argv(superboro, feature_config, nthread, train_argv))
+            for feature_config in feature_configs
+            for superboro in superboros]
+
+    create_dir(os.path.dirname(args.manifest) or ".")
+
+    def record_models(results):
+        # Record each model as soon as it is trained
+        for superboro, feature_config, entry in results:
+            update_model_manifest(args.manifest, feature_config, superboro, entry)
+
+    if n_jobs == 1:
+        record_models(map(train_superboro_model, jobs))
+    else:
+        # Leaving the pool terminates its workers, also when a job fails
+        with mp.Pool(n_jobs, maxtasksperchild=1) as pool:
+            record_models(pool.imap_unordered(train_superboro_model, jobs))
+    print(f">>> Manifest written to {args.manifest}")
+
+
+if __name__ == "__main__":
+    main()
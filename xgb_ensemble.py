@@ -5,12 +5,14 @@ from sklearn.utils import shuffle
 
 import os
 import argparse
+import multiprocessing as mp
 from time import time
 
-from baseline_utils import SUPERBORO_CODE, create_dir
+from baseline_utils import SUPERBORO_CODE, create_dir, read_model_manifest
 from obtain_features import *
 from bridge_info import BRIDGES
 from borough_labels import BOROUGHS
+from streaming_metrics import ErrorStats, merge_stats
 
 
 parser = argparse.ArgumentParser(
@@ -19,31 +21,21 @@ parser = argparse.ArgumentParser(
     )
 
 # Super-boro models for inference
-# NOTE: The models whose names are specified below are not
-#       part of the repo; to run this code, first use
-#       `baseline_model.py` script to train and save each
-#       super-borough model
-BEST_MODEL_PATHS = {
-    "111": ["models/sb11_sm1.0_111_2019-12-06-04-08-05.xgb",
-            "models/sb22_sm1.0_111_2019-12-09-19-16-01.xgb",    # Val Loss: 336.6702
-            "models/sb33_sm1.0_111_2019-12-08-21-01-14.xgb",],
-    "001": ["models/sb11_sm1.0_001_2019-12-06-11-22-49.xgb",
-            "models/sb22_sm1.0_001_2019-12-09-19-16-24.xgb",
-            "models/sb33_sm1.0_001_2019-12-08-21-02-35.xgb",],
-    "110": ["models/sb11_sm1.0_110_2019-12-10-01-28-42.xgb",
-            "models/sb22_sm1.0_110_2019-12-09-18-57-34.xgb",    # Val Loss: 335.2700
-            "models/sb33_sm1.0_110_2019-12-09-18-49-37.xgb",],  # Val Loss: 589.2293
-}
-
+# NOTE: The models are not part of the repo; to run this code,
+#       first use `train_superboro_models.py` script to train
+#       each super-borough model and record it in the manifest
+parser.add_argument("--manifest", type=str, default="models/manifest.json",
+                    help="Path to the manifest of trained super-borough "
+                         "models written by `train_superboro_models.py`")
 parser.add_argument("-sb1", "--sb1-model-path", type=str,
                     help="Path to the stored model for Super-boro 1 (MEBx), "
-                         "will be automatically set")
+                         "read from `--manifest` if not provided")
 parser.add_argument("-sb2", "--sb2-model-path", type=str,
                     help="Path to the stored model for Super-boro 2 (BkQ), "
-                         "will be automatically set")
+                         "read from `--manifest` if not provided")
 parser.add_argument("-sb3", "--sb3-model-path", type=str,
                     help="Path to the stored model for Super-boro 3 (St), "
-                         "will be automatically set")
+                         "read from `--manifest` if not provided")
 
 # Dataset
 parser.add_argument("-sm", "--stddev-mul", type=float,
@@ -85,191 +77,229 @@ parser.add_argument("--log-dir", type=str, default="logs/xgb_ensemble",
                     help="Directory to store test log in")
 parser.add_argument("--log", type=int, default=0,
                     help="Log testing progress every {log} test points "
-                         "(default: 0 => do not log)")
+                         "(default: 0 => do not log). With `--n-jobs` "
+                         "larger than 1, each shard logs its own progress")
+parser.add_argument("--aggregate-logs", action="store_true",
+                    help="Print the merged progress of the sharded "
+                         "evaluation logged under `--log-dir` for the "
+                         "given configuration and `--n-jobs` (larger "
+                         "than 1), then exit")
 
+# Parallelism
+parser.add_argument("--n-jobs", type=int, default=1,
+                    help="Number of worker processes to shard the "
+                         "evaluation across (default: 1)")
 
-def connecting_bridges(start_superboro_id, end_superboro_id, conn):
-    """Returns all bridges connecting two superboroughs
 
-    :start_superboro_id: the first superborough we wish our
-        bridges to connect
-    :end_superboro_id: the other superborough we wish our
-        bridges to connect
-    :conn: a connection to the database containing information
-        on our bridges
-    :returns: a list of tuples, where the tuples contain two integers,
-        representing a start and an end location id
-    """
-    cursor = conn.cursor()
-
-    start_superboro_string = list_to_quoted_string(SUPERBORO_CODE[start_superboro_id])
-    end_superboro_string = list_to_quoted_string(SUPERBORO_CODE[end_superboro_id])
-
-    query = f"""
-    SELECT b.LocationID1, b.LocationID2
-    FROM bridges b, locations l1, locations l2
-    WHERE b.LocationID1 = l1.LocationID
-    AND b.LocationID2 = l2.LocationID
-    AND ((l1.Borough IN ({start_superboro_string}) AND l2.Borough in ({end_superboro_string}))
-    OR (l2.Borough IN ({start_superboro_string}) AND l1.Borough in ({end_superboro_string})))
-    """
+# Ordered pairs of distinct super-boros (PU code, DO code)
+SUPERBORO_PAIRS = ((1,2),(1,3),(2,1),(2,3),(3,1),(3,2))
 
-    try:
-        cursor.execute(query)
-    except Error as e:
-        print(e)
-    rows = cursor.fetchall()
-    return rows
+# Minimum number of trips predicted at once by `evaluate_trips`,
+# rounded up to a multiple of `--log`
+MIN_CHUNK_SIZE = 10000
 
 
-def get_location_ids_in_boro(boro, conn):
-    cursor = conn.cursor()
+def get_feature_layout(doh, woh, loc_id, max_loc_id=263):
+    """Returns the starting column of each location-related
+    block of features, within a feature vector obtained from
+    `extract_features` (with the default, non-NN ordering)
 
-    query = f"""
-    SELECT LocationID
-    FROM locations
-    WHERE Borough = "{boro}"
+    :doh: Boolean for datetime-one-hotness
+    :woh: Boolean for weekdays-one-hotness
+    :loc_id: Boolean for including PU, DO locationIDs
+        (locationIDs are one-hot if included)
+    :max_loc_id: The maximum possible value of location IDs
+    :returns: A dictionary mapping each of "pu_loc_id", "pu_coords",
+        "pu_boro", "do_loc_id", "do_coords" and "do_boro" to the
+        index of its first column (`None` for the location ID
+        blocks when `loc_id` is False), and "num_features" to the
+        length of the feature vector
     """
+    # dates, months, hours, minutes, seconds & weekdays
+    datetime_size = (31 + 12 + 24 + 60 + 60 if doh else 5) \
+                    + (7 if woh else 1)
+
+    if loc_id:
+        return {
+            "pu_loc_id": 0,
+            "pu_coords": max_loc_id,
+            "pu_boro":   max_loc_id + 2,
+            "do_loc_id": max_loc_id + 8,
+            "do_coords": 2*max_loc_id + 8,
+            "do_boro":   2*max_loc_id + 10,
+            "num_features": 2*max_loc_id + 16 + datetime_size,
+        }
 
-    try:
-        cursor.execute(query)
-    except Error as e:
-        print(e)
-    rows = cursor.fetchall()
-    return set([row[0] for row in rows])
-
-
-def crossboro_preproc_setup(conn):
-    loaded_bridge_data = {}
-    superboro_location_ids = {}
-    boro_location_ids = {}
-    inverted_boro_dict = {v: k for k, v in BOROUGHS.items()}
-    coordinates = extract_all_coordinates(conn, 'coordinates')
-    conn = conn
-
-    def crossboro_preproc(features, doh, woh, loc_id):
-        """Given the details of a single cross-superboro trip
-        as a 1-D array of features, for each bridge connecting
-        the two superboros involved, return the following info:
-            - PU Super-boro code (int between 1 and 3)
-            - DO Super-boro code (int between 1 and 3)
-            - Features for PU->bridge (np.array)
-            - Features for bridge->DO (np.array)
-
-        :features: A single row in `features` array obtained
-            from `extract_features` function call
-            (corresponds to a single cross-superboro trip)
-        :doh: Boolean for datetime-one-hotness
-        :woh: Boolean for weekdays-one-hotness
-        :loc_id: Boolean for including PU, DO locationIDs
-            (locationIDs are one-hot if included)
-        :returns: A list with length equal to the number of
-            bridges between the two super-boros, where each
-            element is a sublist with the info listed above
-        """
-        nonlocal loaded_bridge_data
-        nonlocal inverted_boro_dict
-        nonlocal superboro_location_ids
-        nonlocal boro_location_ids
-        nonlocal coordinates
-        nonlocal conn
-
-        # NOTE: if `features` is a row from `scipy.sparse` matrix,
-        #       it may have to be converted into `np.array` (dense)
-        is_sparse = doh or woh or loc_id
-        indices = features.nonzero()[1]
-
-        boro_start_index = 9
-        if woh:
-            boro_start_index += 6
-        if doh:
-            boro_start_index += 182
-
-        boro_start_from_end = -4
-        boro_end_from_end = -3
-        if not loc_id:
-            boro_start_from_end += 2
-            boro_end_from_end += 2
-
-        start_boro_one_hot = indices[boro_start_from_end] - boro_start_index
-        start_boro = inverted_boro_dict[start_boro_one_hot]
-        end_boro_one_hot = indices[boro_end_from_end] - (boro_start_index + 6)
-        end_boro = inverted_boro_dict[end_boro_one_hot]
-        start_code = 0
-        end_code = 0
-
-        for k, v in SUPERBORO_CODE.items():
-            if v is None:
-                continue
+    return {
+        "pu_loc_id": None,
+        "pu_coords": datetime_size,
+        "pu_boro":   datetime_size + 4,
+        "do_loc_id": None,
+        "do_coords": datetime_size + 2,
+        "do_boro":   datetime_size + 10,
+        "num_features": datetime_size + 16,
+    }
+
+
+def get_boro_to_superboro():
+    """Returns an np.array mapping each borough label
+    (refer to `BOROUGHS`) to its super-boro code,
+    with 0 for unknown boroughs"""
+    boro_to_superboro = np.zeros(len(BOROUGHS) + 1, dtype=int)
+    for code, boros in SUPERBORO_CODE.items():
+        if boros is None:
+            continue
+        for boro in boros:
+            boro_to_superboro[BOROUGHS[boro]] = code
+    return boro_to_superboro
+
+
+def get_bridge_legs(coordinates, boros):
+    """Precomputes the bridges connecting each ordered pair of
+    distinct super-boros from `BRIDGES`, with each bridge oriented
+    from its near side (in the PU super-boro) to its far side
+    (in the DO super-boro)
+
+    :coordinates: Array obtained from `extract_all_coordinates`
+    :boros: Array obtained from `extract_all_boroughs`
+    :returns: A dictionary mapping each pair in `SUPERBORO_PAIRS`
+        to a dictionary of np.arrays with one entry per bridge:
+            - "near_zone", "far_zone": location IDs of both sides
+            - "near_boro", "far_boro": borough labels of both sides
+            - "near_coords", "far_coords": coordinates of both sides
+    """
+    boro_labels = np.where(boros.any(axis=1), boros.argmax(axis=1) + 1, 0)
+    zone_superboros = get_boro_to_superboro()[boro_labels]
+    bridges = np.array(BRIDGES, dtype=int)
+    first_superboros = zone_superboros[bridges[:, 0]]
+    second_superboros = zone_superboros[bridges[:, 1]]
+
+    bridge_legs = {}
+    for start_code, end_code in SUPERBORO_PAIRS:
+        forward = (first_superboros == start_code) & (second_superboros == end_code)
+        backward = (first_superboros == end_code) & (second_superboros == start_code)
+        connecting = forward | backward
+        near_zones = np.where(forward, bridges[:, 0], bridges[:, 1])[connecting]
+        far_zones = np.where(forward, bridges[:, 1], bridges[:, 0])[connecting]
+        bridge_legs[(start_code, end_code)] = {
+            "near_zone":   near_zones,
+            "far_zone":    far_zones,
+            "near_boro":   boro_labels[near_zones],
+            "far_boro":    boro_labels[far_zones],
+            "near_coords": coordinates[near_zones],
+            "far_coords":  coordinates[far_zones],
+        }
+    return bridge_legs
 
-            if start_boro in v:
-                start_code = k
-            if end_boro in v:
-                end_code = k
-
-        superboro_pair_code = tuple(sorted((start_code, end_code)))
-        if superboro_pair_code not in loaded_bridge_data:
-            loaded_bridge_data[superboro_pair_code] = connecting_bridges(start_code, end_code, conn)
-
-        if start_code not in superboro_location_ids:
-            location_ids = set()
-            for boro in SUPERBORO_CODE[start_code]:
-                if boro not in boro_location_ids:
-                    boro_locations = get_location_ids_in_boro(boro, conn)
-                    boro_location_ids[boro] = boro_locations
-                location_ids.update(boro_location_ids[boro])
-            superboro_location_ids[start_code] = location_ids
-
-        if end_code not in superboro_location_ids:
-            location_ids = set()
-            for boro in SUPERBORO_CODE[end_code]:
-                if boro not in boro_location_ids:
-                    boro_locations = get_location_ids_in_boro(boro, conn)
-                    boro_location_ids[boro] = boro_locations
-                location_ids.update(boro_location_ids[boro])
-            superboro_location_ids[end_code] = location_ids
-
-        rides = []
-        for bridge in loaded_bridge_data[superboro_pair_code]:
-            first_zone, second_zone = bridge
-            start_zone = None
-            end_zone = None
-
-            if first_zone in superboro_location_ids[start_code]:
-                start_zone = first_zone
-                end_zone = second_zone
-            else:
-                start_zone = second_zone
-                end_zone = first_zone
 
-            bridge_start_boro = None
-            bridge_end_boro = None
-            for k, v in boro_location_ids.items():
-                if start_zone in v:
-                    bridge_start_boro = k
-                if end_zone in v:
-                    bridge_end_boro = k
+def get_superboro_codes(features, layout):
+    """Returns the PU and DO super-boro codes of each trip
 
-            bridge_start_boro_id = BOROUGHS[bridge_start_boro]
-            bridge_end_boro_id = BOROUGHS[bridge_end_boro]
+    :features: `features` array obtained from `extract_features`
+    :layout: Dictionary obtained from `get_feature_layout`
+    :returns: Two np.arrays containing the PU and DO super-boro
+        codes (ints between 1 and 3) of each trip
+    """
+    boro_to_superboro = get_boro_to_superboro()
 
-            first_leg = features.copy()
-            first_leg[0, indices[boro_end_from_end]] = 0
-            first_leg[0, bridge_start_boro_id + boro_start_index + 6] = 1
-            first_leg[0, boro_start_index - 1] = coordinates[start_zone][0]
-            first_leg[0, boro_start_index] = coordinates[start_zone][1]
+    codes = []
+    for prefix in ("pu", "do"):
+        start = layout[f"{prefix}_boro"]
+        boro_one_hots = features[:, start:start+len(BOROUGHS)]
+        if sparse.issparse(boro_one_hots):
+            boro_one_hots = boro_one_hots.toarray()
+        codes.append(boro_to_superboro[boro_one_hots.argmax(axis=1) + 1])
+    return codes[0], codes[1]
 
-            second_leg = features.copy()
-            second_leg[0, indices[boro_start_from_end]] = 0
-            second_leg[0, bridge_end_boro_id + boro_start_index] = 1
-            second_leg[0, boro_start_index - 3] = coordinates[end_zone][0]
-            second_leg[0, boro_start_index - 2] = coordinates[end_zone][1]
 
-            rides.append((start_code, end_code, first_leg, second_leg))
+def crossboro_batch_preproc_setup(conn, doh, woh, loc_id):
+    """Sets up a function expanding cross-superboro trips
+    into their legs through each connecting bridge
 
-        return rides
+    :conn: Connection to the database containing information
+        on our locations and coordinates (only read once, here)
+    :doh: Boolean for datetime-one-hotness
+    :woh: Boolean for weekdays-one-hotness
+    :loc_id: Boolean for including PU, DO locationIDs
+        (locationIDs are one-hot if included)
+    :returns: The `crossboro_batch_preproc` function described below
+    """
+    layout = get_feature_layout(doh, woh, loc_id)
+    bridge_legs = get_bridge_legs(extract_all_coordinates(conn, 'coordinates'),
+                                  extract_all_boroughs(conn, 'locations'))
+    num_boros = len(BOROUGHS)
+    num_loc_ids = 263
+
+    def location_template(zones, boro_ids, coords, prefix):
+        """Dense rows holding only the location-related features
+        of `zones` (one row per zone) in the `prefix` blocks"""
+        template = np.zeros((len(zones), layout["num_features"]))
+        rows = np.arange(len(zones))
+        coords_col = layout[f"{prefix}_coords"]
+        template[:, coords_col:coords_col+2] = coords
+        template[rows, layout[f"{prefix}_boro"] + boro_ids - 1] = 1
+        if loc_id:
+            template[rows, layout[f"{prefix}_loc_id"] + zones - 1] = 1
+        return template
+
+    def location_columns(prefix):
+        cols = [layout[f"{prefix}_coords"] + np.arange(2),
+                layout[f"{prefix}_boro"] + np.arange(num_boros)]
+        if loc_id:
+            cols.append(layout[f"{prefix}_loc_id"] + np.arange(num_loc_ids))
+        return np.concatenate(cols)
+
+    # PU->bridge replaces DO info, bridge->DO replaces PU info
+    bridge_templates = {}
+    for pair, legs in bridge_legs.items():
+        bridge_templates[pair] = (
+            location_columns("do"),
+            location_template(legs["near_zone"], legs["near_boro"],
+                              legs["near_coords"], "do"),
+            location_columns("pu"),
+            location_template(legs["far_zone"], legs["far_boro"],
+                              legs["far_coords"], "pu"),
+        )
+
+    def expand(features, num_bridges, cols, template):
+        num_trips = features.shape[0]
+        legs = features[np.repeat(np.arange(num_trips), num_bridges)]
+        tiled_rows = np.tile(np.arange(num_bridges), num_trips)
+        if sparse.issparse(features):
+            mask = np.ones(features.shape[1])
+            mask[cols] = 0
+            legs = legs.tocsr() @ sparse.diags(mask, format="csr")
+            legs.eliminate_zeros()
+            # Tile the sparse template, rather than sparsifying a tiled one
+            return (legs + sparse.csr_matrix(template)[tiled_rows]).tocsr()
+        legs[:, cols] = template[tiled_rows][:, cols]
+        return legs
+
+    def crossboro_batch_preproc(features, start_code, end_code):
+        """Given all cross-superboro trips from super-boro
+        `start_code` to `end_code`, and for each bridge connecting
+        the two superboros, build the following features:
+            - Features for PU->bridge
+            - Features for bridge->DO
+        Rows are ordered trip-major, i.e. the legs of trip `i`
+        through bridge `j` are at row `i*num_bridges + j`.
+
+        :features: Rows of `features` array obtained from
+            `extract_features` that start in `start_code` and
+            end in `end_code`
+        :start_code, end_code: PU and DO super-boro codes
+        :returns: A tuple of (first_legs, second_legs, num_bridges),
+            with legs of the same type as `features`
+        """
+        do_cols, do_template, pu_cols, pu_template = \
+            bridge_templates[(start_code, end_code)]
+        num_bridges = do_template.shape[0]
+
+        first_legs = expand(features, num_bridges, do_cols, do_template)
+        second_legs = expand(features, num_bridges, pu_cols, pu_template)
+        return first_legs, second_legs, num_bridges
 
-    return crossboro_preproc
+    return crossboro_batch_preproc
 
 
 def load_models(args):
@@ -288,89 +318,331 @@ def load_models(args):
     return [None,sb1_model,sb2_model,sb3_model]
 
 
+def predict_crossboro(models, crossboro_batch_preproc, features,
+                      start_code, end_code):
+    """Predict the durations of cross-superboro trips as the
+    minimum over the connecting bridges of the durations of
+    PU->bridge and bridge->DO
+
+    :models: List of models for prediction (starting at index 1)
+    :crossboro_batch_preproc: Function obtained from
+        `crossboro_batch_preproc_setup`
+    :features: Features of trips starting in `start_code`
+        and ending in `end_code`
+    :start_code, end_code: PU and DO super-boro codes
+    :returns: A tuple of (minimum durations, maximum durations,
+        number of bridges), with one duration per trip
+    """
+    first_legs, second_legs, num_bridges = \
+        crossboro_batch_preproc(features, start_code, end_code)
+
+    # Compute durations for all legs with a single call per model
+    PU_durations = models[start_code].predict(xgb.DMatrix(first_legs))
+    DO_durations = models[end_code].predict(xgb.DMatrix(second_legs))
+    durations = PU_durations + DO_durations
+
+    # Legs are ordered trip-major, `num_bridges` per trip
+    trip_starts = np.arange(0, durations.shape[0], num_bridges)
+    min_durations = np.minimum.reduceat(durations, trip_starts)
+    max_durations = np.maximum.reduceat(durations, trip_starts)
+    return min_durations, max_durations, num_bridges
+
+
+def predict_trips(models, crossboro_batch_preproc, features, layout):
+    """Predict the durations of any trips, using the model of
+    the super-boro for trips within a single super-boro, and
+    `predict_crossboro` for the others
+
+    :models: List of models for prediction (starting at index 1)
+    :crossboro_batch_preproc: Function obtained from
+        `crossboro_batch_preproc_setup`
+    :features: Features of the trips, as obtained from `extract_features`
+    :layout: Dictionary obtained from `get_feature_layout`
+    :returns: np.array of predicted durations, one per trip
+    """
+    sb_PUs, sb_DOs = get_superboro_codes(features, layout)
+    durations = np.zeros(features.shape[0])
+    for sb_PU, sb_DO in [(code, code) for code in (1, 2, 3)] + list(SUPERBORO_PAIRS):
+        trip_indices = np.nonzero((sb_PUs == sb_PU) & (sb_DOs == sb_DO))[0]
+        if trip_indices.shape[0] == 0:
+            continue
+        if sb_PU == sb_DO:
+            durations[trip_indices] = \
+                models[sb_PU].predict(xgb.DMatrix(features[trip_indices]))
+        else:
+            durations[trip_indices] = \
+                predict_crossboro(models, crossboro_batch_preproc,
+                                  features[trip_indices], sb_PU, sb_DO)[0]
+    return durations
+
+
+def evaluate_trips(models, crossboro_batch_preproc, features, outputs,
+                   layout, args, log_path=None, shard_id=None):
+    """Evaluate the selected superboro models on a set of
+    cross-superboro trips, and report the squared errors.
+
+    :models: List of models for prediction (starting at index 1)
+    :crossboro_batch_preproc: Function obtained from
+        `crossboro_batch_preproc_setup`
+    :features, outputs: Cross-superboro dataset to evaluate upon
+    :layout: Dictionary obtained from `get_feature_layout`
+    :args: argparse Namespace
+    :log_path: Path to the log file to record progress in
+        (default: None => do not log)
+    :shard_id: Index of the shard being evaluated, if the dataset
+        has been sharded across processes. Progress records are
+        then written with the exact sum of squared errors, so that
+        `aggregate_shard_logs` can merge them
+    :returns: A dictionary of the `ErrorStats` of the trips
+        of every (PU, DO) super-boro pair
+    """
+    total_loss = 0
+    pair_stats = {}
+    sb_PUs, sb_DOs = get_superboro_codes(features, layout)
+    breakpoint = args.log if args.log > 0 else 10
+    prefix = f"[Shard {shard_id}] " if shard_id is not None else ""
+
+    def record(checkpoint, sum_squared_errors, label="idx"):
+        running_loss = np.sqrt(sum_squared_errors / checkpoint)
+        if args.verbose > 0:
+            print(f">>> {prefix}Running test point {checkpoint}, "
+                  f"current loss {running_loss:.4f}")
+        if log_path is not None:
+            with open(log_path, "a+") as log_file:
+                if shard_id is None:
+                    log_file.write(f"{label} {checkpoint}: "
+                        f"{running_loss:.4f}\n")
+                else:
+                    log_file.write(f"{label} {checkpoint}: "
+                        f"{running_loss:.4f}, sse: {float(sum_squared_errors)!r}\n")
+
+    # Predict the trips chunk by chunk, so that progress is logged
+    # during the evaluation. Within a chunk, iterate through each
+    # ordered pair of distinct super-boros, expanding all of its
+    # trips over the connecting bridges at once, and scatter the
+    # predictions back to the trips' positions
+    num_trips = outputs.shape[0]
+    chunk_size = breakpoint * max(1, -(-MIN_CHUNK_SIZE // breakpoint))
+    pair_times = {}
+    idx = 0
+    eval_start_time = time()
+    for chunk_start in range(0, num_trips, chunk_size):
+        chunk_end = min(chunk_start + chunk_size, num_trips)
+        chunk_trips = chunk_end - chunk_start
+        all_min_durations = np.zeros(chunk_trips)
+        all_max_durations = np.zeros(chunk_trips)
+        evaluated = np.zeros(chunk_trips, dtype=bool)
+        for sb_PU, sb_DO in SUPERBORO_PAIRS:
+            trip_indices = np.nonzero((sb_PUs[chunk_start:chunk_end] == sb_PU)
+                                      & (sb_DOs[chunk_start:chunk_end] == sb_DO))[0]
+            if trip_indices.shape[0] == 0:
+                continue
+            pair_start_time = time()
+            min_durations, max_durations, num_bridges = \
+                predict_crossboro(models, crossboro_batch_preproc,
+                                  features[chunk_start + trip_indices], sb_PU, sb_DO)
+            all_min_durations[trip_indices] = min_durations
+            all_max_durations[trip_indices] = max_durations
+            evaluated[trip_indices] = True
+            pair_stats.setdefault((sb_PU, sb_DO), ErrorStats()) \
+                .update(min_durations, outputs[chunk_start + trip_indices])
+            pair_trips, _, pair_duration = pair_times.get((sb_PU, sb_DO), (0, 0, 0))
+            pair_times[sb_PU, sb_DO] = (pair_trips + trip_indices.shape[0], num_bridges,
+                                        pair_duration + time() - pair_start_time)
+
+        # Accumulate MSE loss in trip order, so that checkpoints report
+        # the same running loss as the former per-trip loop
+        trip_order = np.nonzero(evaluated)[0]
+        # For debugging purposes
+        if args.verbose > 1:
+            for order_idx, trip_idx in enumerate(trip_order):
+                print(f"{prefix}[{idx+order_idx+1:8}] "
+                      f"min: {all_min_durations[trip_idx]:15.3f}, "
+                      f"max: {all_max_durations[trip_idx]:15.3f}, "
+                      f"Target: {outputs[chunk_start + trip_idx]}")
+        squared_errors = (all_min_durations[trip_order]
+                          - outputs[chunk_start + trip_order])**2
+        running_losses = np.cumsum(np.concatenate([[total_loss], squared_errors]))
+        for checkpoint in range((idx // breakpoint + 1) * breakpoint,
+                                idx + trip_order.shape[0] + 1, breakpoint):
+            record(checkpoint, running_losses[checkpoint - idx])
+        idx += trip_order.shape[0]
+        total_loss = running_losses[-1]
+
+    if args.verbose > 0:
+        for (sb_PU, sb_DO), (pair_trips, num_bridges, pair_duration) in pair_times.items():
+            print(f">>> {prefix}SBs {sb_PU}->{sb_DO}: {pair_trips} trips "
+                  f"x {num_bridges} bridges in {pair_duration:.2f} seconds "
+                  f"({pair_trips / pair_duration:.1f} trips/sec)")
+
+    # Sharded logs always end with the shard's exact totals
+    if shard_id is not None and idx > 0:
+        record(idx, total_loss, label="done")
+
+    eval_duration = time() - eval_start_time
+    print(f">>> {prefix}Evaluated {idx} trips in {eval_duration:.2f} seconds "
+          f"({idx / eval_duration:.1f} trips/sec)")
+
+    return pair_stats
+
+
+# Per-process state of the workers used by `evaluate`
+# when `--n-jobs` is larger than 1
+_worker_state = {}
+
+
+def _init_worker(args, doh, woh, loc_id, nthread):
+    """Loads the models and sets up the preprocessing
+    once per worker process"""
+    models = load_models(args)
+    for model in models[1:]:
+        model.set_param({"nthread": nthread})
+    conn = create_connection(args.db_path)
+    _worker_state["models"] = models
+    _worker_state["preproc"] = crossboro_batch_preproc_setup(conn, doh, woh, loc_id)
+    _worker_state["layout"] = get_feature_layout(doh, woh, loc_id)
+    _worker_state["args"] = args
+
+
+def _evaluate_shard(shard):
+    shard_id, features, outputs, log_path = shard
+    return evaluate_trips(_worker_state["models"],
+                          _worker_state["preproc"],
+                          features, outputs,
+                          _worker_state["layout"],
+                          _worker_state["args"],
+                          log_path=log_path,
+                          shard_id=shard_id)
+
+
+def get_shard_log_path(log_path, shard_id):
+    """Returns the path to the progress log of a single shard"""
+    root, ext = os.path.splitext(log_path)
+    return f"{root}_shard{shard_id}{ext}"
+
+
+def aggregate_shard_logs(log_path, n_shards):
+    """Merges the latest progress records of each shard into
+    the progress of the whole evaluation. Can be run while
+    the evaluation is still in progress.
+
+    :log_path: Path to the log file of the whole evaluation
+    :n_shards: Number of shards the evaluation has been split into
+    :returns: A tuple of (number of trips evaluated so far,
+        RMSE over those trips, number of finished shards)
+    """
+    total_loss = 0
+    num_trips = 0
+    num_done = 0
+    for shard_id in range(n_shards):
+        try:
+            with open(get_shard_log_path(log_path, shard_id), "r") as log_file:
+                records = [line.split() for line in log_file
+                           if line.startswith(("idx", "done"))]
+        except OSError:
+            continue
+        if len(records) == 0:
+            continue
+        label, checkpoint, _, _, sum_squared_errors = records[-1]
+        num_trips += int(checkpoint[:-1])
+        total_loss += float(sum_squared_errors)
+        num_done += (label == "done")
+    rmse = np.sqrt(total_loss / num_trips) if num_trips > 0 else float("nan")
+    return num_trips, rmse, num_done
+
+
+def get_log_path(args):
+    """Returns the path to the log file of the evaluation
+    configured by `args`"""
+    return os.path.join(args.log_dir,
+                        f"log_ts{args.test_size}"
+                        f"_sm{args.stddev_mul}"
+                        f"_{int(args.datetime_one_hot)}"
+                        f"{int(args.weekdays_one_hot)}"
+                        f"{int(args.loc_id)}"
+                        ".txt")
+
+
+def report_pair_stats(pair_stats):
+    """Prints the error statistics of every super-boro pair,
+    and of all of them together
+
+    :pair_stats: Dictionary of the `ErrorStats` of every pair
+    :returns: The merged `ErrorStats`
+    """
+    for sb_PU, sb_DO in SUPERBORO_PAIRS:
+        if (sb_PU, sb_DO) in pair_stats:
+            print(f">>> SBs {sb_PU}->{sb_DO}: {pair_stats[sb_PU, sb_DO]}")
+    stats = merge_stats(pair_stats.values())
+    print(f">>> All cross-superboro trips: {stats}")
+    return stats
+
+
 def evaluate(models, features, outputs, doh, woh, loc_id, args):
     """Evaluate the selected superboro models on cross-superboro
-    trips.
+    trips. If `args.n_jobs` is larger than 1, the trips are
+    sharded across that many worker processes, each loading
+    the models once, and the squared errors of each shard
+    are merged into the exact RMSE.
 
-    :models: List of models for prediction (starting at index 1)
+    :models: List of models for prediction (starting at index 1),
+        unused by the worker processes
     :features, outputs: Cross-superboro dataset to evaluate upon
     :doh: Boolean for datetime-one-hotness
     :woh: Boolean for weekdays-one-hotness
     :loc_id: Boolean for including PU, DO locationIDs
         (locationIDs are one-hot if included)
-    :returns: Total loss from the given dataset
+    :returns: The RMSE over the given dataset
     """
-    conn = create_connection(args.db_path)
-    total_loss = 0
-    crossboro_preproc = crossboro_preproc_setup(conn)
-    convert = lambda trip: crossboro_preproc(trip, doh, woh, loc_id)
+    n_jobs = args.n_jobs
+    log_path = None
 
     if args.log > 0:
-        log_dir = create_dir(args.log_dir)
-        log_path = os.path.join(log_dir,
-                                f"log_ts{args.test_size}"
-                                f"_sm{args.stddev_mul}"
-                                f"_{int(args.datetime_one_hot)}"
-                                f"{int(args.weekdays_one_hot)}"
-                                f"{int(args.loc_id)}"
-                                ".txt")
+        create_dir(args.log_dir)
+        log_path = get_log_path(args)
         print(f">>> To be logged in: {log_path}")
-        try:
-            os.remove(log_path)
-        except OSError:
-            pass
+        for path in [log_path] + [get_shard_log_path(log_path, shard_id)
+                                  for shard_id in range(n_jobs)]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
         with open(log_path, "a+") as log_file:
             log_file.write(f"sb1: {args.sb1_model_path} \n")
             log_file.write(f"sb2: {args.sb2_model_path} \n")
             log_file.write(f"sb3: {args.sb3_model_path} \n")
+            if n_jobs > 1:
+                log_file.write(f"n_shards: {n_jobs} \n")
             log_file.write("\n")
 
-    breakpoint = args.log if args.log > 0 else 10
-
-    # Iterate through each cross-superboro trip
-    for idx, (inputs_, output) in enumerate(zip(features, outputs)):
-        inputs = convert(inputs_)
-
-        min_duration = 1e20
-        max_duration = -1
-
-        # Compute loss for each bridge and record minimum
-        for (sb_PU, sb_DO, f_PU, f_DO) in inputs:
-            f_PU_dmat = xgb.DMatrix(f_PU)
-            f_DO_dmat = xgb.DMatrix(f_DO)
-
-            # Compute durations for each trip
-            PU_duration = models[sb_PU].predict(f_PU_dmat)[0]
-            DO_duration = models[sb_DO].predict(f_DO_dmat)[0]
-
-            # Compute total duration & MSE loss
-            duration = PU_duration + DO_duration
-            min_duration = min(min_duration, duration)
-            max_duration = max(max_duration, duration)
-
-        # For debugging purposes
-        if args.verbose > 1:
-            print(f"[{idx+1:8}] "
-                  f"min: {min_duration:15.3f}, "
-                  f"max: {max_duration:15.3f}, "
-                  f"Target: {output}")
-
-            if min_duration == 1e20:
-                print(inputs_)
-                print(inputs)
-
-        total_loss += (min_duration - output)**2
-
-        if (idx+1) % breakpoint == 0:
+    if n_jobs <= 1:
+        conn = create_connection(args.db_path)
+        crossboro_batch_preproc = crossboro_batch_preproc_setup(conn, doh, woh, loc_id)
+        pair_stats = evaluate_trips(models, crossboro_batch_preproc,
+                                    features, outputs,
+                                    get_feature_layout(doh, woh, loc_id),
+                                    args, log_path=log_path)
+        return report_pair_stats(pair_stats).rmse()
+
+    # Split XGBoost threads evenly across the workers
+    nthread = max(1, mp.cpu_count() // n_jobs)
+    shards = [(shard_id, features[indices], outputs[indices],
+               get_shard_log_path(log_path, shard_id) if log_path is not None else None)
+              for shard_id, indices in enumerate(
+                  np.array_split(np.arange(outputs.shape[0]), n_jobs))]
+
+    pair_stats = {}
+    with mp.Pool(n_jobs, initializer=_init_worker,
+                 initargs=(args, doh, woh, loc_id, nthread)) as pool:
+        for shard_stats in pool.imap_unordered(_evaluate_shard, shards):
+            for pair, stats in shard_stats.items():
+                pair_stats.setdefault(pair, ErrorStats()).merge(stats)
             if args.verbose > 0:
-                print(f">>> Running test point {idx+1}, "
-                      f"current loss {np.sqrt(total_loss / (idx+1)):.4f}")
-            if args.log > 0:
-                with open(log_path, "a+") as log_file:
-                    log_file.write(f"idx {idx+1}: "
-                        f"{np.sqrt(total_loss / (idx+1)):.4f}\n")
+                stats = merge_stats(pair_stats.values())
+                print(f">>> {stats.count}/{outputs.shape[0]} trips evaluated, "
+                      f"current loss {stats.rmse():.4f}")
 
-    return np.sqrt(total_loss / outputs.shape[0])
+    return report_pair_stats(pair_stats).rmse()
 
 
 def load_cross_superboro(args, f_path=None, o_path=None):
@@ -460,6 +732,18 @@ def load_cross_superboro(args, f_path=None, o_path=None):
 
 def main():
     args = parser.parse_args()
+
+    if args.aggregate_logs:
+        # Only the shards of `--n-jobs` larger than 1 log their sums
+        assert args.n_jobs > 1, \
+            "ERROR: `--aggregate-logs` merges the logs of `--n-jobs` larger than 1"
+        num_trips, loss, num_done = \
+            aggregate_shard_logs(get_log_path(args), args.n_jobs)
+        print(f">>> {num_done}/{args.n_jobs} shards done, "
+              f"{num_trips} test points evaluated, "
+              f"current loss {loss:.4f}")
+        return
+
     is_sparse = args.datetime_one_hot \
                 or args.weekdays_one_hot \
                 or args.loc_id
@@ -477,8 +761,14 @@ def main():
     models_key = f"{int(args.datetime_one_hot)}" \
                  f"{int(args.weekdays_one_hot)}" \
                  f"{int(args.loc_id)}"
-    args.sb1_model_path, args.sb2_model_path, args.sb3_model_path = \
-        BEST_MODEL_PATHS[models_key]
+    manifest = read_model_manifest(args.manifest).get(models_key, {})
+    for superboro in (1, 2, 3):
+        path_arg = f"sb{superboro}_model_path"
+        if getattr(args, path_arg) is None:
+            assert str(superboro) in manifest, \
+                f"ERROR: No super-borough {superboro} model for features " \
+                f"{models_key} in {args.manifest}"
+            setattr(args, path_arg, manifest[str(superboro)]["model_path"])
 
     if args.use_saved:  # Load arrays stored in disk
         if args.verbose:
@@ -505,7 +795,8 @@ def main():
         print(f">>> features.shape = {features.shape}")
         print(f">>> outputs.shape = {outputs.shape}")
 
-    models = load_models(args)
+    # With `--n-jobs`, each worker process loads its own models
+    models = load_models(args) if args.n_jobs <= 1 else None
 
     if args.verbose:
         start_time = time()